@@ -44,9 +44,12 @@ Please read the full license here: https://huggingface.co/spaces/CompVis/stable-
 # !!   "cellView": "form"
 # !! }}
 #@markdown **NVIDIA GPU**
-import subprocess
-sub_p_res = subprocess.run(['nvidia-smi', '--query-gpu=name,memory.total,memory.free', '--format=csv,noheader'], stdout=subprocess.PIPE).stdout.decode('utf-8')
-print(sub_p_res)
+import shutil, subprocess
+if shutil.which('nvidia-smi'):
+    sub_p_res = subprocess.run(['nvidia-smi', '--query-gpu=name,memory.total,memory.free', '--format=csv,noheader'], stdout=subprocess.PIPE).stdout.decode('utf-8')
+    print(sub_p_res)
+else:
+    print("No NVIDIA GPU found, rendering will run on the cpu")
 
 # %%
 # !! {"metadata":{
@@ -107,7 +110,6 @@ if setup_environment:
         ['pip', 'install', 'accelerate', 'ftfy', 'jsonmerge', 'matplotlib', 'resize-right', 'timm', 'torchdiffeq'],
         ['git', 'clone', 'https://github.com/shariqfarooq123/AdaBins.git'],
         ['git', 'clone', 'https://github.com/isl-org/MiDaS.git'],
-        ['git', 'clone', 'https://github.com/MSFTserver/pytorch3d-lite.git'],
     ]
     for process in all_process:
         running = subprocess.run(process,stdout=subprocess.PIPE).stdout.decode('utf-8')
@@ -130,10 +132,9 @@ if setup_environment:
 import json
 from IPython import display
 
-import gc, math, os, pathlib, subprocess, sys, time
+import gc, math, os, subprocess, sys, time
 import cv2
 import numpy as np
-import pandas as pd
 import random
 import requests
 import torch
@@ -145,7 +146,6 @@ from einops import rearrange, repeat
 from omegaconf import OmegaConf
 from PIL import Image
 from pytorch_lightning import seed_everything
-from skimage.exposure import match_histograms
 from torchvision.utils import make_grid
 from tqdm import tqdm, trange
 from types import SimpleNamespace
@@ -158,18 +158,18 @@ sys.path.extend([
     'src/clip',
     'stable-diffusion/',
     'k-diffusion',
-    'pytorch3d-lite',
     'AdaBins',
     'MiDaS',
 ])
 
-import py3d_tools as p3d
-
-from helpers import DepthModel, sampler_fn
-from k_diffusion.external import CompVisDenoiser
+from helpers import ColorMatcher, ConditioningCache, DepthModel, FrameWriter, Predictor, RenderJournal, RenderServer, SamplerPool, VideoEncoder, VideoFrameSource, euler_angles_to_matrix, get_inbetweens, get_prompt_series, parse_key_frames, sampler_fn, warp_depth_3d, warp_images_3d
+from ldm.checkpoint import checkpoint_sha256, load_checkpoint, load_weights, no_init_weights
+from ldm.devices import describe, empty_cache, get_device, get_dtype, set_cpu_threads
+from ldm.download import fetch
 from ldm.util import instantiate_from_config
-from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.guidance import GuidanceSchedule
+from ldm.modules.attention import set_attention_backend, set_token_merging
+from ldm.modules.diffusionmodules.feature_cache import feature_caching
 
 def sanitize(prompt):
     whitelist = set('abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ')
@@ -290,7 +290,8 @@ def warpMatrix(W, H, theta, phi, gamma, scale, fV):
 
     return M33, sideLength
 
-def anim_frame_warp_2d(prev_img_cv2, args, anim_args, keys, frame_idx):
+def anim_frame_matrix_2d(args, anim_args, keys, frame_idx):
+    # 3x3 pixel space transform of a 2D animation step, as used by cv2.warpPerspective
     angle = keys.angle_series[frame_idx]
     zoom = keys.zoom_series[frame_idx]
     translation_x = keys.translation_x_series[frame_idx]
@@ -313,7 +314,10 @@ def anim_frame_warp_2d(prev_img_cv2, args, anim_args, keys, frame_idx):
         xform = np.matmul(bM, rot_mat, trans_mat)
     else:
         xform = np.matmul(rot_mat, trans_mat)
+    return xform
 
+def anim_frame_warp_2d(prev_img_cv2, args, anim_args, keys, frame_idx):
+    xform = anim_frame_matrix_2d(args, anim_args, keys, frame_idx)
     return cv2.warpPerspective(
         prev_img_cv2,
         xform,
@@ -321,7 +325,7 @@ def anim_frame_warp_2d(prev_img_cv2, args, anim_args, keys, frame_idx):
         borderMode=cv2.BORDER_WRAP if anim_args.border == 'wrap' else cv2.BORDER_REPLICATE
     )
 
-def anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx):
+def anim_frame_transform_3d(keys, frame_idx):
     TRANSLATION_SCALE = 1.0/200.0 # matches Disco
     translate_xyz = [
         -keys.translation_x_series[frame_idx] * TRANSLATION_SCALE, 
@@ -333,10 +337,69 @@ def anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx):
         math.radians(keys.rotation_3d_y_series[frame_idx]), 
         math.radians(keys.rotation_3d_z_series[frame_idx])
     ]
-    rot_mat = p3d.euler_angles_to_matrix(torch.tensor(rotate_xyz, device=device), "XYZ").unsqueeze(0)
-    result = transform_image_3d(prev_img_cv2, depth, rot_mat, translate_xyz, anim_args)
-    torch.cuda.empty_cache()
-    return result
+    rot_mat = euler_angles_to_matrix(rotate_xyz, device=device)
+    return rot_mat, translate_xyz
+
+def anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx):
+    # prev_img_cv2 may be a list of frames that share the depth, they are warped in one batch
+    rot_mat, translate_xyz = anim_frame_transform_3d(keys, frame_idx)
+    return transform_image_3d(prev_img_cv2, depth, rot_mat, translate_xyz, anim_args)
+
+def anim_depth_warp_3d(depth, anim_args, keys, frame_idx):
+    # moves a depth map along with the frame it was predicted for, so in-between frames can reuse it:
+    # every point gets its depth in the moved camera and is resampled with the same grid as the image
+    rot_mat, translate_xyz = anim_frame_transform_3d(keys, frame_idx)
+    return warp_depth_3d(depth, rot_mat, translate_xyz, anim_args)
+
+# Latent warping: the same 2D and 3D motion applied directly to the previous frame's latent, so
+# the next frame can start from it without decoding, warping in pixel space and encoding again.
+def latent_warp_grid_2d(xform, width, height, f):
+    # grid_sample grid for a latent of (height//f, width//f): every latent pixel center is mapped
+    # through the inverse pixel space transform, like cv2.warpPerspective does
+    h, w = height // f, width // f
+    y, x = torch.meshgrid(torch.arange(h, dtype=torch.float32, device=device), torch.arange(w, dtype=torch.float32, device=device))
+    dst = torch.stack(((x + 0.5) * f - 0.5, (y + 0.5) * f - 0.5, torch.ones_like(x)), dim=-1)
+    inv = torch.tensor(np.linalg.inv(xform), dtype=torch.float32, device=device)
+    src = dst @ inv.T
+    src = src[..., :2] / src[..., 2:]
+    grid = (src + 0.5) / torch.tensor([width, height], dtype=torch.float32, device=device) * 2 - 1
+    return grid.unsqueeze(0)
+
+def sample_latent(latent, grid, anim_args):
+    if anim_args.border == 'wrap':
+        grid = torch.remainder(grid + 1, 2) - 1
+    warped = torch.nn.functional.grid_sample(
+        latent.float(),
+        grid.expand(latent.shape[0], -1, -1, -1),
+        mode='bilinear',
+        padding_mode='border',
+        align_corners=False
+    )
+    return warped.to(latent.dtype)
+
+def anim_latent_warp_2d(latent, args, anim_args, keys, frame_idx):
+    xform = anim_frame_matrix_2d(args, anim_args, keys, frame_idx)
+    return sample_latent(latent, latent_warp_grid_2d(xform, args.W, args.H, args.f), anim_args)
+
+def anim_latent_warp_3d(latent, depth, anim_args, keys, frame_idx):
+    h, w = latent.shape[2], latent.shape[3]
+    if depth is None:
+        depth = torch.ones((h, w), device=device)
+    else:
+        depth = torch.nn.functional.interpolate(depth[None, None].float(), size=(h, w), mode='area').squeeze()
+    rot_mat, translate_xyz = anim_frame_transform_3d(keys, frame_idx)
+    return warp_images_3d(latent.float(), depth, rot_mat, translate_xyz, anim_args).to(latent.dtype)
+
+def match_latent_colors(latent, color_match_latent):
+    # latent counterpart of maintain_colors, matches the per channel mean and std of the first frame
+    mean, std = latent.mean(dim=(2, 3), keepdim=True), latent.std(dim=(2, 3), keepdim=True)
+    match_mean, match_std = color_match_latent.mean(dim=(2, 3), keepdim=True), color_match_latent.std(dim=(2, 3), keepdim=True)
+    return (latent - mean) / std.clamp(min=1e-5) * match_std + match_mean
+
+def contrast_latent(latent, contrast):
+    # scales each channel around its mean, the latent stand-in for multiplying the image
+    mean = latent.mean(dim=(2, 3), keepdim=True)
+    return mean + (latent - mean) * contrast
 
 def add_noise(sample: torch.Tensor, noise_amt: float) -> torch.Tensor:
     return sample + torch.randn(sample.shape, device=sample.device) * noise_amt
@@ -423,21 +486,6 @@ def prepare_mask(mask_input, mask_shape, mask_brightness_adjust=1.0, mask_contra
     mask = np.clip(mask,0,1)
     return mask
 
-def maintain_colors(prev_img, color_match_sample, mode):
-    if mode == 'Match Frame 0 RGB':
-        return match_histograms(prev_img, color_match_sample, multichannel=True)
-    elif mode == 'Match Frame 0 HSV':
-        prev_img_hsv = cv2.cvtColor(prev_img, cv2.COLOR_RGB2HSV)
-        color_match_hsv = cv2.cvtColor(color_match_sample, cv2.COLOR_RGB2HSV)
-        matched_hsv = match_histograms(prev_img_hsv, color_match_hsv, multichannel=True)
-        return cv2.cvtColor(matched_hsv, cv2.COLOR_HSV2RGB)
-    else: # Match Frame 0 LAB
-        prev_img_lab = cv2.cvtColor(prev_img, cv2.COLOR_RGB2LAB)
-        color_match_lab = cv2.cvtColor(color_match_sample, cv2.COLOR_RGB2LAB)
-        matched_lab = match_histograms(prev_img_lab, color_match_lab, multichannel=True)
-        return cv2.cvtColor(matched_lab, cv2.COLOR_LAB2RGB)
-
-
 #
 # Callback functions
 #
@@ -564,45 +612,41 @@ def sample_to_cv2(sample: torch.Tensor, type=np.uint8) -> np.ndarray:
     sample_int8 = (sample_f32 * 255)
     return sample_int8.astype(type)
 
+def sample_to_turbo_frame(sample: torch.Tensor, anim_args):
+    # turbo frames are RGB HWC float32 (0-255) like sample_to_cv2(sample, type=np.float32). In 3D
+    # they stay device tensors across the in-between warps, in 2D they are numpy arrays for cv2.
+    if anim_args.animation_mode != '3D':
+        return sample_to_cv2(sample, type=np.float32)
+    frame = rearrange(sample.squeeze(0).to(device, torch.float32), "c h w -> h w c")
+    return ((frame * 0.5) + 0.5).clamp(0, 1) * 255
+
+def frame_to_cv2(frame):
+    # numpy array of a turbo frame, for saving and for the init of the next diffused frame
+    return frame.cpu().numpy() if isinstance(frame, torch.Tensor) else frame
+
 def transform_image_3d(prev_img_cv2, depth_tensor, rot_mat, translate, anim_args):
     # adapted and optimized version of transform_image_3d from Disco Diffusion https://github.com/alembics/disco-diffusion 
-    w, h = prev_img_cv2.shape[1], prev_img_cv2.shape[0]
-
-    aspect_ratio = float(w)/float(h)
-    near, far, fov_deg = anim_args.near_plane, anim_args.far_plane, anim_args.fov
-    persp_cam_old = p3d.FoVPerspectiveCameras(near, far, aspect_ratio, fov=fov_deg, degrees=True, device=device)
-    persp_cam_new = p3d.FoVPerspectiveCameras(near, far, aspect_ratio, fov=fov_deg, degrees=True, R=rot_mat, T=torch.tensor([translate]), device=device)
-
-    # range of [-1,1] is important to torch grid_sample's padding handling
-    y,x = torch.meshgrid(torch.linspace(-1.,1.,h,dtype=torch.float32,device=device),torch.linspace(-1.,1.,w,dtype=torch.float32,device=device))
-    z = torch.as_tensor(depth_tensor, dtype=torch.float32, device=device)
-    xyz_old_world = torch.stack((x.flatten(), y.flatten(), z.flatten()), dim=1)
-
-    xyz_old_cam_xy = persp_cam_old.get_full_projection_transform().transform_points(xyz_old_world)[:,0:2]
-    xyz_new_cam_xy = persp_cam_new.get_full_projection_transform().transform_points(xyz_old_world)[:,0:2]
-
-    offset_xy = xyz_new_cam_xy - xyz_old_cam_xy
-    # affine_grid theta param expects a batch of 2D mats. Each is 2x3 to do rotation+translation.
-    identity_2d_batch = torch.tensor([[1.,0.,0.],[0.,1.,0.]], device=device).unsqueeze(0)
-    # coords_2d will have shape (N,H,W,2).. which is also what grid_sample needs.
-    coords_2d = torch.nn.functional.affine_grid(identity_2d_batch, [1,1,h,w], align_corners=False)
-    offset_coords_2d = coords_2d - torch.reshape(offset_xy, (h,w,2)).unsqueeze(0)
-
-    image_tensor = rearrange(torch.from_numpy(prev_img_cv2.astype(np.float32)), 'h w c -> c h w').to(device)
-    new_image = torch.nn.functional.grid_sample(
-        image_tensor.add(1/512 - 0.0001).unsqueeze(0), 
-        offset_coords_2d, 
-        mode=anim_args.sampling_mode, 
-        padding_mode=anim_args.padding_mode, 
-        align_corners=False
-    )
-
-    # convert back to cv2 style numpy array
-    result = rearrange(
-        new_image.squeeze().clamp(0,255), 
-        'c h w -> h w c'
-    ).cpu().numpy().astype(prev_img_cv2.dtype)
-    return result
+    # prev_img_cv2 is a frame or a list of frames of the same size, warped together on the device.
+    # Frames are HWC numpy arrays or device tensors, tensors are returned as float32 tensors.
+    images = prev_img_cv2 if isinstance(prev_img_cv2, list) else [prev_img_cv2]
+    h, w = images[0].shape[:2]
+    if depth_tensor is None:
+        depth_tensor = torch.ones((h, w), device=device)
+
+    image_tensor = torch.stack([
+        img.to(device, torch.float32) if isinstance(img, torch.Tensor) else torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32)).to(device)
+        for img in images
+    ])
+    image_tensor = rearrange(image_tensor, 'b h w c -> b c h w')
+    new_image = warp_images_3d(image_tensor.add(1/512 - 0.0001), torch.as_tensor(depth_tensor, device=device), rot_mat, translate, anim_args)
+    new_image = rearrange(new_image.clamp(0,255), 'b c h w -> b h w c')
+
+    # convert numpy frames back to cv2 style numpy arrays
+    results = [
+        result if isinstance(img, torch.Tensor) else result.cpu().numpy().astype(img.dtype)
+        for result, img in zip(new_image, images)
+    ]
+    return results if isinstance(prev_img_cv2, list) else results[0]
 
 def check_is_number(value):
     float_pattern = r'^(?=.)([+-]?([0-9]*)(\.([0-9]+))?)$'
@@ -612,6 +656,17 @@ def check_is_number(value):
 # borrowed from https://github.com/kylewlacy/stable-diffusion/blob/0a4397094eb6e875f98f9d71193e350d859c4220/ldm/dream/conditioning.py
 # and https://github.com/raefu/stable-diffusion-automatic/blob/unstablediffusion/modules/processing.py
 def get_uc_and_c(prompts, model, args, frame = 0):
+    if isinstance(frame, list):
+        # frames batched together each get the conditioning of their own prompt and frame index,
+        # the sub-prompts of all of them are encoded in one text encoder call first
+        conditioning_cache.get_many(model, [
+            text for p, f in zip(prompts, frame)
+            for text in conditioning_texts(p, *split_weighted_subprompts(p, f, not args.normalize_prompt_weights))
+        ])
+        frame_args = SimpleNamespace(**{**vars(args), 'n_samples': 1})
+        ucs, cs = zip(*[get_uc_and_c([p], model, frame_args, f) for p, f in zip(prompts, frame)])
+        return (torch.cat(ucs), torch.cat(cs))
+
     prompt = prompts[0] # they are the same in a batch anyway
 
     # get weighted sub-prompts
@@ -619,26 +674,40 @@ def get_uc_and_c(prompts, model, args, frame = 0):
         prompt, frame, not args.normalize_prompt_weights
     )
 
+    # the sub-prompts of uc and c in one text encoder call, each distinct text once
+    conditioning_cache.get_many(model, conditioning_texts(prompt, negative_subprompts, positive_subprompts))
     uc = get_learned_conditioning(model, negative_subprompts, "", args, -1)
     c = get_learned_conditioning(model, positive_subprompts, prompt, args, 1)
 
     return (uc, c)
 
+def conditioning_texts(prompt, negative_subprompts, positive_subprompts):
+    # the texts get_learned_conditioning encodes for uc and c
+    negative = [subtext for subtext, _ in negative_subprompts] or [""]
+    positive = [subtext for subtext, _ in positive_subprompts] or [prompt]
+    return negative + positive
+
+# text encoder outputs are reused across frames, only the sub-prompt weights are recombined
+conditioning_cache = ConditioningCache()
+
+# samplers and noise schedules are built once and reused by every generate() call
+sampler_pool = SamplerPool()
+
 def get_learned_conditioning(model, weighted_subprompts, text, args, sign = 1):
     if len(weighted_subprompts) < 1:
         log_tokenization(text, model, args.log_weighted_subprompts, sign)
-        c = model.get_learned_conditioning(args.n_samples * [text])
-    else:
-        c = None
-        for subtext, subweight in weighted_subprompts:
-            log_tokenization(subtext, model, args.log_weighted_subprompts, sign * subweight)
-            if c is None:
-                c = model.get_learned_conditioning(args.n_samples * [subtext])
-                c *= subweight
-            else:
-                c.add_(model.get_learned_conditioning(args.n_samples * [subtext]), alpha=subweight)
-        
-    return c
+        return conditioning_cache.get(model, text, args.n_samples)
+
+    # the weights are combined on single rows, then broadcast to the batch
+    rows = conditioning_cache.get_many(model, [subtext for subtext, _ in weighted_subprompts])
+    c = None
+    for (subtext, subweight), row in zip(weighted_subprompts, rows):
+        log_tokenization(subtext, model, args.log_weighted_subprompts, sign * subweight)
+        if c is None:
+            c = row * subweight
+        else:
+            c.add_(row, alpha=subweight)
+    return c.expand(args.n_samples, -1, -1)
 
 def parse_weight(match, frame = 0)->float:
     import numexpr
@@ -728,16 +797,24 @@ def log_tokenization(text, model, log=False, weight=1):
             f">> Tokens Discarded ({totalTokens-usedTokens}):\n{discarded}\x1b[0m"
         )
 
-def generate(args, frame = 0, return_latent=False, return_sample=False, return_c=False):
+def generate(args, frame = 0, return_latent=False, return_sample=False, return_c=False, seeds=None):
+    # several independent frames can be diffused as one batch by passing a list of prompts in
+    # args.prompt (and optionally their stacked init samples in args.init_sample), their frame
+    # indices as frame and one seed per frame as seeds. Only the starting noise of each frame comes from its seed:
+    # init image encoding, ancestral samplers and ddim_eta > 0 draw from the shared random state,
+    # so batched frames only match frames rendered one at a time for txt2img frames with a
+    # non-ancestral sampler. Batched renders are still reproducible with the same batch_frames
     seed_everything(args.seed)
     os.makedirs(args.outdir, exist_ok=True)
+    # share of tokens merged for self attention on the UNet levels up to token_merging_max_downsample
+    set_token_merging(args.token_merging, args.token_merging_max_downsample)
 
-    sampler = PLMSSampler(model) if args.sampler == 'plms' else DDIMSampler(model)
-    model_wrap = CompVisDenoiser(model)
+    sampler = sampler_pool.get_sampler(model, args.sampler)
+    model_wrap = sampler_pool.get_model_wrap(model)
     batch_size = args.n_samples
     prompt = args.prompt
     assert prompt is not None
-    data = [batch_size * [prompt]]
+    data = [prompt if isinstance(prompt, list) else batch_size * [prompt]]
     precision_scope = autocast if args.precision == "autocast" else nullcontext
 
     init_latent = None
@@ -746,7 +823,7 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
     if args.init_latent is not None:
         init_latent = args.init_latent
     elif args.init_sample is not None:
-        with precision_scope("cuda"):
+        with precision_scope(device.type):
             init_latent = model.get_first_stage_encoding(model.encode_first_stage(args.init_sample))
     elif args.use_init and args.init_image != None and args.init_image != '':
         init_image, mask_image = load_img(args.init_image, 
@@ -754,7 +831,7 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
                                           use_alpha_as_mask=args.use_alpha_as_mask)
         init_image = init_image.to(device)
         init_image = repeat(init_image, '1 ... -> b ...', b=batch_size)
-        with precision_scope("cuda"):
+        with precision_scope(device.type):
             init_latent = model.get_first_stage_encoding(model.encode_first_stage(init_image))  # move to latent space        
 
     if not args.use_init and args.strength > 0 and args.strength_0_no_init:
@@ -786,6 +863,14 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
         
     t_enc = int((1.0-args.strength) * args.steps)
 
+    # starting noise for each frame of a batch, the same as a txt2img frame rendered on its own with its seed
+    noise = None
+    if seeds is not None and len(seeds) > 1:
+        noise = torch.cat([
+            torch.randn([1, args.C, args.H // args.f, args.W // args.f], device=device, generator=torch.Generator(device=device).manual_seed(seed))
+            for seed in seeds
+        ])
+
     # Noise schedule for the k-diffusion samplers (used for masking)
     k_sigmas = model_wrap.get_sigmas(args.steps)
     k_sigmas = k_sigmas[len(k_sigmas)-t_enc-1:]
@@ -793,6 +878,11 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
     if args.sampler in ['plms','ddim']:
         sampler.make_schedule(ddim_num_steps=args.steps, ddim_eta=args.ddim_eta, ddim_discretize='fill', verbose=False)
 
+    # guidance scale over the steps, late steps past cfg_cutoff skip the unconditional pass
+    guidance_schedule = GuidanceSchedule.from_args(args)
+    if guidance_schedule.constant:
+        guidance_schedule = None
+
     callback = SamplerCallback(args=args,
                             mask=mask, 
                             init_latent=init_latent,
@@ -802,16 +892,20 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
 
     results = []
     with torch.no_grad():
-        with precision_scope("cuda"):
-            with model.ema_scope():
+        with precision_scope(device.type):
+            # feature_cache_interval > 1 fully evaluates the UNet only every that many steps
+            with model.ema_scope(), feature_caching(model, args.feature_cache_interval, args.feature_cache_branch) as feature_cache:
                 for prompts in data:
+                    if feature_cache is not None:
+                        feature_cache.reset()
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
                     if args.prompt_weighting:
                         uc, c = get_uc_and_c(prompts, model, args, frame)
                     else:
-                        uc = model.get_learned_conditioning(batch_size * [""])
-                        c = model.get_learned_conditioning(prompts)
+                        conditioning_cache.get_many(model, [""] + prompts)
+                        uc = conditioning_cache.get(model, "", batch_size)
+                        c = conditioning_cache.get_batch(model, prompts)
 
 
                     if args.scale == 1.0:
@@ -828,11 +922,14 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
                             init_latent=init_latent, 
                             t_enc=t_enc, 
                             device=device, 
-                            cb=callback)
+                            cb=callback,
+                            noise=noise)
                     else:
                         # args.sampler == 'plms' or args.sampler == 'ddim':
                         if init_latent is not None and args.strength > 0:
-                            z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]*batch_size).to(device))
+                            z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]*batch_size).to(device), noise=noise)
+                        elif noise is not None:
+                            z_enc = noise
                         else:
                             z_enc = torch.randn([args.n_samples, args.C, args.H // args.f, args.W // args.f], device=device)
                         if args.sampler == 'ddim':
@@ -841,7 +938,8 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
                                                      t_enc, 
                                                      unconditional_guidance_scale=args.scale,
                                                      unconditional_conditioning=uc,
-                                                     img_callback=callback)
+                                                     img_callback=callback,
+                                                     guidance_schedule=guidance_schedule)
                         elif args.sampler == 'plms': # no "decode" function in plms, so use "sample"
                             shape = [args.C, args.H // args.f, args.W // args.f]
                             samples, _ = sampler.sample(S=args.steps,
@@ -853,7 +951,8 @@ def generate(args, frame = 0, return_latent=False, return_sample=False, return_c
                                                             unconditional_conditioning=uc,
                                                             eta=args.ddim_eta,
                                                             x_T=z_enc,
-                                                            img_callback=callback)
+                                                            img_callback=callback,
+                                                            guidance_schedule=guidance_schedule)
                         else:
                             raise Exception(f"Sampler {args.sampler} not recognised.")
 
@@ -916,7 +1015,11 @@ custom_checkpoint_path = "" #@param {type:"string"}
 
 load_on_run_all = True #@param {type: 'boolean'}
 half_precision = True # check
+attention_backend = "auto" #@param ["auto","sliced","sdpa","chunked"]
+device_type = "auto" #@param ["auto","cuda","cpu"]
+cpu_threads = 0 #@param {type:"number"}
 check_sha256 = True #@param {type:"boolean"}
+models_mirror_path = "" #@param {type:"string"}
 
 model_map = {
     "sd-v1-4-full-ema.ckpt": {
@@ -987,46 +1090,33 @@ if os.path.exists(ckpt_path):
 elif 'url' in model_map[model_checkpoint]:
     url = model_map[model_checkpoint]['url']
 
-    # CLI dialogue to authenticate download
-    if model_map[model_checkpoint]['requires_login']:
+    # CLI dialogue to authenticate download, not needed for a copy from the mirror
+    auth = None
+    mirrored = models_mirror_path and os.path.exists(os.path.join(models_mirror_path, model_checkpoint))
+    if model_map[model_checkpoint]['requires_login'] and not mirrored:
         print("This model requires an authentication token")
         print("Please ensure you have accepted its terms of service before continuing.")
 
         username = input("What is your huggingface username?:")
         token = input("What is your huggingface token?:")
 
-        _, path = url.split("https://")
+        # sent in an Authorization header, a token in the url would show up in error messages
+        auth = (username, token)
 
-        url = f"https://{username}:{token}@{path}"
-
-    # contact server for model
+    # streamed to disk and hashed while downloading, an interrupted download resumes
     print(f"Attempting to download {model_checkpoint}...this may take a while")
-    ckpt_request = requests.get(url)
-    request_status = ckpt_request.status_code
-
-    # inform user of errors
-    if request_status == 403:
-      raise ConnectionRefusedError("You have not accepted the license for this model.")
-    elif request_status == 404:
-      raise ConnectionError("Could not make contact with server")
-    elif request_status != 200:
-      raise ConnectionError(f"Some other error has ocurred - response code: {request_status}")
-
-    # write to model path
-    with open(os.path.join(models_path, model_checkpoint), 'wb') as model_file:
-        model_file.write(ckpt_request.content)
+    fetch(url, ckpt_path, sha256=model_map[model_checkpoint]['sha256'] if check_sha256 else None, mirror=models_mirror_path or None, auth=auth)
 else:
     print(f"Please download model checkpoint and place in {os.path.join(models_path, model_checkpoint)}")
     ckpt_valid = False
 
+ckpt_sha256 = None
 if check_sha256 and model_checkpoint != "custom" and ckpt_valid:
-    import hashlib
     print("\n...checking sha256")
-    with open(ckpt_path, "rb") as f:
-        bytes = f.read() 
-        hash = hashlib.sha256(bytes).hexdigest()
-        del bytes
+    # hashed once, later runs use the recorded hash of the unchanged file
+    hash = checkpoint_sha256(ckpt_path)
     if model_map[model_checkpoint]["sha256"] == hash:
+        ckpt_sha256 = hash
         print("hash is correct\n")
     else:
         print("hash in not correct\n")
@@ -1035,15 +1125,18 @@ if check_sha256 and model_checkpoint != "custom" and ckpt_valid:
 if ckpt_valid:
     print(f"Using ckpt: {ckpt_path}")
 
-def load_model_from_config(config, ckpt, verbose=False, device='cuda', half_precision=True):
-    map_location = "cuda" #@param ["cpu", "cuda"]
+def load_model_from_config(config, ckpt, verbose=False, device='cuda', half_precision=True, sha256=None):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location=map_location)
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    # memory mapped from a float16 sidecar of the checkpoint, written on the first load
+    sd, metadata = load_checkpoint(ckpt, half_precision=half_precision, sha256=sha256)
+    if "global_step" in metadata:
+        print(f"Global Step: {metadata['global_step']}")
+    # built without random init, the parameters are then the checkpoint tensors moved to the
+    # device in float16 on cuda and bfloat16 on the cpu, without a float32 copy in memory
+    with no_init_weights():
+        model = instantiate_from_config(config.model)
+    m, u = load_weights(model, sd, device, get_dtype(device, half_precision))
+    del sd
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -1051,18 +1144,20 @@ def load_model_from_config(config, ckpt, verbose=False, device='cuda', half_prec
         print("unexpected keys:")
         print(u)
 
-    if half_precision:
-        model = model.half().to(device)
-    else:
-        model = model.to(device)
     model.eval()
     return model
 
+# the cpu runs the whole pipeline in float32 or bfloat16 on all cores
+device = get_device(device_type)
+model_dtype = get_dtype(device, half_precision)
+if device.type == 'cpu':
+    set_cpu_threads(cpu_threads)
+print(f"Using {describe(device)}")
+
 if load_on_run_all and ckpt_valid:
+    print(f"Using {set_attention_backend(attention_backend)} attention")
     local_config = OmegaConf.load(f"{ckpt_config_path}")
-    model = load_model_from_config(local_config, f"{ckpt_path}", half_precision=half_precision)
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = model.to(device)
+    model = load_model_from_config(local_config, f"{ckpt_path}", device=device, half_precision=half_precision, sha256=ckpt_sha256)
 
 # %%
 # !! {"metadata":{
@@ -1110,6 +1205,7 @@ def DeforumAnimArgs():
     noise_schedule = "0: (0.02)"#@param {type:"string"}
     strength_schedule = "0: (0.65)"#@param {type:"string"}
     contrast_schedule = "0: (1.0)"#@param {type:"string"}
+    cfg_cutoff_schedule = ""#@param {type:"string"}
 
     #@markdown ####**Coherence:**
     color_coherence = 'Match Frame 0 LAB' #@param ['None', 'Match Frame 0 HSV', 'Match Frame 0 LAB', 'Match Frame 0 RGB'] {type:'string'}
@@ -1117,6 +1213,8 @@ def DeforumAnimArgs():
 
     #@markdown ####**3D Depth Warping:**
     use_depth_warping = True #@param {type:"boolean"}
+    depth_backend = 'dpt_large' #@param ['dpt_large', 'dpt_hybrid', 'midas_small', 'adabins', 'constant'] {type:'string'}
+    depth_resolution = 0 #@param {type:"number"}
     midas_weight = 0.3#@param {type:"number"}
     near_plane = 200
     far_plane = 10000
@@ -1124,11 +1222,11 @@ def DeforumAnimArgs():
     padding_mode = 'border'#@param ['border', 'reflection', 'zeros'] {type:'string'}
     sampling_mode = 'bicubic'#@param ['bicubic', 'bilinear', 'nearest'] {type:'string'}
     save_depth_maps = False #@param {type:"boolean"}
+    depth_reestimate_interval = 0 #@param {type:"number"}
 
     #@markdown ####**Video Input:**
     video_init_path ='/content/video_in.mp4'#@param {type:"string"}
     extract_nth_frame = 1#@param {type:"number"}
-    overwrite_extracted_frames = True #@param {type:"boolean"}
     use_mask_video = False #@param {type:"boolean"}
     video_mask_path ='/content/video_in.mp4'#@param {type:"string"}
 
@@ -1139,74 +1237,51 @@ def DeforumAnimArgs():
     #@markdown ####**Resume Animation:**
     resume_from_timestring = False #@param {type:"boolean"}
     resume_timestring = "20220829210106" #@param {type:"string"}
+    journal_interval = 10 #@param {type:"number"}
+
+    #@markdown ####**Video Output:**
+    stream_video = False #@param {type:"boolean"}
+    stream_fps = 12 #@param {type:"number"}
+    save_frames = True #@param {type:"boolean"}
+
+    #@markdown ####**Performance:**
+    writer_threads = 2 #@param {type:"number"}
+    # batched video input frames differ from the same frames rendered one at a time
+    batch_frames = 1 #@param {type:"number"}
+    latent_warping = False #@param {type:"boolean"}
 
     return locals()
 
 class DeformAnimKeys():
+    # schedules are compiled the first time they are read, so e.g. the 3D ones are never built in 2D mode
+    schedules = {
+        'angle_series': 'angle',
+        'zoom_series': 'zoom',
+        'translation_x_series': 'translation_x',
+        'translation_y_series': 'translation_y',
+        'translation_z_series': 'translation_z',
+        'rotation_3d_x_series': 'rotation_3d_x',
+        'rotation_3d_y_series': 'rotation_3d_y',
+        'rotation_3d_z_series': 'rotation_3d_z',
+        'perspective_flip_theta_series': 'perspective_flip_theta',
+        'perspective_flip_phi_series': 'perspective_flip_phi',
+        'perspective_flip_gamma_series': 'perspective_flip_gamma',
+        'perspective_flip_fv_series': 'perspective_flip_fv',
+        'noise_schedule_series': 'noise_schedule',
+        'strength_schedule_series': 'strength_schedule',
+        'contrast_schedule_series': 'contrast_schedule',
+        'cfg_cutoff_schedule_series': 'cfg_cutoff_schedule',
+    }
+
     def __init__(self, anim_args):
-        self.angle_series = get_inbetweens(parse_key_frames(anim_args.angle), anim_args.max_frames)
-        self.zoom_series = get_inbetweens(parse_key_frames(anim_args.zoom), anim_args.max_frames)
-        self.translation_x_series = get_inbetweens(parse_key_frames(anim_args.translation_x), anim_args.max_frames)
-        self.translation_y_series = get_inbetweens(parse_key_frames(anim_args.translation_y), anim_args.max_frames)
-        self.translation_z_series = get_inbetweens(parse_key_frames(anim_args.translation_z), anim_args.max_frames)
-        self.rotation_3d_x_series = get_inbetweens(parse_key_frames(anim_args.rotation_3d_x), anim_args.max_frames)
-        self.rotation_3d_y_series = get_inbetweens(parse_key_frames(anim_args.rotation_3d_y), anim_args.max_frames)
-        self.rotation_3d_z_series = get_inbetweens(parse_key_frames(anim_args.rotation_3d_z), anim_args.max_frames)
-        self.perspective_flip_theta_series = get_inbetweens(parse_key_frames(anim_args.perspective_flip_theta), anim_args.max_frames)
-        self.perspective_flip_phi_series = get_inbetweens(parse_key_frames(anim_args.perspective_flip_phi), anim_args.max_frames)
-        self.perspective_flip_gamma_series = get_inbetweens(parse_key_frames(anim_args.perspective_flip_gamma), anim_args.max_frames)
-        self.perspective_flip_fv_series = get_inbetweens(parse_key_frames(anim_args.perspective_flip_fv), anim_args.max_frames)
-        self.noise_schedule_series = get_inbetweens(parse_key_frames(anim_args.noise_schedule), anim_args.max_frames)
-        self.strength_schedule_series = get_inbetweens(parse_key_frames(anim_args.strength_schedule), anim_args.max_frames)
-        self.contrast_schedule_series = get_inbetweens(parse_key_frames(anim_args.contrast_schedule), anim_args.max_frames)
-
-
-def get_inbetweens(key_frames, max_frames, integer=False, interp_method='Linear'):
-    import numexpr
-    key_frame_series = pd.Series([np.nan for a in range(max_frames)])
-    
-    for i in range(0, max_frames):
-        if i in key_frames:
-            value = key_frames[i]
-            value_is_number = check_is_number(value)
-            # if it's only a number, leave the rest for the default interpolation
-            if value_is_number:
-                t = i
-                key_frame_series[i] = value
-        if not value_is_number:
-            t = i
-            key_frame_series[i] = numexpr.evaluate(value)
-    key_frame_series = key_frame_series.astype(float)
-    
-    if interp_method == 'Cubic' and len(key_frames.items()) <= 3:
-      interp_method = 'Quadratic'    
-    if interp_method == 'Quadratic' and len(key_frames.items()) <= 2:
-      interp_method = 'Linear'
-          
-    key_frame_series[0] = key_frame_series[key_frame_series.first_valid_index()]
-    key_frame_series[max_frames-1] = key_frame_series[key_frame_series.last_valid_index()]
-    key_frame_series = key_frame_series.interpolate(method=interp_method.lower(), limit_direction='both')
-    if integer:
-        return key_frame_series.astype(int)
-    return key_frame_series
-
-def parse_key_frames(string, prompt_parser=None):
-    # because math functions (i.e. sin(t)) can utilize brackets 
-    # it extracts the value in form of some stuff
-    # which has previously been enclosed with brackets and
-    # with a comma or end of line existing after the closing one
-    pattern = r'((?P<frame>[0-9]+):[\s]*\((?P<param>[\S\s]*?)\)([,][\s]?|[\s]?$))'
-    frames = dict()
-    for match_object in re.finditer(pattern, string):
-        frame = int(match_object.groupdict()['frame'])
-        param = match_object.groupdict()['param']
-        if prompt_parser:
-            frames[frame] = prompt_parser(param)
-        else:
-            frames[frame] = param
-    if frames == {} and len(string) != 0:
-        raise RuntimeError('Key Frame string not correctly formatted')
-    return frames
+        self.anim_args = anim_args
+
+    def __getattr__(self, name):
+        if name not in DeformAnimKeys.schedules:
+            raise AttributeError(name)
+        series = get_inbetweens(parse_key_frames(getattr(self.anim_args, DeformAnimKeys.schedules[name])), self.anim_args.max_frames)
+        setattr(self, name, series)
+        return series
 
 # %%
 # !! {"metadata":{
@@ -1255,6 +1330,10 @@ animation_prompts = {
 override_settings_with_file = False #@param {type:"boolean"}
 custom_settings_file = "/content/drive/MyDrive/Settings.txt"#@param {type:"string"}
 
+#@markdown **Render Server**
+serve_render_jobs = False #@param {type:"boolean"}
+render_server_address = "127.0.0.1:7860" #@param {type:"string"}
+
 def DeforumArgs():
     #@markdown **Image Settings**
     W = 512 #@param
@@ -1266,7 +1345,13 @@ def DeforumArgs():
     sampler = 'klms' #@param ["klms","dpm2","dpm2_ancestral","heun","euler","euler_ancestral","plms", "ddim"]
     steps = 50 #@param
     scale = 7 #@param
+    scale_end = 0 #@param {type:"number"}
+    cfg_cutoff = 1.0 #@param {type:"number"}
     ddim_eta = 0.0 #@param
+    token_merging = 0.0 #@param {type:"number"}
+    token_merging_max_downsample = 1 #@param [1,2,4,8]
+    feature_cache_interval = 1 #@param {type:"number"}
+    feature_cache_branch = 0 #@param {type:"number"}
     dynamic_threshold = None
     static_threshold = None   
 
@@ -1333,7 +1418,16 @@ def next_seed(args):
         args.seed = random.randint(0, 2**32 - 1)
     return args.seed
 
-def render_image_batch(args):
+def next_seeds(args, n):
+    # seeds for n consecutive frames rendered as one batch, args.seed is left at the last one
+    seeds = [args.seed]
+    for _ in range(n-1):
+        seeds.append(next_seed(args))
+    return seeds
+
+def render_image_batch(args, prompts, on_saved=None):
+    # on_saved is called with the path of every saved frame, the render server uses it to stream
+    # frames and cancel jobs
     args.prompts = {k: f"{v:05d}" for v, k in enumerate(prompts)}
     
     # create output folder for the batch
@@ -1370,60 +1464,89 @@ def render_image_batch(args):
     # when doing large batches don't flood browser with images
     clear_between_batches = args.n_batch >= 32
 
-    for iprompt, prompt in enumerate(prompts):  
-        args.prompt = prompt
-        print(f"Prompt {iprompt+1} of {len(prompts)}")
-        print(f"{args.prompt}")
+    writer = FrameWriter(on_saved=on_saved)
 
-        all_images = []
+    with writer:
+        for iprompt, prompt in enumerate(prompts):  
+            args.prompt = prompt
+            print(f"Prompt {iprompt+1} of {len(prompts)}")
+            print(f"{args.prompt}")
 
-        for batch_index in range(args.n_batch):
-            if clear_between_batches and batch_index % 32 == 0: 
-                display.clear_output(wait=True)            
-            print(f"Batch {batch_index+1} of {args.n_batch}")
-            
-            for image in init_array: # iterates the init images
-                args.init_image = image
-                results = generate(args)
-                for image in results:
-                    if args.make_grid:
-                        all_images.append(T.functional.pil_to_tensor(image))
-                    if args.save_samples:
-                        if args.filename_format == "{timestring}_{index}_{prompt}.png":
-                            filename = f"{args.timestring}_{index:05}_{sanitize(prompt)[:160]}.png"
-                        else:
-                            filename = f"{args.timestring}_{index:05}_{args.seed}.png"
-                        image.save(os.path.join(args.outdir, filename))
-                    if args.display_samples:
-                        display.display(image)
-                    index += 1
-                args.seed = next_seed(args)
-
-        #print(len(all_images))
-        if args.make_grid:
-            grid = make_grid(all_images, nrow=int(len(all_images)/args.grid_rows))
-            grid = rearrange(grid, 'c h w -> h w c').cpu().numpy()
-            filename = f"{args.timestring}_{iprompt:05d}_grid_{args.seed}.png"
-            grid_image = Image.fromarray(grid.astype(np.uint8))
-            grid_image.save(os.path.join(args.outdir, filename))
-            display.clear_output(wait=True)            
-            display.display(grid_image)
+            all_images = []
 
+            for batch_index in range(args.n_batch):
+                if clear_between_batches and batch_index % 32 == 0: 
+                    display.clear_output(wait=True)            
+                print(f"Batch {batch_index+1} of {args.n_batch}")
+            
+                for image in init_array: # iterates the init images
+                    args.init_image = image
+                    results = generate(args)
+                    for image in results:
+                        if args.make_grid:
+                            all_images.append(T.functional.pil_to_tensor(image))
+                        if args.save_samples:
+                            if args.filename_format == "{timestring}_{index}_{prompt}.png":
+                                filename = f"{args.timestring}_{index:05}_{sanitize(prompt)[:160]}.png"
+                            else:
+                                filename = f"{args.timestring}_{index:05}_{args.seed}.png"
+                            writer.save_image(image, os.path.join(args.outdir, filename))
+                        if args.display_samples:
+                            display.display(image)
+                        index += 1
+                    args.seed = next_seed(args)
+
+            #print(len(all_images))
+            if args.make_grid:
+                grid = make_grid(all_images, nrow=int(len(all_images)/args.grid_rows))
+                grid = rearrange(grid, 'c h w -> h w c').cpu().numpy()
+                filename = f"{args.timestring}_{iprompt:05d}_grid_{args.seed}.png"
+                grid_image = Image.fromarray(grid.astype(np.uint8))
+                grid_image.save(os.path.join(args.outdir, filename))
+                display.clear_output(wait=True)            
+                display.display(grid_image)
+
+# depth models stay loaded between renders
+loaded_depth_model = globals().get('loaded_depth_model')
+
+def load_depth_model(anim_args):
+    global loaded_depth_model
+    if loaded_depth_model is None or loaded_depth_model.backend != anim_args.depth_backend:
+        loaded_depth_model = None
+        empty_cache(device)
+        loaded_depth_model = DepthModel(device, anim_args.depth_backend, mirror=models_mirror_path or None)
+        loaded_depth_model.load(models_path, half_precision)
+    loaded_depth_model.resolution = int(anim_args.depth_resolution)
+    if loaded_depth_model.midas_model is not None and anim_args.midas_weight < 1.0 and loaded_depth_model.adabins_helper is None:
+        loaded_depth_model.load_adabins()
+    return loaded_depth_model
+
+def make_frame_writer(args, anim_args, resuming=False, journal=None, on_saved=None):
+    # with stream_video the frames are piped into {timestring}.mp4 as they are rendered,
+    # the PNGs are only written when save_frames is set
+    if journal is not None:
+        def on_saved(path, notify=on_saved):
+            journal.frame_saved(path)
+            if notify is not None:
+                notify(path)
+    encoder = None
+    if anim_args.stream_video:
+        if resuming:
+            print("Can't stream a resumed animation to video, make the video from the saved frames instead")
+        else:
+            mp4_path = os.path.join(args.outdir, f"{args.timestring}.mp4")
+            print(f"Streaming video to {mp4_path}")
+            encoder = VideoEncoder(mp4_path, anim_args.stream_fps)
+    return FrameWriter(anim_args.writer_threads, on_saved=on_saved, encoder=encoder, save_frames=anim_args.save_frames)
 
-def render_animation(args, anim_args):
+def render_animation(args, anim_args, animation_prompts, video_source=None, mask_source=None, on_saved=None):
     # animations use key framed prompts
     args.prompts = animation_prompts
 
     # expand key frame strings to values
     keys = DeformAnimKeys(anim_args)
-
-    # resume animation
-    start_frame = 0
-    if anim_args.resume_from_timestring:
-        for tmp in os.listdir(args.outdir):
-            if tmp.split("_")[0] == anim_args.resume_timestring:
-                start_frame += 1
-        start_frame = start_frame - 1
+    # an empty cfg_cutoff_schedule keeps args.cfg_cutoff for every frame
+    cfg_cutoff_series = keys.cfg_cutoff_schedule_series if anim_args.cfg_cutoff_schedule else None
 
     # create output folder for the batch
     os.makedirs(args.outdir, exist_ok=True)
@@ -1439,11 +1562,12 @@ def render_animation(args, anim_args):
     if anim_args.resume_from_timestring:
         args.timestring = anim_args.resume_timestring
 
+    # completed frames and snapshots of the render state go to {timestring}_journal.jsonl
+    journal = RenderJournal(args.outdir, args.timestring, anim_args.journal_interval)
+    resume_state = journal.resume(device) if anim_args.resume_from_timestring else None
+
     # expand prompts out to per-frame
-    prompt_series = pd.Series([np.nan for a in range(anim_args.max_frames)])
-    for i, prompt in animation_prompts.items():
-        prompt_series[i] = prompt
-    prompt_series = prompt_series.ffill().bfill()
+    prompt_series = get_prompt_series(animation_prompts, anim_args.max_frames)
 
     # check for video inits
     using_vid_init = anim_args.animation_mode == 'Video Input'
@@ -1451,10 +1575,7 @@ def render_animation(args, anim_args):
     # load depth model for 3D
     predict_depths = (anim_args.animation_mode == '3D' and anim_args.use_depth_warping) or anim_args.save_depth_maps
     if predict_depths:
-        depth_model = DepthModel(device)
-        depth_model.load_midas(models_path)
-        if anim_args.midas_weight < 1.0:
-            depth_model.load_adabins()
+        depth_model = load_depth_model(anim_args)
     else:
         depth_model = None
         anim_args.save_depth_maps = False
@@ -1464,10 +1585,32 @@ def render_animation(args, anim_args):
     turbo_prev_image, turbo_prev_frame_idx = None, 0
     turbo_next_image, turbo_next_frame_idx = None, 0
 
+    # 2D/3D frames without cadence can be warped in latent space, skipping the VAE round trip
+    latent_warping = anim_args.latent_warping and turbo_steps == 1 and not using_vid_init
+
     # resume animation
+    start_frame = 0
     prev_sample = None
-    color_match_sample = None
-    if anim_args.resume_from_timestring:
+    prev_latent, prev_image = None, None
+    color_matcher, color_match_latent = None, None
+    if resume_state is not None:
+        # exactly the state the last run had at its last snapshot
+        start_frame = resume_state['frame_idx']
+        prev_sample, prev_latent, prev_image = resume_state['prev_sample'], resume_state['prev_latent'], resume_state['prev_image']
+        color_matcher, color_match_latent = resume_state['color_matcher'], resume_state['color_match_latent']
+        turbo_prev_image, turbo_prev_frame_idx = resume_state['turbo_prev_image'], resume_state['turbo_prev_frame_idx']
+        turbo_next_image, turbo_next_frame_idx = resume_state['turbo_next_image'], resume_state['turbo_next_frame_idx']
+        args.seed = resume_state['seed']
+        print(f"Resuming from the snapshot at frame {start_frame}")
+    elif anim_args.resume_from_timestring:
+        # runs without a usable snapshot continue after the frames their journal has on disk,
+        # runs without a journal from the last frame in the output folder
+        start_frame = journal.frames_on_disk()
+        if start_frame == 0:
+            for tmp in os.listdir(args.outdir):
+                if re.fullmatch(rf"{re.escape(anim_args.resume_timestring)}_\d{{5}}\.png", tmp):
+                    start_frame += 1
+            start_frame = start_frame - 1
         last_frame = start_frame-1
         if turbo_steps > 1:
             last_frame -= last_frame%turbo_steps
@@ -1476,179 +1619,243 @@ def render_animation(args, anim_args):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         prev_sample = sample_from_cv2(img)
         if anim_args.color_coherence != 'None':
-            color_match_sample = img
+            color_matcher = ColorMatcher(img, anim_args.color_coherence, device)
         if turbo_steps > 1:
-            turbo_next_image, turbo_next_frame_idx = sample_to_cv2(prev_sample, type=np.float32), last_frame
+            turbo_next_image, turbo_next_frame_idx = sample_to_turbo_frame(prev_sample, anim_args), last_frame
             turbo_prev_image, turbo_prev_frame_idx = turbo_next_image, turbo_next_frame_idx
             start_frame = last_frame+turbo_steps
 
+    # frames are encoded and saved in the background while the next frame is diffused
+    writer = make_frame_writer(args, anim_args, resuming=anim_args.resume_from_timestring, journal=journal, on_saved=on_saved)
+
+    # video input frames don't depend on the previous output, so several of them can share a batch
+    batch_frames = 1
+    if using_vid_init and prev_sample is None and not anim_args.use_mask_video and not args.use_alpha_as_mask:
+        batch_frames = max(1, int(anim_args.batch_frames))
+
     args.n_samples = 1
     frame_idx = start_frame
-    while frame_idx < anim_args.max_frames:
-        print(f"Rendering animation frame {frame_idx} of {anim_args.max_frames}")
-        noise = keys.noise_schedule_series[frame_idx]
-        strength = keys.strength_schedule_series[frame_idx]
-        contrast = keys.contrast_schedule_series[frame_idx]
-        depth = None
-        
-        # emit in-between frames
-        if turbo_steps > 1:
-            tween_frame_start_idx = max(0, frame_idx-turbo_steps)
-            for tween_frame_idx in range(tween_frame_start_idx, frame_idx):
-                tween = float(tween_frame_idx - tween_frame_start_idx + 1) / float(frame_idx - tween_frame_start_idx)
-                print(f"  creating in between frame {tween_frame_idx} tween:{tween:0.2f}")
-
-                advance_prev = turbo_prev_image is not None and tween_frame_idx > turbo_prev_frame_idx
-                advance_next = tween_frame_idx > turbo_next_frame_idx
+    with journal, writer:
+        while frame_idx < anim_args.max_frames:
+            if journal.due(frame_idx):
+                # a snapshot may only skip frames that are on disk, with cadence the in-between
+                # frames before frame_idx are written by this iteration
+                writer.wait()
+                journal.snapshot(frame_idx, {
+                    'prev_sample': prev_sample, 'prev_latent': prev_latent, 'prev_image': prev_image,
+                    'color_matcher': color_matcher, 'color_match_latent': color_match_latent,
+                    'turbo_prev_image': turbo_prev_image, 'turbo_prev_frame_idx': turbo_prev_frame_idx,
+                    'turbo_next_image': turbo_next_image, 'turbo_next_frame_idx': turbo_next_frame_idx,
+                    'seed': args.seed,
+                }, saved=max(0, frame_idx-turbo_steps) if turbo_steps > 1 else frame_idx)
+
+            if batch_frames > 1:
+                batch_end = min(frame_idx+batch_frames, anim_args.max_frames)
+                if cfg_cutoff_series is not None:
+                    # the frames of a batch share one guidance schedule, so a batch ends where the cutoff changes
+                    batch_end = next((i for i in range(frame_idx, batch_end) if cfg_cutoff_series[i] != cfg_cutoff_series[frame_idx]), batch_end)
+                    args.cfg_cutoff = cfg_cutoff_series[frame_idx]
+                batch = list(range(frame_idx, batch_end))
+                print(f"Rendering animation frames {batch[0]}-{batch[-1]} of {anim_args.max_frames}")
+                args.n_samples = len(batch)
+                args.prompt = [prompt_series[i] for i in batch]
+                args.init_sample = torch.cat([sample_from_cv2(video_source[i]) for i in batch]).to(device, dtype=model_dtype)
+                seeds = next_seeds(args, len(batch))
+                for i, prompt, seed in zip(batch, args.prompt, seeds):
+                    print(f"{i}: {prompt} {seed}")
+
+                results = generate(args, batch, return_sample=True, seeds=seeds)
+                samples, images = results[0], results[1:]
+                if anim_args.save_depth_maps:
+                    depths = depth_model.predict_many([sample_to_cv2(samples[j:j+1]) for j in range(len(batch))], anim_args)
+                for j, (i, image) in enumerate(zip(batch, images)):
+                    filename = f"{args.timestring}_{i:05}.png"
+                    writer.save_image(image, os.path.join(args.outdir, filename))
+                    if anim_args.save_depth_maps:
+                        depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{i:05}.png"), depths[j])
 
-                if depth_model is not None:
-                    assert(turbo_next_image is not None)
-                    depth = depth_model.predict(turbo_next_image, anim_args)
+                display.clear_output(wait=True)
+                display.display(images[-1])
 
+                args.seed = next_seed(args)
+                frame_idx += len(batch)
+                continue
+
+            print(f"Rendering animation frame {frame_idx} of {anim_args.max_frames}")
+            noise = keys.noise_schedule_series[frame_idx]
+            strength = keys.strength_schedule_series[frame_idx]
+            contrast = keys.contrast_schedule_series[frame_idx]
+            if cfg_cutoff_series is not None:
+                args.cfg_cutoff = cfg_cutoff_series[frame_idx]
+            depth = None
+        
+            # emit in-between frames
+            if turbo_steps > 1:
+                # depth is predicted once for the last diffused frame and then warped along with it,
+                # depth_reestimate_interval > 0 predicts it again every that many in-between frames
+                depth_age = 0
+                tween_frame_start_idx = max(0, frame_idx-turbo_steps)
+                for tween_frame_idx in range(tween_frame_start_idx, frame_idx):
+                    tween = float(tween_frame_idx - tween_frame_start_idx + 1) / float(frame_idx - tween_frame_start_idx)
+                    print(f"  creating in between frame {tween_frame_idx} tween:{tween:0.2f}")
+
+                    advance_prev = turbo_prev_image is not None and tween_frame_idx > turbo_prev_frame_idx
+                    advance_next = tween_frame_idx > turbo_next_frame_idx
+
+                    if depth_model is not None:
+                        assert(turbo_next_image is not None)
+                        # in 2D the depth is only saved and isn't warped, so it is predicted for every frame
+                        if depth is None or anim_args.animation_mode == '2D' or (anim_args.depth_reestimate_interval > 0 and depth_age >= anim_args.depth_reestimate_interval):
+                            depth = depth_model.predict(turbo_next_image, anim_args)
+                            depth_age = 0
+
+                    if anim_args.animation_mode == '2D':
+                        if advance_prev:
+                            turbo_prev_image = anim_frame_warp_2d(turbo_prev_image, args, anim_args, keys, tween_frame_idx)
+                        if advance_next:
+                            turbo_next_image = anim_frame_warp_2d(turbo_next_image, args, anim_args, keys, tween_frame_idx)
+                    else: # '3D'
+                        if advance_prev and advance_next:
+                            turbo_prev_image, turbo_next_image = anim_frame_warp_3d([turbo_prev_image, turbo_next_image], depth, anim_args, keys, tween_frame_idx)
+                        elif advance_prev:
+                            turbo_prev_image = anim_frame_warp_3d(turbo_prev_image, depth, anim_args, keys, tween_frame_idx)
+                        elif advance_next:
+                            turbo_next_image = anim_frame_warp_3d(turbo_next_image, depth, anim_args, keys, tween_frame_idx)
+                        if advance_next and depth is not None:
+                            depth = anim_depth_warp_3d(depth, anim_args, keys, tween_frame_idx)
+                            depth_age += 1
+                    turbo_prev_frame_idx = turbo_next_frame_idx = tween_frame_idx
+
+                    filename = f"{args.timestring}_{tween_frame_idx:05}.png"
+                    writer.save_tween(frame_to_cv2(turbo_prev_image), frame_to_cv2(turbo_next_image), tween, os.path.join(args.outdir, filename))
+                    if anim_args.save_depth_maps:
+                        depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{tween_frame_idx:05}.png"), depth)
+                if turbo_next_image is not None:
+                    prev_sample = sample_from_cv2(frame_to_cv2(turbo_next_image))
+
+            # apply transforms to previous latent
+            if prev_latent is not None:
                 if anim_args.animation_mode == '2D':
-                    if advance_prev:
-                        turbo_prev_image = anim_frame_warp_2d(turbo_prev_image, args, anim_args, keys, tween_frame_idx)
-                    if advance_next:
-                        turbo_next_image = anim_frame_warp_2d(turbo_next_image, args, anim_args, keys, tween_frame_idx)
+                    latent = anim_latent_warp_2d(prev_latent, args, anim_args, keys, frame_idx)
                 else: # '3D'
-                    if advance_prev:
-                        turbo_prev_image = anim_frame_warp_3d(turbo_prev_image, depth, anim_args, keys, tween_frame_idx)
-                    if advance_next:
-                        turbo_next_image = anim_frame_warp_3d(turbo_next_image, depth, anim_args, keys, tween_frame_idx)
-                turbo_prev_frame_idx = turbo_next_frame_idx = tween_frame_idx
-
-                if turbo_prev_image is not None and tween < 1.0:
-                    img = turbo_prev_image*(1.0-tween) + turbo_next_image*tween
-                else:
-                    img = turbo_next_image
+                    depth = depth_model.predict(prev_image, anim_args) if depth_model else None
+                    latent = anim_latent_warp_3d(prev_latent, depth, anim_args, keys, frame_idx)
 
-                filename = f"{args.timestring}_{tween_frame_idx:05}.png"
-                cv2.imwrite(os.path.join(args.outdir, filename), cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR))
-                if anim_args.save_depth_maps:
-                    depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{tween_frame_idx:05}.png"), depth)
-            if turbo_next_image is not None:
-                prev_sample = sample_from_cv2(turbo_next_image)
-
-        # apply transforms to previous frame
-        if prev_sample is not None:
-            if anim_args.animation_mode == '2D':
-                prev_img = anim_frame_warp_2d(sample_to_cv2(prev_sample), args, anim_args, keys, frame_idx)
-            else: # '3D'
-                prev_img_cv2 = sample_to_cv2(prev_sample)
-                depth = depth_model.predict(prev_img_cv2, anim_args) if depth_model else None
-                prev_img = anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx)
-
-            # apply color matching
-            if anim_args.color_coherence != 'None':
-                if color_match_sample is None:
-                    color_match_sample = prev_img.copy()
-                else:
-                    prev_img = maintain_colors(prev_img, color_match_sample, anim_args.color_coherence)
+                # apply color matching
+                if anim_args.color_coherence != 'None':
+                    if color_match_latent is None:
+                        color_match_latent = latent.clone()
+                    else:
+                        latent = match_latent_colors(latent, color_match_latent)
 
-            # apply scaling
-            contrast_sample = prev_img * contrast
-            # apply frame noising
-            noised_sample = add_noise(sample_from_cv2(contrast_sample), noise)
+                # apply scaling and frame noising
+                latent = add_noise(contrast_latent(latent, contrast), noise)
 
-            # use transformed previous frame as init for current
-            args.use_init = True
-            if half_precision:
-                args.init_sample = noised_sample.half().to(device)
-            else:
-                args.init_sample = noised_sample.to(device)
-            args.strength = max(0.0, min(1.0, strength))
-
-        # grab prompt for current frame
-        args.prompt = prompt_series[frame_idx]
-        print(f"{args.prompt} {args.seed}")
-        if not using_vid_init:
-            print(f"Angle: {keys.angle_series[frame_idx]} Zoom: {keys.zoom_series[frame_idx]}")
-            print(f"Tx: {keys.translation_x_series[frame_idx]} Ty: {keys.translation_y_series[frame_idx]} Tz: {keys.translation_z_series[frame_idx]}")
-            print(f"Rx: {keys.rotation_3d_x_series[frame_idx]} Ry: {keys.rotation_3d_y_series[frame_idx]} Rz: {keys.rotation_3d_z_series[frame_idx]}")
-
-        # grab init image for current frame
-        if using_vid_init:
-            init_frame = os.path.join(args.outdir, 'inputframes', f"{frame_idx+1:05}.jpg")            
-            print(f"Using video init frame {init_frame}")
-            args.init_image = init_frame
-            if anim_args.use_mask_video:
-                mask_frame = os.path.join(args.outdir, 'maskframes', f"{frame_idx+1:05}.jpg")
-                args.mask_file = mask_frame
+                # use warped previous latent as init for current
+                args.use_init = True
+                args.init_sample = None
+                args.init_latent = latent
+                args.strength = max(0.0, min(1.0, strength))
 
-        # sample the diffusion model
-        sample, image = generate(args, frame_idx, return_latent=False, return_sample=True)
-        if not using_vid_init:
-            prev_sample = sample
+            # apply transforms to previous frame
+            elif prev_sample is not None:
+                if anim_args.animation_mode == '2D':
+                    prev_img = anim_frame_warp_2d(sample_to_cv2(prev_sample), args, anim_args, keys, frame_idx)
+                else: # '3D'
+                    prev_img_cv2 = sample_to_cv2(prev_sample)
+                    # after in-between frames the warped depth already belongs to prev_sample
+                    if depth is None and depth_model is not None:
+                        depth = depth_model.predict(prev_img_cv2, anim_args)
+                    prev_img = anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx)
+
+                # apply color matching
+                if anim_args.color_coherence != 'None':
+                    if color_matcher is None:
+                        color_matcher = ColorMatcher(prev_img, anim_args.color_coherence, device)
+                    else:
+                        prev_img = color_matcher.match(prev_img)
+
+                # apply scaling
+                contrast_sample = prev_img * contrast
+                # apply frame noising
+                noised_sample = add_noise(sample_from_cv2(contrast_sample), noise)
+
+                # use transformed previous frame as init for current
+                args.use_init = True
+                args.init_sample = noised_sample.to(device, dtype=model_dtype)
+                args.strength = max(0.0, min(1.0, strength))
+
+            # grab prompt for current frame
+            args.prompt = prompt_series[frame_idx]
+            print(f"{args.prompt} {args.seed}")
+            if not using_vid_init:
+                print(f"Angle: {keys.angle_series[frame_idx]} Zoom: {keys.zoom_series[frame_idx]}")
+                print(f"Tx: {keys.translation_x_series[frame_idx]} Ty: {keys.translation_y_series[frame_idx]} Tz: {keys.translation_z_series[frame_idx]}")
+                print(f"Rx: {keys.rotation_3d_x_series[frame_idx]} Ry: {keys.rotation_3d_y_series[frame_idx]} Rz: {keys.rotation_3d_z_series[frame_idx]}")
+
+            # grab init image for current frame
+            if using_vid_init:
+                print(f"Using video init frame {frame_idx}")
+                args.init_sample = sample_from_cv2(video_source[frame_idx]).to(device, dtype=model_dtype)
+                if mask_source is not None:
+                    args.mask_file = Image.fromarray(mask_source[frame_idx])
 
-        if turbo_steps > 1:
-            turbo_prev_image, turbo_prev_frame_idx = turbo_next_image, turbo_next_frame_idx
-            turbo_next_image, turbo_next_frame_idx = sample_to_cv2(sample, type=np.float32), frame_idx
-            frame_idx += turbo_steps
-        else:    
-            filename = f"{args.timestring}_{frame_idx:05}.png"
-            image.save(os.path.join(args.outdir, filename))
-            if anim_args.save_depth_maps:
-                if depth is None:
-                    depth = depth_model.predict(sample_to_cv2(sample), anim_args)
-                depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{frame_idx:05}.png"), depth)
-            frame_idx += 1
+            # sample the diffusion model
+            if latent_warping:
+                # the latent is kept for the next frame, only the output image is decoded
+                prev_latent, image = generate(args, frame_idx, return_latent=True)
+                prev_image = np.asarray(image)
+                prev_sample = None
+            else:
+                sample, image = generate(args, frame_idx, return_latent=False, return_sample=True)
+                if not using_vid_init:
+                    prev_sample = sample
+
+            if turbo_steps > 1:
+                turbo_prev_image, turbo_prev_frame_idx = turbo_next_image, turbo_next_frame_idx
+                turbo_next_image, turbo_next_frame_idx = sample_to_turbo_frame(sample, anim_args), frame_idx
+                frame_idx += turbo_steps
+            else:    
+                filename = f"{args.timestring}_{frame_idx:05}.png"
+                writer.save_image(image, os.path.join(args.outdir, filename))
+                if anim_args.save_depth_maps:
+                    if depth is None:
+                        depth = depth_model.predict(prev_image if latent_warping else sample_to_cv2(sample), anim_args)
+                    depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{frame_idx:05}.png"), depth)
+                frame_idx += 1
 
-        display.clear_output(wait=True)
-        display.display(image)
+            display.clear_output(wait=True)
+            display.display(image)
 
-        args.seed = next_seed(args)
+            args.seed = next_seed(args)
 
-def vid2frames(video_path, frames_path, n=1, overwrite=True):      
-    if not os.path.exists(frames_path) or overwrite: 
-      try:
-          for f in pathlib.Path(video_in_frame_path).glob('*.jpg'):
-              f.unlink()
-      except:
-          pass
-      assert os.path.exists(video_path), f"Video input {video_path} does not exist"
-          
-      vidcap = cv2.VideoCapture(video_path)
-      success,image = vidcap.read()
-      count = 0
-      t=1
-      success = True
-      while success:
-        if count % n == 0:
-            cv2.imwrite(frames_path + os.path.sep + f"{t:05}.jpg" , image)     # save frame as JPEG file
-            t += 1
-        success,image = vidcap.read()
-        count += 1
-      print("Converted %d frames" % count)
-    else: print("Frames already unpacked")
-
-def render_input_video(args, anim_args):
-    # create a folder for the video input frames to live in
-    video_in_frame_path = os.path.join(args.outdir, 'inputframes') 
-    os.makedirs(video_in_frame_path, exist_ok=True)
-    
-    # save the video frames from input video
-    print(f"Exporting Video Frames (1 every {anim_args.extract_nth_frame}) frames to {video_in_frame_path}...")
-    vid2frames(anim_args.video_init_path, video_in_frame_path, anim_args.extract_nth_frame, anim_args.overwrite_extracted_frames)
+    args.n_samples = 1
 
-    # determine max frames from length of input frames
-    anim_args.max_frames = len([f for f in pathlib.Path(video_in_frame_path).glob('*.jpg')])
+def render_input_video(args, anim_args, animation_prompts, on_saved=None):
+    # input frames are decoded while rendering, already resized to the output size
+    print(f"Reading video frames (1 every {anim_args.extract_nth_frame}) from {anim_args.video_init_path}...")
+    video_source = VideoFrameSource(anim_args.video_init_path, anim_args.extract_nth_frame, (args.W, args.H))
+
+    # determine max frames from length of input video
+    anim_args.max_frames = len(video_source)
     args.use_init = True
-    print(f"Loading {anim_args.max_frames} input frames from {video_in_frame_path} and saving video frames to {args.outdir}")
+    print(f"Loading {anim_args.max_frames} input frames and saving video frames to {args.outdir}")
 
+    mask_source = None
     if anim_args.use_mask_video:
-        # create a folder for the mask video input frames to live in
-        mask_in_frame_path = os.path.join(args.outdir, 'maskframes') 
-        os.makedirs(mask_in_frame_path, exist_ok=True)
-
-        # save the video frames from mask video
-        print(f"Exporting Video Frames (1 every {anim_args.extract_nth_frame}) frames to {mask_in_frame_path}...")
-        vid2frames(anim_args.video_mask_path, mask_in_frame_path, anim_args.extract_nth_frame, anim_args.overwrite_extracted_frames)
+        print(f"Reading mask frames (1 every {anim_args.extract_nth_frame}) from {anim_args.video_mask_path}...")
+        mask_source = VideoFrameSource(anim_args.video_mask_path, anim_args.extract_nth_frame, (args.W, args.H))
         args.use_mask = True
         args.overlay_mask = True
 
-    render_animation(args, anim_args)
+    try:
+        render_animation(args, anim_args, animation_prompts, video_source, mask_source, on_saved)
+    finally:
+        video_source.close()
+        if mask_source is not None:
+            mask_source.close()
 
-def render_interpolation(args, anim_args):
+def render_interpolation(args, anim_args, animation_prompts, on_saved=None):
     # animations use key framed prompts
     args.prompts = animation_prompts
 
@@ -1685,8 +1892,8 @@ def render_interpolation(args, anim_args):
     display.clear_output(wait=True)
     print(f"Interpolation start...")
 
-    frame_idx = 0
-
+    # interpolate the text embeddings of every frame up front, the last prompt is rendered as is
+    frames_c = []
     if anim_args.interpolate_key_frames:
       for i in range(len(prompts_c_s)-1):
         dist_frames = list(animation_prompts.items())[i+1][0] - list(animation_prompts.items())[i][0]
@@ -1695,55 +1902,43 @@ def render_interpolation(args, anim_args):
           return
         else:
           for j in range(dist_frames):
-            # interpolate the text embedding
             prompt1_c = prompts_c_s[i]
             prompt2_c = prompts_c_s[i+1]  
-            args.init_c = prompt1_c.add(prompt2_c.sub(prompt1_c).mul(j * 1/dist_frames))
-
-            # sample the diffusion model
-            results = generate(args)
-            image = results[0]
-
-            filename = f"{args.timestring}_{frame_idx:05}.png"
-            image.save(os.path.join(args.outdir, filename))
-            frame_idx += 1
-
-            display.clear_output(wait=True)
-            display.display(image)
-
-            args.seed = next_seed(args)
+            frames_c.append(prompt1_c.add(prompt2_c.sub(prompt1_c).mul(j * 1/dist_frames)))
 
     else:
       for i in range(len(prompts_c_s)-1):
         for j in range(anim_args.interpolate_x_frames+1):
-          # interpolate the text embedding
           prompt1_c = prompts_c_s[i]
           prompt2_c = prompts_c_s[i+1]  
-          args.init_c = prompt1_c.add(prompt2_c.sub(prompt1_c).mul(j * 1/(anim_args.interpolate_x_frames+1)))
+          frames_c.append(prompt1_c.add(prompt2_c.sub(prompt1_c).mul(j * 1/(anim_args.interpolate_x_frames+1))))
+
+    frames_c.append(prompts_c_s[-1])
 
-          # sample the diffusion model
-          results = generate(args)
-          image = results[0]
+    # interpolation frames only depend on their text embedding, so batch_frames of them are diffused together
+    writer = make_frame_writer(args, anim_args, on_saved=on_saved)
+    batch_frames = max(1, int(anim_args.batch_frames))
 
-          filename = f"{args.timestring}_{frame_idx:05}.png"
-          image.save(os.path.join(args.outdir, filename))
-          frame_idx += 1
+    with writer:
+      for frame_idx in range(0, len(frames_c), batch_frames):
+        batch_c = frames_c[frame_idx:frame_idx+batch_frames]
+        args.n_samples = len(batch_c)
+        args.init_c = torch.cat(batch_c)
 
-          display.clear_output(wait=True)
-          display.display(image)
+        # sample the diffusion model
+        seeds = next_seeds(args, len(batch_c))
+        images = generate(args, seeds=seeds)
 
-          args.seed = next_seed(args)
+        for j, image in enumerate(images):
+          filename = f"{args.timestring}_{frame_idx+j:05}.png"
+          writer.save_image(image, os.path.join(args.outdir, filename))
 
-    # generate the last prompt
-    args.init_c = prompts_c_s[-1]
-    results = generate(args)
-    image = results[0]
-    filename = f"{args.timestring}_{frame_idx:05}.png"
-    image.save(os.path.join(args.outdir, filename))
+        display.clear_output(wait=True)
+        display.display(images[-1])
 
-    display.clear_output(wait=True)
-    display.display(image)
-    args.seed = next_seed(args)
+        args.seed = next_seed(args)
+
+    args.n_samples = 1
 
     #clear init_c
     args.init_c = None
@@ -1773,40 +1968,57 @@ if override_settings_with_file:
             print(args_dict)
             print(anim_args_dict)
 
-args = SimpleNamespace(**args_dict)
-anim_args = SimpleNamespace(**anim_args_dict)
-
-args.timestring = time.strftime('%Y%m%d%H%M%S')
-args.strength = max(0.0, min(1.0, args.strength))
-
-if args.seed == -1:
-    args.seed = random.randint(0, 2**32 - 1)
-if not args.use_init:
-    args.init_image = None
-if args.sampler == 'plms' and (args.use_init or anim_args.animation_mode != 'None'):
-    print(f"Init images aren't supported with PLMS yet, switching to KLMS")
-    args.sampler = 'klms'
-if args.sampler != 'ddim':
-    args.ddim_eta = 0
-
-if anim_args.animation_mode == 'None':
-    anim_args.max_frames = 1
-elif anim_args.animation_mode == 'Video Input':
-    args.use_init = True
+def prepare_args(args_dict, anim_args_dict):
+    args = SimpleNamespace(**args_dict)
+    anim_args = SimpleNamespace(**anim_args_dict)
+
+    args.timestring = time.strftime('%Y%m%d%H%M%S')
+    args.strength = max(0.0, min(1.0, args.strength))
 
-# clean up unused memory
-gc.collect()
-torch.cuda.empty_cache()
-
-# dispatch to appropriate renderer
-if anim_args.animation_mode == '2D' or anim_args.animation_mode == '3D':
-    render_animation(args, anim_args)
-elif anim_args.animation_mode == 'Video Input':
-    render_input_video(args, anim_args)
-elif anim_args.animation_mode == 'Interpolation':
-    render_interpolation(args, anim_args)
+    if args.seed == -1:
+        args.seed = random.randint(0, 2**32 - 1)
+    if not args.use_init:
+        args.init_image = None
+    if args.sampler == 'plms' and (args.use_init or anim_args.animation_mode != 'None'):
+        print(f"Init images aren't supported with PLMS yet, switching to KLMS")
+        args.sampler = 'klms'
+    if args.sampler != 'ddim':
+        args.ddim_eta = 0
+
+    if anim_args.animation_mode == 'None':
+        anim_args.max_frames = 1
+    elif anim_args.animation_mode == 'Video Input':
+        args.use_init = True
+    return args, anim_args
+
+def render(args, anim_args, prompts, animation_prompts, on_saved=None):
+    # clean up unused memory
+    gc.collect()
+    empty_cache(device)
+
+    # dispatch to appropriate renderer
+    if anim_args.animation_mode == '2D' or anim_args.animation_mode == '3D':
+        render_animation(args, anim_args, animation_prompts, on_saved=on_saved)
+    elif anim_args.animation_mode == 'Video Input':
+        render_input_video(args, anim_args, animation_prompts, on_saved)
+    elif anim_args.animation_mode == 'Interpolation':
+        render_interpolation(args, anim_args, animation_prompts, on_saved)
+    else:
+        render_image_batch(args, prompts, on_saved)    
+
+def render_job(args_dict, anim_args_dict, prompts, animation_prompts, on_saved=None):
+    # renders a job posted to the render server with the model loaded above, the render server
+    # runs one job at a time and passes everything else per job
+    args, anim_args = prepare_args(args_dict, anim_args_dict)
+    render(args, anim_args, prompts, animation_prompts, on_saved)
+
+args, anim_args = prepare_args(args_dict, anim_args_dict)
+
+if serve_render_jobs:
+    predictor = Predictor(render_job, args_dict, anim_args_dict, prompts, animation_prompts)
+    RenderServer(predictor, output_path).serve(render_server_address)
 else:
-    render_image_batch(args)    
+    render(args, anim_args, prompts, animation_prompts)
 
 # %%
 # !! {"metadata":{
@@ -1856,29 +2068,33 @@ else:
             mp4_path = os.path.join(args.outdir, f"{args.timestring}.mp4")
             max_frames = str(anim_args.max_frames)
 
-    # make video
-    cmd = [
-        'ffmpeg',
-        '-y',
-        '-vcodec', 'png',
-        '-r', str(fps),
-        '-start_number', str(0),
-        '-i', image_path,
-        '-frames:v', max_frames,
-        '-c:v', 'libx264',
-        '-vf',
-        f'fps={fps}',
-        '-pix_fmt', 'yuv420p',
-        '-crf', '17',
-        '-preset', 'veryfast',
-        '-pattern_type', 'sequence',
-        mp4_path
-    ]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        print(stderr)
-        raise RuntimeError(stderr)
+    # make video, unless it was already streamed while rendering. A resumed run streams nothing,
+    # an mp4 there is the partial one of the run it resumed.
+    if not use_manual_settings and not render_steps and anim_args.stream_video and not anim_args.resume_from_timestring and os.path.exists(mp4_path):
+        print(f"{mp4_path} was written while rendering")
+    else:
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-vcodec', 'png',
+            '-r', str(fps),
+            '-start_number', str(0),
+            '-i', image_path,
+            '-frames:v', max_frames,
+            '-c:v', 'libx264',
+            '-vf',
+            f'fps={fps}',
+            '-pix_fmt', 'yuv420p',
+            '-crf', '17',
+            '-preset', 'veryfast',
+            '-pattern_type', 'sequence',
+            mp4_path
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            print(stderr)
+            raise RuntimeError(stderr)
 
     mp4 = open(mp4_path,'rb').read()
     data_url = "data:video/mp4;base64," + b64encode(mp4).decode()
@@ -14,7 +14,6 @@ sys.path.append('./CLIP')
 sys.path.append('./stable-diffusion-0.4')
 sys.path.append('./k-diffusion')
 sys.path.append('./taming-transformers')
-sys.path.append('./pytorch3d-lite')
 sys.path.append('./AdaBins')
 sys.path.append('./MiDaS')
 
@@ -37,17 +36,15 @@ from omegaconf import OmegaConf
 import PIL
 from PIL import Image, ImageDraw
 from pytorch_lightning import seed_everything
-from skimage.exposure import match_histograms
 from torchvision.utils import make_grid
 from tqdm import tqdm, trange
 from types import SimpleNamespace
 from torch.cuda.amp import autocast
-import py3d_tools as p3d
-from helpers import DepthModel, sampler_fn
-from k_diffusion.external import CompVisDenoiser
+from helpers import ColorMatcher, ConditioningCache, DepthModel, FrameWriter, SamplerPool, euler_angles_to_matrix, sampler_fn, warp_images_3d
+from ldm.checkpoint import load_checkpoint, load_weights, no_init_weights
 from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.models.diffusion.plms import PLMSSampler
+from ldm.modules.upscaler import get_upscaler, upscalers
 import argparse
 
 
@@ -82,6 +79,9 @@ class Options:
     passes: int
     wm: str
     realesrgan: str
+    upscaler: str
+    upscaler_model: str
+    upscaler_tile: int
     detail_steps: int
     detail_scale: float
     gobig_overlap: int
@@ -148,6 +148,9 @@ def parse_args():
     parser.add_argument("--HDstrength",type=float,default=0.3,help="strength for noising/unnoising. 1.0 corresponds to full destruction of information in init image",)
     parser.add_argument("--passes",type=int,default=1,help="number of upscales/details",)
     parser.add_argument("--realesrgan",type=str,default="realesrgan-ncnn-vulkan",help="path to realesrgan executable")
+    parser.add_argument("--upscaler",type=str,default="auto",choices=upscalers,help="upscaler between passes, auto uses esrgan when --upscaler_model exists")
+    parser.add_argument("--upscaler_model",type=str,default="models/RealESRGAN_x4plus.pth",help="Real-ESRGAN weights for the esrgan upscaler")
+    parser.add_argument("--upscaler_tile",type=int,default=512,help="tile size for the esrgan upscaler, 0 upscales the whole image at once")
     parser.add_argument("--detail_steps",type=int,default=150,help="number of sampling steps when detailing",)
     parser.add_argument("--detail_scale",type=float,default=10,help="unconditional guidance scale when detailing: eps = eps(x, empty) + scale * (eps(x, cond) - eps(x, empty))",)
     parser.add_argument("--gobig_overlap",type=int,default=128,help="overlap size for GOBIG",)
@@ -164,7 +167,10 @@ args2=parse_args();
 
 device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
 print('Using device:', device)
-print(torch.cuda.get_device_properties(device))
+if device.type == 'cuda':
+    print(torch.cuda.get_device_properties(device))
+else:
+    torch.set_num_threads(os.cpu_count() or 1)
 sys.stdout.flush()
 
 
@@ -306,24 +312,6 @@ def grid_slice(source, overlap, og_size, maximize=False):
     return slices, new_size
 
 
-def realesrgan2x(executable: str, input: str, output: str):
-    print(f"executable = {executable}\n")
-    print(f"input = {input}\n")
-    print(f"output = {output}\n")
-    process = subprocess.Popen([
-        './'+executable+'/realesrgan-ncnn-vulkan.exe',
-        '-i',
-        './'+input,
-        '-o',
-        './'+output,
-        '-n',
-        'realesrgan-x4plus'
-    ])
-    process.wait()
-
-    final_output = Image.open(output)
-    final_output = final_output.resize((int(final_output.size[0] / 2), int(final_output.size[1] / 2)), get_resampling_mode())
-    final_output.save(output)
 ###############################################################################################################################################################################
 
 
@@ -365,7 +353,7 @@ def anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx):
         math.radians(keys.rotation_3d_y_series[frame_idx]), 
         math.radians(keys.rotation_3d_z_series[frame_idx])
     ]
-    rot_mat = p3d.euler_angles_to_matrix(torch.tensor(rotate_xyz, device=device), "XYZ").unsqueeze(0)
+    rot_mat = euler_angles_to_matrix(rotate_xyz, device=device)
     result = transform_image_3d(prev_img_cv2, depth, rot_mat, translate_xyz, anim_args)
     torch.cuda.empty_cache()
     return result
@@ -455,20 +443,6 @@ def prepare_mask(mask_input, mask_shape, mask_brightness_adjust=1.0, mask_contra
     mask = np.clip(mask,0,1)
     return mask
 
-def maintain_colors(prev_img, color_match_sample, mode):
-    if mode == 'Match Frame 0 RGB':
-        return match_histograms(prev_img, color_match_sample, multichannel=True)
-    elif mode == 'Match Frame 0 HSV':
-        prev_img_hsv = cv2.cvtColor(prev_img, cv2.COLOR_RGB2HSV)
-        color_match_hsv = cv2.cvtColor(color_match_sample, cv2.COLOR_RGB2HSV)
-        matched_hsv = match_histograms(prev_img_hsv, color_match_hsv, multichannel=True)
-        return cv2.cvtColor(matched_hsv, cv2.COLOR_HSV2RGB)
-    else: # Match Frame 0 LAB
-        prev_img_lab = cv2.cvtColor(prev_img, cv2.COLOR_RGB2LAB)
-        color_match_lab = cv2.cvtColor(color_match_sample, cv2.COLOR_RGB2LAB)
-        matched_lab = match_histograms(prev_img_lab, color_match_lab, multichannel=True)
-        return cv2.cvtColor(matched_lab, cv2.COLOR_LAB2RGB)
-
 
 def make_callback(sampler_name, dynamic_threshold=None, static_threshold=None, mask=None, init_latent=None, sigmas=None, sampler=None, masked_noise_modifier=1.0):  
     # Creates the callback function to be passed into the samplers
@@ -550,34 +524,11 @@ def transform_image_3d(prev_img_cv2, depth_tensor, rot_mat, translate, anim_args
     # adapted and optimized version of transform_image_3d from Disco Diffusion https://github.com/alembics/disco-diffusion 
     w, h = prev_img_cv2.shape[1], prev_img_cv2.shape[0]
 
-    aspect_ratio = float(w)/float(h)
-    near, far, fov_deg = anim_args.near_plane, anim_args.far_plane, anim_args.fov
-    persp_cam_old = p3d.FoVPerspectiveCameras(near, far, aspect_ratio, fov=fov_deg, degrees=True, device=device)
-    persp_cam_new = p3d.FoVPerspectiveCameras(near, far, aspect_ratio, fov=fov_deg, degrees=True, R=rot_mat, T=torch.tensor([translate]), device=device)
-
-    # range of [-1,1] is important to torch grid_sample's padding handling
-    y,x = torch.meshgrid(torch.linspace(-1.,1.,h,dtype=torch.float32,device=device),torch.linspace(-1.,1.,w,dtype=torch.float32,device=device))
-    z = torch.as_tensor(depth_tensor, dtype=torch.float32, device=device)
-    xyz_old_world = torch.stack((x.flatten(), y.flatten(), z.flatten()), dim=1)
-
-    xyz_old_cam_xy = persp_cam_old.get_full_projection_transform().transform_points(xyz_old_world)[:,0:2]
-    xyz_new_cam_xy = persp_cam_new.get_full_projection_transform().transform_points(xyz_old_world)[:,0:2]
-
-    offset_xy = xyz_new_cam_xy - xyz_old_cam_xy
-    # affine_grid theta param expects a batch of 2D mats. Each is 2x3 to do rotation+translation.
-    identity_2d_batch = torch.tensor([[1.,0.,0.],[0.,1.,0.]], device=device).unsqueeze(0)
-    # coords_2d will have shape (N,H,W,2).. which is also what grid_sample needs.
-    coords_2d = torch.nn.functional.affine_grid(identity_2d_batch, [1,1,h,w], align_corners=False)
-    offset_coords_2d = coords_2d - torch.reshape(offset_xy, (h,w,2)).unsqueeze(0)
+    if depth_tensor is None:
+        depth_tensor = torch.ones((h, w), device=device)
 
     image_tensor = rearrange(torch.from_numpy(prev_img_cv2.astype(np.float32)), 'h w c -> c h w').to(device)
-    new_image = torch.nn.functional.grid_sample(
-        image_tensor.add(1/512 - 0.0001).unsqueeze(0), 
-        offset_coords_2d, 
-        mode=anim_args.sampling_mode, 
-        padding_mode=anim_args.padding_mode, 
-        align_corners=False
-    )
+    new_image = warp_images_3d(image_tensor.add(1/512 - 0.0001).unsqueeze(0), torch.as_tensor(depth_tensor, device=device), rot_mat, translate, anim_args)
 
     # convert back to cv2 style numpy array
     result = rearrange(
@@ -586,12 +537,18 @@ def transform_image_3d(prev_img_cv2, depth_tensor, rot_mat, translate, anim_args
     ).cpu().numpy().astype(prev_img_cv2.dtype)
     return result
 
+# text encoder outputs are reused across frames
+conditioning_cache = ConditioningCache()
+
+# samplers and noise schedules are built once and reused by every generate() call
+sampler_pool = SamplerPool()
+
 def generate(args, return_latent=False, return_sample=False, return_c=False):
     seed_everything(args.seed)
     os.makedirs(args.outdir, exist_ok=True)
     
-    sampler = PLMSSampler(model) if args.sampler == 'plms' else DDIMSampler(model)
-    model_wrap = CompVisDenoiser(model)
+    sampler = sampler_pool.get_sampler(model, args.sampler)
+    model_wrap = sampler_pool.get_model_wrap(model)
     batch_size = args.n_samples
     prompt = args.prompt
     assert prompt is not None
@@ -692,12 +649,14 @@ def generate(args, return_latent=False, return_sample=False, return_c=False):
         with torch.cuda.amp.autocast():
             with model.ema_scope():
                 for prompts in data:
+                    # the negative and the positive prompt in one text encoder call
+                    conditioning_cache.get_many(model, [args2.negative_prompt, prompts[0]] if args.scale != 1.0 else [prompts[0]])
                     uc = None
                     if args.scale != 1.0:
-                        uc = model.get_learned_conditioning(batch_size * [args2.negative_prompt])
+                        uc = conditioning_cache.get(model, args2.negative_prompt, batch_size)
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
-                    c = model.get_learned_conditioning(prompts)
+                    c = conditioning_cache.get(model, prompts[0], len(prompts))
 
                     if args.init_c != None:
                         c = args.init_c
@@ -793,14 +752,16 @@ def generate(args, return_latent=False, return_sample=False, return_c=False):
         
     sampler = DDIMSampler(model)
 
+    upscaler = get_upscaler(args2.upscaler, model_path=args2.upscaler_model, executable=args2.realesrgan, device=device, half_precision=device.type == 'cuda', tile=args2.upscaler_tile)
+
     for base_filename in generated:
+        # every pass upscales the previous pass in memory, the PNGs are only written as outputs
+        source_image = Image.open(os.path.join(sample_path, f"{base_filename}.png")).convert("RGB")
         for _ in trange(args2.passes, desc="Passes"):
-            realesrgan2x(args2.realesrgan, os.path.join(sample_path, f"{base_filename}.png"), os.path.join(sample_path, f"{base_filename}u.png"))
-            #realesrgan2x(args2.realesrgan, args2.image_file, args2.image_file)
+            source_image = upscaler.upscale(source_image)
             base_filename = f"{base_filename}u"
+            source_image.save(os.path.join(sample_path, f"{base_filename}.png"))
 
-            source_image = Image.open(os.path.join(sample_path, f"{base_filename}.png"))
-            
             sys.stdout.write('Saving progress ...\n')
             sys.stdout.flush()
             shutil.copyfile(os.path.join(sample_path, f"{base_filename}.png"),args2.image_file)
@@ -850,12 +811,14 @@ def generate(args, return_latent=False, return_sample=False, return_c=False):
                                 # decode it
                                 samples = sampler.decode(z_enc, c, t_enc, unconditional_guidance_scale=args2.detail_scale,
                                                         unconditional_conditioning=uc,)"""
+                                # the negative and the positive prompt in one text encoder call
+                                conditioning_cache.get_many(model, [args2.negative_prompt, prompts[0]] if args.scale != 1.0 else [prompts[0]])
                                 uc = None
                                 if args.scale != 1.0:
-                                    uc = model.get_learned_conditioning(batch_size * [args2.negative_prompt])
+                                    uc = conditioning_cache.get(model, args2.negative_prompt, batch_size)
                                 if isinstance(prompts, tuple):
                                     prompts = list(prompts)
-                                c = model.get_learned_conditioning(prompts)
+                                c = conditioning_cache.get(model, prompts[0], len(prompts))
 
                                 #if generated != None:
                                 #    c = generated
@@ -934,6 +897,7 @@ def generate(args, return_latent=False, return_sample=False, return_c=False):
 
             #final_output.save(args2.image_file)
             base_filename = f"{base_filename}d"
+            source_image = final_output
 
             torch.cuda.empty_cache()
             gc.collect()
@@ -1026,16 +990,18 @@ if ckpt_valid:
 """
 
 def load_model_from_config(config, ckpt, verbose=False, device='cuda', half_precision=True):
-    map_location = "cuda" #@param ["cpu", "cuda"]
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location=map_location)
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
+    # the cpu path runs in float32, the cuda autocast used for sampling does nothing there
+    half_precision = half_precision and torch.device(device).type == 'cuda'
+    sd, metadata = load_checkpoint(ckpt, half_precision=half_precision)
+    if "global_step" in metadata:
+        print(f"Global Step: {metadata['global_step']}")
+    with no_init_weights():
+        model = instantiate_from_config(config.model)
+    m, u = load_weights(model, sd, device, torch.float16 if half_precision else torch.float32)
+    del sd
     if embedding_path is not None:
         model.embedding_manager.load(embedding_path)
-    m, u = model.load_state_dict(sd, strict=False)
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -1043,19 +1009,14 @@ def load_model_from_config(config, ckpt, verbose=False, device='cuda', half_prec
         print("unexpected keys:")
         print(u)
 
-    if half_precision:
-        model = model.half().to(device)
-    else:
-        model = model.to(device)
     model.eval()
     return model
 
 if load_on_run_all and ckpt_valid:
     local_config = OmegaConf.load(f"{ckpt_config_path}")
-    model = load_model_from_config(local_config, f"{ckpt_path}", half_precision=half_precision)
+    model = load_model_from_config(local_config, f"{ckpt_path}", device=device, half_precision=half_precision)
     if embedding_path is not None:
         model.embedding_manager.load(embedding_path)
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     model = model.to(device)
 
 """# Settings
@@ -1119,6 +1080,9 @@ def DeforumAnimArgs():
     resume_from_timestring = False #@param {type:"boolean"}
     resume_timestring = "20220829210106" #@param {type:"string"}
 
+    #@markdown ####**Performance:**
+    writer_threads = 2 #@param {type:"number"}
+
     return locals()
 
 class DeformAnimKeys():
@@ -1463,7 +1427,7 @@ def render_animation(args, anim_args):
 
     # resume animation
     prev_sample = None
-    color_match_sample = None
+    color_matcher = None
     if anim_args.resume_from_timestring:
         last_frame = start_frame-1
         if turbo_steps > 1:
@@ -1473,151 +1437,143 @@ def render_animation(args, anim_args):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         prev_sample = sample_from_cv2(img)
         if anim_args.color_coherence != 'None':
-            color_match_sample = img
+            color_matcher = ColorMatcher(img, anim_args.color_coherence, device)
         if turbo_steps > 1:
             turbo_next_image, turbo_next_frame_idx = sample_to_cv2(prev_sample, type=np.float32), last_frame
             turbo_prev_image, turbo_prev_frame_idx = turbo_next_image, turbo_next_frame_idx
             start_frame = last_frame+turbo_steps
 
+    # frames are encoded and saved in the background while the next frame is diffused, the GUI
+    # picks up a frame at its progress handshake, which is sent once the frame is on disk
+    def report_saved(path):
+        sys.stdout.write('Saving progress ...\nProgress saved\n')
+        sys.stdout.flush()
+    writer = FrameWriter(anim_args.writer_threads, on_saved=report_saved)
+
     args.n_samples = 1
     frame_idx = start_frame
-    while frame_idx < anim_args.max_frames:
-        sys.stdout.write(f"Rendering animation frame {frame_idx} of {anim_args.max_frames}\n")
-        sys.stdout.flush()
-        noise = keys.noise_schedule_series[frame_idx]
-        strength = keys.strength_schedule_series[frame_idx]
-        contrast = keys.contrast_schedule_series[frame_idx]
-        depth = None
+    with writer:
+        while frame_idx < anim_args.max_frames:
+            sys.stdout.write(f"Rendering animation frame {frame_idx} of {anim_args.max_frames}\n")
+            sys.stdout.flush()
+            noise = keys.noise_schedule_series[frame_idx]
+            strength = keys.strength_schedule_series[frame_idx]
+            contrast = keys.contrast_schedule_series[frame_idx]
+            depth = None
         
-        # emit in-between frames
-        if turbo_steps > 1:
-            tween_frame_start_idx = max(0, frame_idx-turbo_steps)
-            for tween_frame_idx in range(tween_frame_start_idx, frame_idx):
-                tween = float(tween_frame_idx - tween_frame_start_idx + 1) / float(frame_idx - tween_frame_start_idx)
-                print(f"  creating in between frame {tween_frame_idx} tween:{tween:0.2f}")
-
-                advance_prev = turbo_prev_image is not None and tween_frame_idx > turbo_prev_frame_idx
-                advance_next = tween_frame_idx > turbo_next_frame_idx
-
-                if depth_model is not None:
-                    assert(turbo_next_image is not None)
-                    depth = depth_model.predict(turbo_next_image, anim_args)
-
+            # emit in-between frames
+            if turbo_steps > 1:
+                tween_frame_start_idx = max(0, frame_idx-turbo_steps)
+                for tween_frame_idx in range(tween_frame_start_idx, frame_idx):
+                    tween = float(tween_frame_idx - tween_frame_start_idx + 1) / float(frame_idx - tween_frame_start_idx)
+                    print(f"  creating in between frame {tween_frame_idx} tween:{tween:0.2f}")
+
+                    advance_prev = turbo_prev_image is not None and tween_frame_idx > turbo_prev_frame_idx
+                    advance_next = tween_frame_idx > turbo_next_frame_idx
+
+                    if depth_model is not None:
+                        assert(turbo_next_image is not None)
+                        depth = depth_model.predict(turbo_next_image, anim_args)
+
+                    if anim_args.animation_mode == '2D':
+                        if advance_prev:
+                            turbo_prev_image = anim_frame_warp_2d(turbo_prev_image, args, anim_args, keys, tween_frame_idx)
+                        if advance_next:
+                            turbo_next_image = anim_frame_warp_2d(turbo_next_image, args, anim_args, keys, tween_frame_idx)
+                    else: # '3D'
+                        if advance_prev:
+                            turbo_prev_image = anim_frame_warp_3d(turbo_prev_image, depth, anim_args, keys, tween_frame_idx)
+                        if advance_next:
+                            turbo_next_image = anim_frame_warp_3d(turbo_next_image, depth, anim_args, keys, tween_frame_idx)
+                    turbo_prev_frame_idx = turbo_next_frame_idx = tween_frame_idx
+
+                    #filename = f"{args.timestring}_{tween_frame_idx:05}.png"
+                    filename = f"FRA{tween_frame_idx+1:05}.PNG"
+                    writer.save_tween(turbo_prev_image, turbo_next_image, tween, os.path.join(args.outdir, filename))
+
+                    if anim_args.save_depth_maps:
+                        #depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{tween_frame_idx:05}.png"), depth)
+                        depth_model.save(os.path.join(args.outdir, f"Depth_FRA{tween_frame_idx+1:05}.PNG"), depth)
+                if turbo_next_image is not None:
+                    prev_sample = sample_from_cv2(turbo_next_image)
+
+            # apply transforms to previous frame
+            if prev_sample is not None:
                 if anim_args.animation_mode == '2D':
-                    if advance_prev:
-                        turbo_prev_image = anim_frame_warp_2d(turbo_prev_image, args, anim_args, keys, tween_frame_idx)
-                    if advance_next:
-                        turbo_next_image = anim_frame_warp_2d(turbo_next_image, args, anim_args, keys, tween_frame_idx)
+                    prev_img = anim_frame_warp_2d(sample_to_cv2(prev_sample), args, anim_args, keys, frame_idx)
                 else: # '3D'
-                    if advance_prev:
-                        turbo_prev_image = anim_frame_warp_3d(turbo_prev_image, depth, anim_args, keys, tween_frame_idx)
-                    if advance_next:
-                        turbo_next_image = anim_frame_warp_3d(turbo_next_image, depth, anim_args, keys, tween_frame_idx)
-                turbo_prev_frame_idx = turbo_next_frame_idx = tween_frame_idx
-
-                if turbo_prev_image is not None and tween < 1.0:
-                    img = turbo_prev_image*(1.0-tween) + turbo_next_image*tween
-                else:
-                    img = turbo_next_image
-
-                sys.stdout.write('Saving progress ...\n')
-                sys.stdout.flush()
-
-                #filename = f"{args.timestring}_{tween_frame_idx:05}.png"
-                filename = f"FRA{tween_frame_idx+1:05}.PNG"
-                cv2.imwrite(os.path.join(args.outdir, filename), cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR))
+                    prev_img_cv2 = sample_to_cv2(prev_sample)
+                    depth = depth_model.predict(prev_img_cv2, anim_args) if depth_model else None
+                    prev_img = anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx)
+
+                # apply color matching
+                if anim_args.color_coherence != 'None':
+                    if color_matcher is None:
+                        color_matcher = ColorMatcher(prev_img, anim_args.color_coherence, device)
+                    else:
+                        prev_img = color_matcher.match(prev_img)
 
-                sys.stdout.write('Progress saved\n')
-                sys.stdout.flush()
+                # apply scaling
+                contrast_sample = prev_img * contrast
+                # apply frame noising
+                noised_sample = add_noise(sample_from_cv2(contrast_sample), noise)
 
-                if anim_args.save_depth_maps:
-                    #depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{tween_frame_idx:05}.png"), depth)
-                    depth_model.save(os.path.join(args.outdir, f"Depth_FRA{tween_frame_idx+1:05}.PNG"), depth)
-            if turbo_next_image is not None:
-                prev_sample = sample_from_cv2(turbo_next_image)
-
-        # apply transforms to previous frame
-        if prev_sample is not None:
-            if anim_args.animation_mode == '2D':
-                prev_img = anim_frame_warp_2d(sample_to_cv2(prev_sample), args, anim_args, keys, frame_idx)
-            else: # '3D'
-                prev_img_cv2 = sample_to_cv2(prev_sample)
-                depth = depth_model.predict(prev_img_cv2, anim_args) if depth_model else None
-                prev_img = anim_frame_warp_3d(prev_img_cv2, depth, anim_args, keys, frame_idx)
-
-            # apply color matching
-            if anim_args.color_coherence != 'None':
-                if color_match_sample is None:
-                    color_match_sample = prev_img.copy()
+                # use transformed previous frame as init for current
+                args.use_init = True
+                if half_precision:
+                    args.init_sample = noised_sample.half().to(device)
                 else:
-                    prev_img = maintain_colors(prev_img, color_match_sample, anim_args.color_coherence)
+                    args.init_sample = noised_sample.to(device)
+                args.strength = max(0.0, min(1.0, strength))
 
-            # apply scaling
-            contrast_sample = prev_img * contrast
-            # apply frame noising
-            noised_sample = add_noise(sample_from_cv2(contrast_sample), noise)
-
-            # use transformed previous frame as init for current
-            args.use_init = True
-            if half_precision:
-                args.init_sample = noised_sample.half().to(device)
-            else:
-                args.init_sample = noised_sample.to(device)
-            args.strength = max(0.0, min(1.0, strength))
-
-        # grab prompt for current frame
-        args.prompt = prompt_series[frame_idx]
-        sys.stdout.write(f"{args.prompt}\n")
-        sys.stdout.write(f"{args.timestring}\n")
-        sys.stdout.flush()
-
-        # grab init image for current frame
-        if using_vid_init:
-            init_frame = os.path.join(args.outdir, 'inputframes', f"{frame_idx+1:04}.jpg")            
-            sys.stdout.flush()
-            sys.stdout.write(f"Using video init frame {init_frame}\n")
+            # grab prompt for current frame
+            args.prompt = prompt_series[frame_idx]
+            sys.stdout.write(f"{args.prompt}\n")
+            sys.stdout.write(f"{args.timestring}\n")
             sys.stdout.flush()
-            args.init_image = init_frame
 
-        # sample the diffusion model
-        sample, image = generate(args, return_latent=False, return_sample=True)
-
-        sys.stdout.write('Saving progress ...\n')
-        sys.stdout.flush()
-
-        #filename = f"{args.timestring}_{index:05}_{args.seed}.png"
-        filename = args2.image_file
-        image.save(os.path.join(args.outdir, filename))
+            # grab init image for current frame
+            if using_vid_init:
+                init_frame = os.path.join(args.outdir, 'inputframes', f"{frame_idx+1:04}.jpg")            
+                sys.stdout.flush()
+                sys.stdout.write(f"Using video init frame {init_frame}\n")
+                sys.stdout.flush()
+                args.init_image = init_frame
 
-        #filename = f"{args.timestring}_{frame_idx:05}.png"
-        filename = f"FRA{frame_idx+1:05}.PNG"
-        #image.save(os.path.join(args.outdir, filename))
-        image.save(os.path.join(args2.frame_dir, filename))
+            # sample the diffusion model
+            sample, image = generate(args, return_latent=False, return_sample=True)
 
-        if not using_vid_init:
-            prev_sample = sample
+            # saved before the frame is queued, so it is on disk when the frame reports progress
+            #filename = f"{args.timestring}_{index:05}_{args.seed}.png"
+            filename = args2.image_file
+            image.save(os.path.join(args.outdir, filename))
 
-        if turbo_steps > 1:
-            turbo_prev_image, turbo_prev_frame_idx = turbo_next_image, turbo_next_frame_idx
-            turbo_next_image, turbo_next_frame_idx = sample_to_cv2(sample, type=np.float32), frame_idx
-            frame_idx += turbo_steps
-        else:    
             #filename = f"{args.timestring}_{frame_idx:05}.png"
+            filename = f"FRA{frame_idx+1:05}.PNG"
             #image.save(os.path.join(args.outdir, filename))
-            if anim_args.save_depth_maps:
-                if depth is None:
-                    depth = depth_model.predict(sample_to_cv2(sample), anim_args)
-                #depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{frame_idx:05}.png"), depth)
-                depth_model.save(os.path.join(args.outdir, f"Depth_FRA{frame_idx+1:05}.PNG"), depth)
-            frame_idx += 1
-
-        sys.stdout.write('Progress saved\n')
-        sys.stdout.flush()
+            writer.save_image(image, os.path.join(args2.frame_dir, filename))
+
+            if not using_vid_init:
+                prev_sample = sample
+
+            if turbo_steps > 1:
+                turbo_prev_image, turbo_prev_frame_idx = turbo_next_image, turbo_next_frame_idx
+                turbo_next_image, turbo_next_frame_idx = sample_to_cv2(sample, type=np.float32), frame_idx
+                frame_idx += turbo_steps
+            else:    
+                #filename = f"{args.timestring}_{frame_idx:05}.png"
+                #image.save(os.path.join(args.outdir, filename))
+                if anim_args.save_depth_maps:
+                    if depth is None:
+                        depth = depth_model.predict(sample_to_cv2(sample), anim_args)
+                    #depth_model.save(os.path.join(args.outdir, f"{args.timestring}_depth_{frame_idx:05}.png"), depth)
+                    depth_model.save(os.path.join(args.outdir, f"Depth_FRA{frame_idx+1:05}.PNG"), depth)
+                frame_idx += 1
 
-        #display.clear_output(wait=True)
-        #display.display(image)
+            #display.clear_output(wait=True)
+            #display.display(image)
 
-        args.seed = next_seed(args)
+            args.seed = next_seed(args)
 
 
 def render_input_video(args, anim_args):
@@ -1,3 +1,13 @@
 from .save_images import save_samples
 from .k_samplers import sampler_fn
-from .depth import DepthModel
\ No newline at end of file
+from .conditioning import ConditioningCache
+from .depth import DepthModel
+from .frame_writer import FrameWriter
+from .render_journal import RenderJournal
+from .render_server import Predictor, RenderServer
+from .sampler_pool import SamplerPool
+from .schedules import get_inbetweens, get_prompt_series, parse_key_frames
+from .video_encoder import VideoEncoder
+from .video_source import VideoFrameSource
+from .warp import euler_angles_to_matrix, warp_depth_3d, warp_images_3d
+from .color_match import ColorMatcher
\ No newline at end of file
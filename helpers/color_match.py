@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+
+
+class ColorMatcher():
+    # Histogram matching of animation frames against one reference frame, the torch version of
+    # skimage's match_histograms for color coherence. The reference is converted and its CDF built
+    # once, every frame after that costs a 256 bin histogram and a lookup table per channel.
+    # Colors are matched in 8 bit RGB, HSV or LAB levels, scaled like cv2's uint8 conversions.
+    # Frames are RGB HWC arrays or tensors (0-255), matched on device and returned as float32 of the same kind.
+    def __init__(self, reference, mode='Match Frame 0 LAB', device=None):
+        self.mode = mode
+        self.device = device
+        levels = self.quantize(self.to_space(self.to_tensor(reference)))
+        counts = _histograms(levels)
+        self.reference = []
+        for channel_counts in counts:
+            values = torch.nonzero(channel_counts).squeeze(1)
+            quantiles = torch.cumsum(channel_counts[values], 0).float() / levels.shape[1]
+            if values.numel() == 1:
+                # a flat channel, anything maps to its one value
+                values, quantiles = values.repeat(2), quantiles.repeat(2)
+            self.reference.append((quantiles, values.float()))
+
+    def match(self, image):
+        x = self.to_space(self.to_tensor(image))
+        levels = self.quantize(x)
+        cdf = torch.cumsum(_histograms(levels), 1).float() / levels.shape[1]
+        lut = torch.stack([_interp(cdf[c], *self.reference[c]) for c in range(3)])
+        matched = torch.gather(lut, 1, levels).reshape(x.shape)
+        result = self.from_space(matched).clamp(0, 255)
+        result = result.permute(1, 2, 0)
+        if isinstance(image, np.ndarray):
+            return result.cpu().numpy().astype(np.float32)
+        return result.to(image.device)
+
+    def to_tensor(self, image):
+        x = torch.as_tensor(np.ascontiguousarray(image) if isinstance(image, np.ndarray) else image)
+        return x.to(self.device or x.device, torch.float32).permute(2, 0, 1)
+
+    def quantize(self, x):
+        return x.round().clamp(0, 255).long().reshape(3, -1)
+
+    def to_space(self, rgb):
+        if self.mode == 'Match Frame 0 RGB':
+            return rgb
+        elif self.mode == 'Match Frame 0 HSV':
+            return rgb_to_hsv(rgb)
+        return rgb_to_lab(rgb)
+
+    def from_space(self, x):
+        if self.mode == 'Match Frame 0 RGB':
+            return x
+        elif self.mode == 'Match Frame 0 HSV':
+            return hsv_to_rgb(x)
+        return lab_to_rgb(x)
+
+
+def _histograms(levels):
+    # (3, 256) counts of every level in each channel
+    offsets = torch.arange(3, device=levels.device).unsqueeze(1) * 256
+    return torch.bincount((levels + offsets).reshape(-1), minlength=3*256).reshape(3, 256)
+
+def _interp(x, xp, fp):
+    # np.interp for increasing xp
+    i = torch.searchsorted(xp, x).clamp(1, xp.numel() - 1)
+    x0, x1, f0, f1 = xp[i - 1], xp[i], fp[i - 1], fp[i]
+    t = ((x - x0) / (x1 - x0).clamp(min=1e-12)).clamp(0, 1)
+    return f0 + t * (f1 - f0)
+
+# color spaces at the scale of cv2's 8 bit conversions: H in [0, 180), S and V in [0, 255],
+# L in [0, 255] and a, b offset by 128
+
+def rgb_to_hsv(rgb):
+    r, g, b = rgb / 255.0
+    maxc, _ = torch.max(rgb / 255.0, dim=0)
+    minc, _ = torch.min(rgb / 255.0, dim=0)
+    delta = maxc - minc
+    safe_delta = delta.clamp(min=1e-12)
+    h = torch.where(maxc == r, torch.remainder((g - b) / safe_delta, 6),
+        torch.where(maxc == g, (b - r) / safe_delta + 2, (r - g) / safe_delta + 4))
+    h = torch.where(delta > 0, h * 60, torch.zeros_like(h))
+    s = torch.where(maxc > 0, delta / maxc.clamp(min=1e-12), torch.zeros_like(maxc))
+    return torch.stack((h / 2, s * 255, maxc * 255))
+
+def hsv_to_rgb(hsv):
+    h = torch.remainder(hsv[0] * 2, 360) / 60
+    s, v = hsv[1] / 255.0, hsv[2] / 255.0
+    channels = []
+    for n in (5, 3, 1):
+        k = torch.remainder(n + h, 6)
+        channels.append(v - v * s * torch.clamp(torch.minimum(k, 4 - k), 0, 1))
+    return torch.stack(channels) * 255
+
+_RGB_TO_XYZ = ((0.412453, 0.357580, 0.180423), (0.212671, 0.715160, 0.072169), (0.019334, 0.119193, 0.950227))
+_WHITE = (0.950456, 1.0, 1.088754)
+
+def rgb_to_lab(rgb):
+    c = rgb / 255.0
+    c = torch.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    m = torch.tensor(_RGB_TO_XYZ, device=rgb.device)
+    xyz = torch.einsum('ij,jhw->ihw', m, c) / torch.tensor(_WHITE, device=rgb.device).view(3, 1, 1)
+    f = torch.where(xyz > 0.008856, xyz.clamp(min=0) ** (1/3), 7.787 * xyz + 16/116)
+    L = torch.where(xyz[1] > 0.008856, 116 * f[1] - 16, 903.3 * xyz[1])
+    a = 500 * (f[0] - f[1])
+    b = 200 * (f[1] - f[2])
+    return torch.stack((L * 255 / 100, a + 128, b + 128))
+
+def lab_to_rgb(lab):
+    L, a, b = lab[0] * 100 / 255, lab[1] - 128, lab[2] - 128
+    fy = (L + 16) / 116
+    f = torch.stack((a / 500 + fy, fy, fy - b / 200))
+    xyz = torch.where(f ** 3 > 0.008856, f ** 3, (f - 16/116) / 7.787)
+    xyz = xyz * torch.tensor(_WHITE, device=lab.device).view(3, 1, 1)
+    m = torch.linalg.inv(torch.tensor(_RGB_TO_XYZ, device=lab.device))
+    c = torch.einsum('ij,jhw->ihw', m, xyz).clamp(0, 1)
+    c = torch.where(c <= 0.0031308, 12.92 * c, 1.055 * c ** (1/2.4) - 0.055)
+    return c * 255
@@ -0,0 +1,69 @@
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+class ConditioningCache():
+    # LRU cache for text encoder outputs. An animation repeats the same prompt for hundreds of
+    # frames, so the conditioning of a text is looked up by (text, embedding manager state, autocast)
+    # and CLIP only runs the first time a prompt is seen. Entries are single rows, broadcast to the
+    # batch size when they are returned. get_many() encodes every text it hasn't seen yet in one
+    # text encoder call, each distinct text once, so the sub-prompts of a weighted prompt and the
+    # unconditional prompt cost one forward together.
+    # The returned tensors are shared between calls and must not be modified in place.
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.model = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model, texts):
+        # a (1, tokens, dim) conditioning row for every text
+        if self.model is None or self.model() is not model:
+            # a different model was loaded, nothing cached so far is valid for it
+            self.clear()
+            self.model = weakref.ref(model)
+        state = (_embedding_state(model), torch.is_autocast_enabled())
+        missing = list(dict.fromkeys(text for text in texts if (text, state) not in self.entries))
+        if missing:
+            self.misses += len(missing)
+            rows = model.get_learned_conditioning(missing).split(1)
+            self.entries.update(((text, state), row) for text, row in zip(missing, rows))
+        self.hits += len(texts) - len(missing)
+
+        rows = []
+        for text in texts:
+            self.entries.move_to_end((text, state))
+            rows.append(self.entries[(text, state)])
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return rows
+
+    def get(self, model, text, n_samples):
+        return self.get_many(model, [text])[0].expand(n_samples, -1, -1)
+
+    def get_batch(self, model, texts):
+        # one row per text, the usual n_samples copies of a single prompt share one entry
+        if all(text == texts[0] for text in texts):
+            return self.get(model, texts[0], len(texts))
+        return torch.cat(self.get_many(model, texts))
+
+    def clear(self):
+        self.entries.clear()
+        self.model = None
+        self.hits = 0
+        self.misses = 0
+
+
+def _embedding_state(model):
+    # textual inversion embeddings change what a placeholder token encodes to, so the loaded
+    # terms and the version of their parameters are part of the key
+    embedding_manager = getattr(model, 'embedding_manager', None)
+    if embedding_manager is None:
+        return None
+    return tuple(
+        (name, param.data_ptr(), param._version)
+        for name, param in embedding_manager.string_to_param_dict.items()
+    )
@@ -1,146 +1,172 @@
-import math, os, subprocess
-import cv2
+import math, os
 import numpy as np
 import torch
-import torchvision.transforms as T
+import torch.nn.functional as F
 
 from einops import rearrange, repeat
 from PIL import Image
 
 from infer import InferenceHelper
+from ldm.download import fetch
 from midas.dpt_depth import DPTDepthModel
-from midas.transforms import Resize, NormalizeImage, PrepareForNet
-
-
-def wget(url, outputdir):
-    print(subprocess.run(['wget', url, '-P', outputdir], stdout=subprocess.PIPE).stdout.decode('utf-8'))
+from midas.midas_net_custom import MidasNet_small
+
+
+# MiDaS models by name: weights, download url, network and default inference resolution.
+# "adabins" predicts with AdaBins alone and "constant" is a flat depth map without any model,
+# for testing or when only the 2D part of the 3D motion matters.
+depth_backends = {
+    'dpt_large': {
+        'file': 'dpt_large-midas-2f21e586.pt',
+        'url': 'https://github.com/intel-isl/DPT/releases/download/1_0/dpt_large-midas-2f21e586.pt',
+        'backbone': 'vitl16_384',
+        'resolution': 384,
+        'mean': (0.5, 0.5, 0.5),
+        'std': (0.5, 0.5, 0.5),
+    },
+    'dpt_hybrid': {
+        'file': 'dpt_hybrid-midas-501f0c75.pt',
+        'url': 'https://github.com/intel-isl/DPT/releases/download/1_0/dpt_hybrid-midas-501f0c75.pt',
+        'backbone': 'vitb_rn50_384',
+        'resolution': 384,
+        'mean': (0.5, 0.5, 0.5),
+        'std': (0.5, 0.5, 0.5),
+    },
+    'midas_small': {
+        'file': 'midas_v21_small_256.pt',
+        'url': 'https://github.com/isl-org/MiDaS/releases/download/v2_1/midas_v21_small_256.pt',
+        'backbone': 'efficientnet_lite3',
+        'resolution': 256,
+        'mean': (0.485, 0.456, 0.406),
+        'std': (0.229, 0.224, 0.225),
+    },
+    'adabins': None,
+    'constant': None,
+}
+
+ADABINS_MEAN = (0.485, 0.456, 0.406)
+ADABINS_STD = (0.229, 0.224, 0.225)
+MAX_ADABINS_AREA = 500000
+MIN_ADABINS_AREA = 448*448
 
 
 class DepthModel():
-    def __init__(self, device):
+    # Depth for 3D warping with one of depth_backends. MiDaS models can be blended with AdaBins
+    # (midas_weight < 1 and load_adabins()). Images are resized and normalized as tensors on the
+    # device, resolution overrides the inference resolution of the MiDaS model (0 keeps its default).
+    # Missing weights are downloaded, or copied from the mirror directory when they are there.
+    def __init__(self, device, backend='dpt_large', resolution=0, mirror=None):
+        assert backend in depth_backends, f"unknown depth backend {backend}, choose from {list(depth_backends)}"
         self.adabins_helper = None
         self.depth_min = 1000
         self.depth_max = -1000
         self.device = device
+        self.backend = backend
+        self.resolution = resolution
+        self.mirror = mirror
         self.midas_model = None
-        self.midas_transform = None
-    
+        self.midas_dtype = torch.float32
+
+    def load(self, models_path, half_precision=True):
+        if self.backend == 'adabins':
+            self.load_adabins()
+        elif self.backend != 'constant':
+            self.load_midas(models_path, half_precision)
+
     def load_adabins(self):
-        if not os.path.exists('pretrained/AdaBins_nyu.pt'):
-            print("Downloading AdaBins_nyu.pt...")
-            os.makedirs('pretrained', exist_ok=True)
-            wget("https://cloudflare-ipfs.com/ipfs/Qmd2mMnDLWePKmgfS8m6ntAg4nhV5VkUyAydYBp8cWWeB7/AdaBins_nyu.pt", 'pretrained')
+        fetch("https://cloudflare-ipfs.com/ipfs/Qmd2mMnDLWePKmgfS8m6ntAg4nhV5VkUyAydYBp8cWWeB7/AdaBins_nyu.pt", 'pretrained/AdaBins_nyu.pt', mirror=self.mirror)
         self.adabins_helper = InferenceHelper(dataset='nyu', device=self.device)
 
     def load_midas(self, models_path, half_precision=True):
-        if not os.path.exists(os.path.join(models_path, 'dpt_large-midas-2f21e586.pt')):
-            print("Downloading dpt_large-midas-2f21e586.pt...")
-            wget("https://github.com/intel-isl/DPT/releases/download/1_0/dpt_large-midas-2f21e586.pt", models_path)
-
-        self.midas_model = DPTDepthModel(
-            path=f"{models_path}/dpt_large-midas-2f21e586.pt",
-            backbone="vitl16_384",
-            non_negative=True,
-        )
-        normalization = NormalizeImage(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-
-        self.midas_transform = T.Compose([
-            Resize(
-                384, 384,
-                resize_target=None,
-                keep_aspect_ratio=True,
-                ensure_multiple_of=32,
-                resize_method="minimal",
-                image_interpolation_method=cv2.INTER_CUBIC,
-            ),
-            normalization,
-            PrepareForNet()
-        ])
+        spec = depth_backends[self.backend]
+        path = fetch(spec['url'], os.path.join(models_path, spec['file']), mirror=self.mirror)
+
+        if self.backend == 'midas_small':
+            self.midas_model = MidasNet_small(path, features=64, backbone=spec['backbone'], exportable=True, non_negative=True, blocks={'expand': True})
+        else:
+            self.midas_model = DPTDepthModel(path=path, backbone=spec['backbone'], non_negative=True)
 
-        self.midas_model.eval()    
-        if half_precision and self.device == torch.device("cuda"):
+        self.midas_model.eval()
+        if half_precision and torch.device(self.device).type == "cuda":
             self.midas_model = self.midas_model.to(memory_format=torch.channels_last)
             self.midas_model = self.midas_model.half()
+            self.midas_dtype = torch.float16
         self.midas_model.to(self.device)
 
     def predict(self, prev_img_cv2, anim_args) -> torch.Tensor:
-        w, h = prev_img_cv2.shape[1], prev_img_cv2.shape[0]
-
-        # predict depth with AdaBins    
-        use_adabins = anim_args.midas_weight < 1.0 and self.adabins_helper is not None
-        if use_adabins:
-            MAX_ADABINS_AREA = 500000
-            MIN_ADABINS_AREA = 448*448
-
-            # resize image if too large or too small
-            img_pil = Image.fromarray(cv2.cvtColor(prev_img_cv2.astype(np.uint8), cv2.COLOR_RGB2BGR))
-            image_pil_area = w*h
-            resized = True
-            if image_pil_area > MAX_ADABINS_AREA:
-                scale = math.sqrt(MAX_ADABINS_AREA) / math.sqrt(image_pil_area)
-                depth_input = img_pil.resize((int(w*scale), int(h*scale)), Image.LANCZOS) # LANCZOS is good for downsampling
-                print(f"  resized to {depth_input.width}x{depth_input.height}")
-            elif image_pil_area < MIN_ADABINS_AREA:
-                scale = math.sqrt(MIN_ADABINS_AREA) / math.sqrt(image_pil_area)
-                depth_input = img_pil.resize((int(w*scale), int(h*scale)), Image.BICUBIC)
-                print(f"  resized to {depth_input.width}x{depth_input.height}")
-            else:
-                depth_input = img_pil
-                resized = False
-
-            # predict depth and resize back to original dimensions
+        return self.predict_many([prev_img_cv2], anim_args)[0]
+
+    def predict_many(self, images, anim_args) -> torch.Tensor:
+        # images are RGB HWC arrays or tensors (0-255) of the same size, returns a (n, h, w) depth tensor
+        x = torch.stack([
+            image.to(self.device) if isinstance(image, torch.Tensor) else torch.as_tensor(np.ascontiguousarray(image)).to(self.device)
+            for image in images
+        ])
+        x = rearrange(x.float() / 255.0, 'b h w c -> b c h w')
+        n, _, h, w = x.shape
+
+        midas_depth = self.predict_midas(x) if self.midas_model is not None else None
+        adabins_depth = None
+        if self.adabins_helper is not None and (midas_depth is None or anim_args.midas_weight < 1.0):
             try:
-                with torch.no_grad():
-                    _, adabins_depth = self.adabins_helper.predict_pil(depth_input)
-                if resized:
-                    adabins_depth = TF.resize(
-                        torch.from_numpy(adabins_depth), 
-                        torch.Size([h, w]),
-                        interpolation=TF.InterpolationMode.BICUBIC
-                    )
-                adabins_depth = adabins_depth.squeeze()
-            except:
+                adabins_depth = self.predict_adabins(x)
+            except Exception:
                 print(f"  exception encountered, falling back to pure MiDaS")
-                use_adabins = False
-            torch.cuda.empty_cache()
-
-        if self.midas_model is not None:
-            # convert image from 0->255 uint8 to 0->1 float for feeding to MiDaS
-            img_midas = prev_img_cv2.astype(np.float32) / 255.0
-            img_midas_input = self.midas_transform({"image": img_midas})["image"]
-
-            # MiDaS depth estimation implementation
-            sample = torch.from_numpy(img_midas_input).float().to(self.device).unsqueeze(0)
-            if self.device == torch.device("cuda"):
-                sample = sample.to(memory_format=torch.channels_last)  
-                sample = sample.half()
-            with torch.no_grad():            
-                midas_depth = self.midas_model.forward(sample)
-            midas_depth = torch.nn.functional.interpolate(
-                midas_depth.unsqueeze(1),
-                size=img_midas.shape[:2],
-                mode="bicubic",
-                align_corners=False,
-            ).squeeze()
-            midas_depth = midas_depth.cpu().numpy()
-            torch.cuda.empty_cache()
-
-            # MiDaS makes the near values greater, and the far values lesser. Let's reverse that and try to align with AdaBins a bit better.
-            midas_depth = np.subtract(50.0, midas_depth)
-            midas_depth = midas_depth / 19.0
-
-            # blend between MiDaS and AdaBins predictions
-            if use_adabins:
-                depth_map = midas_depth*anim_args.midas_weight + adabins_depth*(1.0-anim_args.midas_weight)
-            else:
-                depth_map = midas_depth
-
-            depth_map = np.expand_dims(depth_map, axis=0)
-            depth_tensor = torch.from_numpy(depth_map).squeeze().to(self.device)
-        else:
-            depth_tensor = torch.ones((h, w), device=self.device)
-        
-        return depth_tensor
+
+        if midas_depth is not None and adabins_depth is not None:
+            return midas_depth*anim_args.midas_weight + adabins_depth*(1.0-anim_args.midas_weight)
+        if midas_depth is not None:
+            return midas_depth
+        if adabins_depth is not None:
+            return adabins_depth
+        return torch.ones((n, h, w), device=self.device)
+
+    def midas_size(self, h, w):
+        # keep the aspect ratio and scale as little as possible, in multiples of 32 like the MiDaS transform
+        resolution = self.resolution or depth_backends[self.backend]['resolution']
+        scale_h, scale_w = resolution / h, resolution / w
+        scale = scale_w if abs(1 - scale_w) < abs(1 - scale_h) else scale_h
+        return (max(32, int(round(h * scale / 32)) * 32), max(32, int(round(w * scale / 32)) * 32))
+
+    def predict_midas(self, x):
+        spec = depth_backends[self.backend]
+        h, w = x.shape[2:]
+        sample = F.interpolate(x, size=self.midas_size(h, w), mode='bicubic', align_corners=False)
+        sample = normalize(sample, spec['mean'], spec['std']).to(self.midas_dtype)
+        if self.midas_dtype == torch.float16:
+            sample = sample.to(memory_format=torch.channels_last)
+        with torch.no_grad():
+            midas_depth = self.midas_model.forward(sample)
+        midas_depth = F.interpolate(midas_depth.unsqueeze(1).float(), size=(h, w), mode='bicubic', align_corners=False).squeeze(1)
+
+        # MiDaS makes the near values greater, and the far values lesser. Let's reverse that and try to align with AdaBins a bit better.
+        return (50.0 - midas_depth) / 19.0
+
+    def predict_adabins(self, x):
+        h, w = x.shape[2:]
+
+        # resize image if too large or too small
+        area = w*h
+        sample = x
+        if area > MAX_ADABINS_AREA:
+            scale = math.sqrt(MAX_ADABINS_AREA) / math.sqrt(area)
+            sample = F.interpolate(x, size=(int(h*scale), int(w*scale)), mode='area')
+        elif area < MIN_ADABINS_AREA:
+            scale = math.sqrt(MIN_ADABINS_AREA) / math.sqrt(area)
+            sample = F.interpolate(x, size=(int(h*scale), int(w*scale)), mode='bicubic', align_corners=False)
+
+        # channels swapped to BGR, as AdaBins has always been fed here
+        sample = normalize(sample.flip(1), ADABINS_MEAN, ADABINS_STD)
+        depths = []
+        with torch.no_grad():
+            for i in range(sample.shape[0]):
+                _, adabins_depth = self.adabins_helper.predict(sample[i:i+1])
+                adabins_depth = torch.as_tensor(adabins_depth, device=self.device).float()
+                depths.append(adabins_depth.reshape(1, 1, *adabins_depth.shape[-2:]))
+        adabins_depth = torch.cat(depths)
+        if adabins_depth.shape[-2:] != (h, w):
+            adabins_depth = F.interpolate(adabins_depth, size=(h, w), mode='bicubic', align_corners=False)
+        return adabins_depth.squeeze(1)
 
     def save(self, filename: str, depth: torch.Tensor):
         depth = depth.cpu().numpy()
@@ -152,5 +178,10 @@ class DepthModel():
         denom = max(1e-8, self.depth_max - self.depth_min)
         temp = rearrange((depth - self.depth_min) / denom * 255, 'c h w -> h w c')
         temp = repeat(temp, 'h w 1 -> h w c', c=3)
-        Image.fromarray(temp.astype(np.uint8)).save(filename)    
+        Image.fromarray(temp.astype(np.uint8)).save(filename)
+
 
+def normalize(x, mean, std):
+    mean = torch.tensor(mean, device=x.device, dtype=x.dtype).view(1, 3, 1, 1)
+    std = torch.tensor(std, device=x.device, dtype=x.dtype).view(1, 3, 1, 1)
+    return (x - mean) / std
@@ -0,0 +1,123 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+class FrameWriter():
+    # Encodes and saves animation frames on a small pool of background threads so that
+    # PNG compression of frame N overlaps with diffusion of frame N+1.
+    # At most max_pending frames are kept in flight, submit() blocks once that many are queued.
+    # With threads=0 every write happens synchronously on the caller's thread.
+    # on_saved is called with the path of every frame once it is on disk. Exceptions raised by
+    # a write or by on_saved are re-raised on the render thread at the next submit() or close().
+    # With an encoder (a VideoEncoder) every frame is also streamed into the video in the order it
+    # was saved, and save_frames=False skips the PNGs altogether. on_saved is then called on the
+    # render thread once the frame is in the video, with the path the PNG would have had.
+    # close() also closes the encoder.
+    def __init__(self, threads=2, max_pending=None, on_saved=None, encoder=None, save_frames=True):
+        self.threads = max(0, int(threads))
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='frame_writer') if self.threads > 0 else None
+        self.max_pending = max_pending or max(1, self.threads * 2)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.on_saved = on_saved
+        self.encoder = encoder
+        self.save_frames = save_frames or encoder is None
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def _write(self, fn, args, path):
+        fn(*args)
+        if self.on_saved is not None and path is not None:
+            self.on_saved(path)
+
+    def _run(self, fn, args, path):
+        try:
+            self._write(fn, args, path)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.slots.release()
+
+    def _raise_errors(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def submit(self, fn, *args, path=None):
+        self._raise_errors()
+        if self.executor is None:
+            self._write(fn, args, path)
+            return
+        self.slots.acquire()
+        self.executor.submit(self._run, fn, args, path)
+
+    def _streamed(self, path):
+        # a frame that only went into the video
+        self._raise_errors()
+        if self.on_saved is not None:
+            self.on_saved(path)
+
+    def save_image(self, image, path):
+        # image is a PIL.Image as returned by generate()
+        if self.encoder is not None:
+            self.encoder.write(image)
+        if self.save_frames:
+            self.submit(image.save, path, path=path)
+        else:
+            self._streamed(path)
+
+    def save_cv2(self, img, path):
+        # img is an RGB float or uint8 HWC array, converted on the worker thread
+        if self.encoder is not None:
+            self.encoder.write(img)
+        if self.save_frames:
+            self.submit(_write_cv2, img, path, path=path)
+        else:
+            self._streamed(path)
+
+    def save_tween(self, prev_img, next_img, tween, path):
+        # blends two turbo frames on the worker thread, prev_img may be None
+        if self.encoder is not None:
+            self.encoder.write_tween(prev_img, next_img, tween)
+        if self.save_frames:
+            self.submit(_write_tween, prev_img, next_img, tween, path, path=path)
+        else:
+            self._streamed(path)
+
+    def wait(self):
+        # block until every queued frame has been written
+        if self.executor is not None:
+            for _ in range(self.max_pending):
+                self.slots.acquire()
+            for _ in range(self.max_pending):
+                self.slots.release()
+        self._raise_errors()
+
+    def close(self, raise_errors=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.encoder is not None:
+            try:
+                self.encoder.close(raise_errors=raise_errors)
+            finally:
+                self.encoder = None
+        if raise_errors:
+            self._raise_errors()
+
+
+def _write_cv2(img, path):
+    cv2.imwrite(path, cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR))
+
+def _write_tween(prev_img, next_img, tween, path):
+    if prev_img is not None and tween < 1.0:
+        img = prev_img*(1.0-tween) + next_img*tween
+    else:
+        img = next_img
+    _write_cv2(img, path)
@@ -1,16 +1,32 @@
 from typing import Any, Callable, Optional
+import numpy as np
 import torch
 from k_diffusion.external import CompVisDenoiser
 from k_diffusion import sampling
+from ldm.models.diffusion.guidance import GuidanceSchedule
 from torch import nn
 
         
 class CFGDenoiser(nn.Module):
-    def __init__(self, model):
+    # with a guidance schedule the scale of every call is looked up by where its sigma lies in the
+    # full schedule sigmas, calls without guidance only run the conditional pass
+    def __init__(self, model, guidance=None, sigmas=None):
         super().__init__()
         self.inner_model = model
+        self.guidance = guidance
+        if guidance is not None:
+            self.sigmas = sigmas.cpu().numpy()
+
+    def progress(self, sigma):
+        # sigmas decrease, samplers like heun also call the model between two of them
+        sigma = sigma.reshape(-1)[0].item()
+        return np.interp(-sigma, -self.sigmas, np.arange(len(self.sigmas))) / (len(self.sigmas) - 1)
 
     def forward(self, x, sigma, uncond, cond, cond_scale):
+        if self.guidance is not None:
+            cond_scale = self.guidance(self.progress(sigma))
+        if uncond is None or cond_scale is None or cond_scale == 1.0:
+            return self.inner_model(x, sigma, cond=cond)
         x_in = torch.cat([x] * 2)
         sigma_in = torch.cat([sigma] * 2)
         cond_in = torch.cat([uncond, cond])
@@ -30,27 +46,32 @@ def sampler_fn(
     if not torch.cuda.is_available()
     else torch.device("cuda"),
     cb: Callable[[Any], None] = None,
+    noise: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
     shape = [args.C, args.H // args.f, args.W // args.f]
     sigmas: torch.Tensor = model_wrap.get_sigmas(args.steps)
+    guidance = GuidanceSchedule.from_args(args)
+    cfg_denoiser = CFGDenoiser(model_wrap) if guidance.constant else CFGDenoiser(model_wrap, guidance, sigmas)
     sigmas = sigmas[len(sigmas) - t_enc - 1 :]
     sigma_min, sigma_max = model_wrap.sigmas[0].item(), model_wrap.sigmas[-1].item()
+    if noise is None and len(sigmas) > 0:
+        noise = torch.randn([args.n_samples, *shape], device=device)
     if args.use_init:
         if len(sigmas) > 0:
             x = (
                 init_latent
-                + torch.randn([args.n_samples, *shape], device=device) * sigmas[0]
+                + noise * sigmas[0]
             )
         else:
             x = init_latent
     else:
         if len(sigmas) > 0:
-            x = torch.randn([args.n_samples, *shape], device=device) * sigmas[0]
+            x = noise * sigmas[0]
         else:
             x = torch.zeros([args.n_samples, *shape], device=device)
     if args.sampler in ["klms","dpm2","dpm2_ancestral","heun","euler","euler_ancestral","dpm3_ancestral"]:        
         sampler_args = {
-            "model": CFGDenoiser(model_wrap),
+            "model": cfg_denoiser,
             "x": x,
             "sigmas": sigmas,
             "extra_args": {"cond": c, "uncond": uc, "cond_scale": args.scale},
@@ -59,7 +80,7 @@ def sampler_fn(
         }
     if args.sampler in ["dpm_adaptive"]:
         sampler_args = {
-            "model": CFGDenoiser(model_wrap),
+            "model": cfg_denoiser,
             "x": x,
             "sigma_min": sigma_min,
             "sigma_max" : sigma_max,
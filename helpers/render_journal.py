@@ -0,0 +1,113 @@
+import json, os, random, threading
+
+import numpy as np
+import torch
+
+
+class RenderJournal():
+    # Crash safe record of an animation run, so that a resumed run continues exactly where the
+    # last one stopped instead of re-deriving its state from the last PNG in the output folder.
+    # {timestring}_journal.jsonl gets a line for every frame once it is on disk and one for every
+    # snapshot, each one flushed and fsync'd before it counts. A snapshot is the state carried
+    # from one frame to the next (previous sample or latent, color match references, turbo frames,
+    # seed and random states), written atomically to {timestring}_state.pt every interval frames.
+    # interval=0 only journals frames. On resume the frame lines tell which frames are still on
+    # disk: a snapshot is only used when every frame it recorded as saved is.
+    def __init__(self, outdir, timestring, interval=10):
+        self.timestring = timestring
+        self.path = os.path.join(outdir, f"{timestring}_journal.jsonl")
+        self.state_path = os.path.join(outdir, f"{timestring}_state.pt")
+        self.interval = int(interval)
+        self.last_snapshot = 0
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _append(self, entry):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def frame_saved(self, path):
+        # on_saved callback of a FrameWriter, called from its threads
+        name = os.path.basename(path)
+        self._append({'frame': int(os.path.splitext(name)[0].rsplit('_', 1)[-1]), 'file': name})
+
+    def _entries(self):
+        # the journal lines written so far, a line torn by a crash is skipped
+        entries = []
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        pass
+        return entries
+
+    def frames_on_disk(self):
+        # number of frames from frame 0 on that the journal recorded and that are still on disk
+        folder = os.path.dirname(self.path)
+        saved = {entry['frame'] for entry in self._entries()
+                 if 'frame' in entry and os.path.exists(os.path.join(folder, entry.get('file', f"{self.timestring}_{entry['frame']:05}.png")))}
+        frames = 0
+        while frames in saved:
+            frames += 1
+        return frames
+
+    def due(self, frame_idx):
+        return self.interval > 0 and frame_idx - self.last_snapshot >= self.interval
+
+    def snapshot(self, frame_idx, state, saved=None):
+        # state is what the render loop needs to continue at frame_idx, saved is the number of frames
+        # it has saved so far (frame_idx by default), those must already be on disk. With cadence the
+        # in-between frames before frame_idx are only saved after it is diffused, so fewer are.
+        state = dict(state, frame_idx=frame_idx, random_state=random.getstate(), numpy_state=np.random.get_state(), torch_state=torch.get_rng_state())
+        if torch.cuda.is_available():
+            state['cuda_state'] = torch.cuda.get_rng_state_all()
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+        self._append({'snapshot': frame_idx, 'saved': frame_idx if saved is None else int(saved)})
+        self.last_snapshot = frame_idx
+
+    def resume(self, device):
+        # the state of the last snapshot with the random states restored, None without one or
+        # when frames before it are missing from disk
+        snapshots = [entry for entry in self._entries() if 'snapshot' in entry]
+        if not snapshots or not os.path.exists(self.state_path):
+            return None
+        frames = self.frames_on_disk()
+        if snapshots[-1].get('saved', snapshots[-1]['snapshot']) > frames:
+            print(f"Frame {frames} is missing, the snapshot at frame {snapshots[-1]['snapshot']} can't be used")
+            return None
+        try:
+            state = torch.load(self.state_path, map_location=device, weights_only=False)
+        except TypeError:
+            state = torch.load(self.state_path, map_location=device)
+        random.setstate(state.pop('random_state'))
+        np.random.set_state(state.pop('numpy_state'))
+        torch.set_rng_state(state.pop('torch_state').cpu())
+        if 'cuda_state' in state:
+            cuda_state = state.pop('cuda_state')
+            if torch.cuda.is_available():
+                torch.cuda.set_rng_state_all([s.cpu() for s in cuda_state])
+        self.last_snapshot = state['frame_idx']
+        return state
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,318 @@
+import itertools, json, os, queue, socketserver, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Predictor():
+    # Same split as the replicate Predictor: setup() is called once when the server starts and
+    # keeps the model, depth model and text encoder resident, predict() renders a single job.
+    # Jobs run one at a time on the server's worker thread. Everything a job needs is passed to
+    # render(args_dict, anim_args_dict, prompts, animation_prompts, on_saved): the default
+    # settings overridden by the job's, its prompts (or the default ones) and job.frame_saved,
+    # so nothing but the resident models is shared between jobs.
+    def __init__(self, render, args_dict=None, anim_args_dict=None, prompts=None, animation_prompts=None):
+        self.render = render
+        self.args_dict = dict(args_dict or {})
+        self.anim_args_dict = dict(anim_args_dict or {})
+        self.prompts = prompts
+        self.animation_prompts = animation_prompts
+
+    def setup(self):
+        pass
+
+    def predict(self, job):
+        args_dict = {**self.args_dict, **job.args, 'outdir': job.outdir}
+        anim_args_dict = {**self.anim_args_dict, **job.anim_args}
+        prompts = job.prompts or self.prompts
+        # JSON object keys are strings
+        animation_prompts = {int(k): v for k, v in (job.animation_prompts or self.animation_prompts or {}).items()}
+        self.render(args_dict, anim_args_dict, prompts, animation_prompts, on_saved=job.frame_saved)
+
+
+def frame_index(path, default):
+    # frames are saved as {timestring}_{index:05}[_...].png
+    try:
+        return int(os.path.splitext(os.path.basename(path))[0].split('_')[1])
+    except (IndexError, ValueError):
+        return default
+
+
+class RenderJob():
+    def __init__(self, args, anim_args, prompts=None, animation_prompts=None, priority=0, outdir=""):
+        self.id = uuid.uuid4().hex[:12]
+        self.args = args
+        self.anim_args = anim_args
+        self.prompts = prompts
+        self.animation_prompts = animation_prompts
+        self.priority = priority
+        self.outdir = os.path.join(outdir, self.id)
+        self.status = 'queued'
+        self.error = None
+        self.frames = {}  # frame index -> path
+        self.saved = []  # frame indices in the order they were saved, the cursor of wait_for_frames()
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.changed = threading.Condition()
+
+    def cancel(self):
+        with self.changed:
+            self.cancelled.set()
+            if self.status == 'queued':
+                self._set_status('cancelled')
+
+    def start(self):
+        # marks a queued job running, under the same lock as cancel() so a job cancelled after it
+        # was dequeued is never started. Returns False for a cancelled job
+        with self.changed:
+            if self.cancelled.is_set():
+                if self.status == 'queued':
+                    self._set_status('cancelled')
+                return False
+            self._set_status('running')
+            return True
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"job {self.id} was cancelled")
+
+    def frame_saved(self, path):
+        # hooked up as FrameWriter.on_saved, so cancellation takes effect at the next saved frame
+        with self.changed:
+            index = frame_index(path, len(self.saved))
+            self.frames[index] = path
+            self.saved.append(index)
+            self.changed.notify_all()
+        self.check_cancelled()
+
+    def wait_for_frames(self, after, timeout):
+        # long-poll until more than `after` frames were saved or the job is over, returns the
+        # indices of the frames saved after the first `after` in frame order
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.saved) > after or self.done, timeout)
+            return sorted(self.saved[after:])
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def _set_status(self, status, error=None):
+        with self.changed:
+            self.status = status
+            self.error = error
+            if status == 'running':
+                self.started = time.time()
+            elif self.done:
+                self.finished = time.time()
+            self.changed.notify_all()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'priority': self.priority,
+            'frames': len(self.frames),
+            'error': self.error,
+            'outdir': self.outdir,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class RenderServer():
+    # Long-lived render daemon: a single worker thread pops jobs from a priority queue (higher
+    # priority first, FIFO within a priority) and hands them to predictor.predict, while a small
+    # HTTP API accepts jobs, reports status, cancels and streams finished frames.
+    #
+    #   POST   /jobs                        {"args": {...}, "anim_args": {...}, "prompts": [...],
+    #                                        "animation_prompts": {...}, "priority": 0}
+    #   GET    /jobs                        status of every job
+    #   GET    /jobs/<id>                   status of one job
+    #   DELETE /jobs/<id>                   cancel a queued or running job
+    #   GET    /jobs/<id>/frames?after=N&wait=S
+    #                                       index and name of the frames saved after the first N
+    #                                       (in frame order), waits up to S seconds. next is the N
+    #                                       of the following poll
+    #   GET    /jobs/<id>/frames/<n>        PNG bytes of frame n
+    #
+    # Finished jobs are kept for their status and frames until more than keep_finished of them
+    # have piled up, then the oldest are forgotten (their output folders stay on disk).
+    def __init__(self, predictor, outdir, keep_finished=100):
+        self.predictor = predictor
+        self.outdir = outdir
+        self.keep_finished = keep_finished
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.worker = None
+
+    def submit(self, args, anim_args, prompts=None, animation_prompts=None, priority=0):
+        job = RenderJob(args, anim_args, prompts, animation_prompts, priority, self.outdir)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.queue.put((-priority, next(self.order), job))
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def all_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        job.cancel()
+        self._evict()
+        return job
+
+    def _evict(self):
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.done), key=lambda job: job.finished)
+            for job in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self.jobs[job.id]
+
+    def start(self):
+        if self.worker is None:
+            self.predictor.setup()
+            self.worker = threading.Thread(target=self._work, name='render_worker', daemon=True)
+            self.worker.start()
+
+    def _work(self):
+        while True:
+            _, _, job = self.queue.get()
+            if not job.start():
+                continue
+            try:
+                os.makedirs(job.outdir, exist_ok=True)
+                self.predictor.predict(job)
+                job.check_cancelled()
+                job._set_status('done')
+            except JobCancelled:
+                job._set_status('cancelled')
+            except Exception as e:
+                print(f"render job {job.id} failed: {e!r}")
+                job._set_status('failed', repr(e))
+            self._evict()
+
+    def serve(self, address):
+        # address is "host:port" for TCP or "unix:/path/to.sock" for a Unix domain socket
+        self.start()
+        if address.startswith('unix:'):
+            path = address[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)
+            httpd = _UnixHTTPServer(path, _make_handler(self))
+        else:
+            host, port = address.rsplit(':', 1)
+            httpd = ThreadingHTTPServer((host, int(port)), _make_handler(self))
+        print(f"Render server listening on {address}")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self):
+            # unix sockets have no peer address
+            return str(self.client_address or 'unix')
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, obj, code=200):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _job(self, parts):
+            job = server.get(parts[1]) if len(parts) > 1 else None
+            if job is None:
+                self._send_json({'error': 'no such job'}, 404)
+            return job
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split('/') if p]
+            if parts == ['jobs']:
+                return self._send_json([job.to_dict() for job in server.all_jobs()])
+            if not parts or parts[0] != 'jobs':
+                return self._send_json({'error': 'not found'}, 404)
+            job = self._job(parts)
+            if job is None:
+                return
+            if len(parts) == 2:
+                return self._send_json(job.to_dict())
+            if len(parts) == 3 and parts[2] == 'frames':
+                query = parse_qs(url.query)
+                after = int(query.get('after', ['0'])[0])
+                wait = float(query.get('wait', ['0'])[0])
+                indices = job.wait_for_frames(after, wait)
+                return self._send_json({
+                    'status': job.status,
+                    'after': after,
+                    'next': after + len(indices),
+                    'frames': [{'index': i, 'name': os.path.basename(job.frames[i])} for i in indices],
+                })
+            if len(parts) == 4 and parts[2] == 'frames':
+                path = job.frames.get(int(parts[3]))
+                if path is None:
+                    return self._send_json({'error': 'no such frame'}, 404)
+                if not os.path.exists(path):
+                    # frames of jobs with save_frames off only went into the video
+                    return self._send_json({'error': 'frame was not saved as an image'}, 404)
+                with open(path, 'rb') as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self._send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/jobs':
+                return self._send_json({'error': 'not found'}, 404)
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError as e:
+                return self._send_json({'error': f'invalid json: {e}'}, 400)
+            job = server.submit(
+                request.get('args', {}),
+                request.get('anim_args', {}),
+                prompts=request.get('prompts'),
+                animation_prompts=request.get('animation_prompts'),
+                priority=int(request.get('priority', 0)),
+            )
+            self._send_json(job.to_dict(), 201)
+
+        def do_DELETE(self):
+            parts = [p for p in urlparse(self.path).path.split('/') if p]
+            if len(parts) != 2 or parts[0] != 'jobs':
+                return self._send_json({'error': 'not found'}, 404)
+            job = self._job(parts)
+            if job is None:
+                return
+            server.cancel(job.id)
+            self._send_json(job.to_dict())
+
+    return Handler
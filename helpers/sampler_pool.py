@@ -0,0 +1,51 @@
+from k_diffusion.external import CompVisDenoiser
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+
+
+class SamplerPool():
+    # Samplers and k-diffusion model wrappers shared by every generate() call, instead of new ones
+    # for every frame. A sampler keeps each of its schedules once it has been built (per steps, eta,
+    # discretization and device), the wrapper keeps the sigmas for every number of steps.
+    # Everything belongs to one model, getting a sampler for another model clears the pool.
+    def __init__(self):
+        self.model = None
+        self.samplers = {}
+        self.model_wrap = None
+
+    def clear(self):
+        self.model = None
+        self.samplers = {}
+        self.model_wrap = None
+
+    def _use(self, model):
+        if self.model is not model:
+            self.clear()
+            self.model = model
+
+    def get_sampler(self, model, name):
+        # the ddim or plms sampler of model, make_schedule() is cheap for schedules it built before
+        self._use(model)
+        key = 'plms' if name == 'plms' else 'ddim'
+        if key not in self.samplers:
+            self.samplers[key] = PLMSSampler(model) if key == 'plms' else DDIMSampler(model)
+        return self.samplers[key]
+
+    def get_model_wrap(self, model):
+        self._use(model)
+        if self.model_wrap is None:
+            self.model_wrap = CachedCompVisDenoiser(model)
+        return self.model_wrap
+
+
+class CachedCompVisDenoiser(CompVisDenoiser):
+    # get_sigmas() computes the sigmas for a number of steps only once, callers slice but never
+    # modify the returned tensor
+    def __init__(self, model, *args, **kwargs):
+        super().__init__(model, *args, **kwargs)
+        self.sigmas_cache = {}
+
+    def get_sigmas(self, n=None):
+        if n not in self.sigmas_cache:
+            self.sigmas_cache[n] = super().get_sigmas(n)
+        return self.sigmas_cache[n]
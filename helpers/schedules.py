@@ -0,0 +1,84 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# because math functions (i.e. sin(t)) can utilize brackets
+# it extracts the value in form of some stuff
+# which has previously been enclosed with brackets and
+# with a comma or end of line existing after the closing one
+KEY_FRAME_PATTERN = re.compile(r'((?P<frame>[0-9]+):[\s]*\((?P<param>[\S\s]*?)\)([,][\s]?|[\s]?$))')
+NUMBER_PATTERN = re.compile(r'^(?=.)([+-]?([0-9]*)(\.([0-9]+))?)$')
+
+
+@lru_cache(maxsize=None)
+def _parse_key_frames(string):
+    return tuple(
+        (int(match_object.group('frame')), match_object.group('param'))
+        for match_object in KEY_FRAME_PATTERN.finditer(string)
+    )
+
+
+def parse_key_frames(string, prompt_parser=None):
+    # "0: (1.0), 50: (sin(t))" -> {0: '1.0', 50: 'sin(t)'}, every distinct string is only parsed once
+    frames = dict(_parse_key_frames(string))
+    if frames == {} and len(string) != 0:
+        raise RuntimeError('Key Frame string not correctly formatted')
+    if prompt_parser:
+        frames = {frame: prompt_parser(param) for frame, param in frames.items()}
+    return frames
+
+
+def get_inbetweens(key_frames, max_frames, integer=False, interp_method='Linear'):
+    # Expands key frames to one value per frame as a float64 array, the dtype of the pandas Series it
+    # replaced (values like strength feed int() arithmetic that float32 rounding would shift).
+    # A number is a key point for the interpolation, a math expression of t is evaluated for every
+    # frame from its key frame up to the next one, over all of those frames in a single call.
+    frames = np.arange(max_frames)
+    values = np.full(max_frames, np.nan)
+
+    keys = sorted(frame for frame in key_frames if 0 <= frame < max_frames)
+    for n, key in enumerate(keys):
+        value = key_frames[key]
+        if NUMBER_PATTERN.match(value):
+            values[key] = float(value)
+        else:
+            import numexpr
+            end = keys[n + 1] if n + 1 < len(keys) else max_frames
+            values[key:end] = numexpr.evaluate(value, local_dict={'t': frames[key:end]})
+
+    known = ~np.isnan(values)
+    if not known.any():
+        raise RuntimeError('Key Frame string has no key frames within max_frames')
+
+    if interp_method == 'Cubic' and len(key_frames.items()) <= 3:
+        interp_method = 'Quadratic'
+    if interp_method == 'Quadratic' and len(key_frames.items()) <= 2:
+        interp_method = 'Linear'
+
+    values[0] = values[np.argmax(known)]
+    values[-1] = values[max_frames - 1 - np.argmax(known[::-1])]
+    known = ~np.isnan(values)
+    if interp_method == 'Linear':
+        values = np.interp(frames, frames[known], values[known])
+    else:
+        from scipy.interpolate import interp1d
+        values = interp1d(frames[known], values[known], kind=interp_method.lower())(frames)
+
+    if integer:
+        return values.astype(int)
+    return values
+
+
+def get_prompt_series(prompts, max_frames):
+    # one prompt per frame: the prompt of the last key frame at or before it,
+    # frames before the first key frame use the first prompt
+    key_frames = sorted((int(frame), prompt) for frame, prompt in prompts.items())
+    series = []
+    n, prompt = 0, key_frames[0][1]
+    for frame in range(max_frames):
+        while n < len(key_frames) and key_frames[n][0] <= frame:
+            prompt = key_frames[n][1]
+            n += 1
+        series.append(prompt)
+    return series
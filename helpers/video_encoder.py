@@ -0,0 +1,114 @@
+import queue, subprocess, tempfile, threading
+
+import numpy as np
+
+
+class VideoEncoder():
+    # Streams frames into an ffmpeg process as they are rendered, so the mp4 is done together with
+    # the last frame instead of re-reading and decoding a PNG sequence afterwards.
+    # Frames are converted to rgb24 and piped to ffmpeg's stdin on a background thread, in the
+    # order they were written. At most max_pending frames are queued, write() blocks after that.
+    # The video size is taken from the first frame. Errors are re-raised at the next write() or close().
+    def __init__(self, path, fps, crf=17, preset='veryfast', max_pending=8, ffmpeg='ffmpeg'):
+        self.path = path
+        self.fps = fps
+        self.crf = crf
+        self.preset = preset
+        self.ffmpeg = ffmpeg
+        self.process = None
+        self.log = None
+        self.size = None
+        self.frames = 0
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._run, name='video_encoder', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def _open(self, width, height):
+        self.size = (width, height)
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen([
+            self.ffmpeg,
+            '-y',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-s', f'{width}x{height}',
+            '-r', str(self.fps),
+            '-i', '-',
+            '-c:v', 'libx264',
+            '-pix_fmt', 'yuv420p',
+            '-crf', str(self.crf),
+            '-preset', self.preset,
+            self.path
+        ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                fn, args = item
+                frame = fn(*args)
+                if self.process is None:
+                    self._open(frame.shape[1], frame.shape[0])
+                if (frame.shape[1], frame.shape[0]) != self.size:
+                    raise ValueError(f"frame size {frame.shape[1]}x{frame.shape[0]} doesn't match the video size {self.size[0]}x{self.size[1]}")
+                self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+                self.frames += 1
+            except Exception as e:
+                self.error = e
+
+    def _raise_errors(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, frame):
+        # frame is a PIL.Image or an RGB float or uint8 HWC array
+        self._raise_errors()
+        self.queue.put((_to_rgb24, (frame,)))
+
+    def write_tween(self, prev_img, next_img, tween):
+        # blends two turbo frames on the encoder thread, prev_img may be None
+        self._raise_errors()
+        self.queue.put((_tween_rgb24, (prev_img, next_img, tween)))
+
+    def close(self, raise_errors=True):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.process is not None:
+            self.process.stdin.close()
+            returncode = self.process.wait()
+            self.process = None
+            self.log.seek(0)
+            log = self.log.read().decode('utf-8', errors='replace')
+            self.log.close()
+            if returncode != 0 and self.error is None:
+                self.error = RuntimeError(f"ffmpeg exited with {returncode} writing {self.path}\n{log}")
+        if raise_errors:
+            self._raise_errors()
+
+
+def _to_rgb24(frame):
+    if not isinstance(frame, np.ndarray):
+        frame = np.asarray(frame.convert('RGB'))
+    if frame.dtype != np.uint8:
+        frame = np.clip(frame, 0, 255).astype(np.uint8)
+    return frame
+
+def _tween_rgb24(prev_img, next_img, tween):
+    if prev_img is not None and tween < 1.0:
+        return _to_rgb24(prev_img*(1.0-tween) + next_img*tween)
+    return _to_rgb24(next_img)
@@ -0,0 +1,107 @@
+import os, queue, threading
+
+import cv2
+
+
+class VideoFrameSource():
+    # Decodes the frames of an input video on demand instead of extracting them to JPEGs first.
+    # Every nth frame of the video is a frame of the source, the ones in between are only grabbed.
+    # Frames are resized once to size (W, H) and returned as RGB uint8 HWC arrays.
+    # A background thread decodes up to prefetch frames ahead of the last one read, reading
+    # forwards is sequential and going back (e.g. when resuming) restarts the reader with a seek.
+    def __init__(self, path, n=1, size=None, prefetch=8):
+        assert os.path.exists(path), f"Video input {path} does not exist"
+        self.path = path
+        self.n = max(1, int(n))
+        self.size = tuple(size) if size is not None else None
+        self.prefetch = prefetch
+        self.frames = None
+        self.stop = None
+        self.thread = None
+        self.next_index = 0
+
+        video = cv2.VideoCapture(path)
+        count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if count <= 0:
+            # no frame count in the container, count them without converting any
+            count = 0
+            while video.grab():
+                count += 1
+        video.release()
+        self.length = (count + self.n - 1) // self.n
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.get(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, index):
+        if index < 0 or index >= self.length:
+            raise IndexError(f"frame {index} is out of range for {self.length} frames of {self.path}")
+        if self.thread is None or index < self.next_index:
+            self._start(index)
+        while True:
+            item = self.frames.get()
+            if item is None:
+                self.close()
+                raise IndexError(f"{self.path} ended before frame {index}")
+            if isinstance(item, Exception):
+                self.close()
+                raise item
+            current = self.next_index
+            self.next_index += 1
+            if current == index:
+                return item
+
+    def close(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def _start(self, index):
+        self.close()
+        self.frames = queue.Queue(self.prefetch)
+        self.stop = threading.Event()
+        self.next_index = index
+        self.thread = threading.Thread(target=self._read, args=(index, self.frames, self.stop), name='video_source', daemon=True)
+        self.thread.start()
+
+    def _read(self, index, frames, stop):
+        video = cv2.VideoCapture(self.path)
+        try:
+            if index > 0:
+                video.set(cv2.CAP_PROP_POS_FRAMES, index * self.n)
+            while not stop.is_set():
+                success, frame = video.read()
+                if not success:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                if self.size is not None and (frame.shape[1], frame.shape[0]) != self.size:
+                    frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_LANCZOS4)
+                _put(frames, stop, frame)
+                for _ in range(self.n - 1):
+                    if not video.grab():
+                        break
+        except Exception as e:
+            _put(frames, stop, e)
+        finally:
+            video.release()
+            _put(frames, stop, None)
+
+
+def _put(frames, stop, item):
+    # gives up once the reader was stopped, so a full queue never blocks close()
+    while not stop.is_set():
+        try:
+            frames.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
@@ -0,0 +1,68 @@
+import math
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+
+
+# 3D animation warp without pytorch3d. The math is that of two FoVPerspectiveCameras, one at
+# the origin and one moved by (R, T), projecting every pixel lifted to (x, y, depth): points are
+# rows, moved as p @ R + T, and only the projected x, y are used, so near/far don't matter.
+
+def euler_angles_to_matrix(angles, device=None):
+    # same as pytorch3d's euler_angles_to_matrix(angles, "XYZ"), angles in radians
+    cx, cy, cz = (math.cos(a) for a in angles)
+    sx, sy, sz = (math.sin(a) for a in angles)
+    r_x = torch.tensor([[1., 0., 0.], [0., cx, -sx], [0., sx, cx]])
+    r_y = torch.tensor([[cy, 0., sy], [0., 1., 0.], [-sy, 0., cy]])
+    r_z = torch.tensor([[cz, -sz, 0.], [sz, cz, 0.], [0., 0., 1.]])
+    return (r_x @ r_y @ r_z).to(device)
+
+@lru_cache(maxsize=16)
+def pixel_grids(w, h, device):
+    # (h*w, 2) pixel positions in [-1, 1] with the corners on the edge pixels, and the identity
+    # grid_sample grid (align_corners=False) the offsets are applied to
+    y, x = torch.meshgrid(torch.linspace(-1., 1., h, device=device), torch.linspace(-1., 1., w, device=device), indexing='ij')
+    xy = torch.stack((x.flatten(), y.flatten()), dim=1)
+    identity = F.affine_grid(torch.tensor([[[1., 0., 0.], [0., 1., 0.]]], device=device), [1, 1, h, w], align_corners=False)
+    return xy, identity
+
+@lru_cache(maxsize=16)
+def projection_scale(w, h, fov, device):
+    # x and y entries of the FoV perspective projection matrix
+    tan_half_fov = math.tan(math.radians(fov) / 2)
+    aspect_ratio = float(w) / float(h)
+    return torch.tensor([1. / (tan_half_fov * aspect_ratio), 1. / tan_half_fov], device=device)
+
+def reproject(depth, rot_mat, translate, fov):
+    # grid_sample grid that moves every pixel of a frame with this depth by the camera motion,
+    # and the depth of every pixel as seen from the moved camera
+    h, w = depth.shape[-2:]
+    device = depth.device
+    xy, identity = pixel_grids(w, h, device)
+    scale = projection_scale(w, h, float(fov), device)
+
+    z = depth.reshape(-1, 1).float()
+    xyz = torch.cat((xy, z), dim=1)
+    xyz_new = xyz @ rot_mat.to(device).float().reshape(3, 3) + torch.as_tensor(translate, dtype=torch.float32, device=device)
+
+    offset_xy = xyz_new[:, :2] / xyz_new[:, 2:] * scale - xy / z * scale
+    grid = identity - offset_xy.reshape(1, h, w, 2)
+    return grid, xyz_new[:, 2].reshape(h, w)
+
+def warp_images_3d(images, depth, rot_mat, translate, anim_args):
+    # images is a (n, c, h, w) batch that shares depth and camera motion, e.g. both turbo frames
+    grid, _ = reproject(depth, rot_mat, translate, anim_args.fov)
+    return F.grid_sample(
+        images,
+        grid.expand(images.shape[0], -1, -1, -1),
+        mode=anim_args.sampling_mode,
+        padding_mode=anim_args.padding_mode,
+        align_corners=False
+    )
+
+def warp_depth_3d(depth, rot_mat, translate, anim_args):
+    # moves a depth map along with the frame it was predicted for
+    grid, depth_new = reproject(depth, rot_mat, translate, anim_args.fov)
+    warped = F.grid_sample(depth_new[None, None], grid, mode='bilinear', padding_mode='border', align_corners=False)
+    return warped.squeeze().to(depth.dtype)
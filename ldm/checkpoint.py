@@ -0,0 +1,237 @@
+import json, os, struct
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from ldm.download import file_sha256, record_sha256, recorded_sha256
+
+
+# Stable Diffusion .ckpt files are 4-7 GB pickles that torch.load reads completely into memory
+# (in float32 for most of them) before anything is converted. The first load of a checkpoint
+# writes a sidecar next to it in the safetensors layout: an 8 byte little endian header size, a
+# JSON header with the dtype, shape and byte range of every tensor, and the raw tensor data.
+# Later loads map the sidecar into memory, tensors are views of the file that are only read
+# when they are copied into the model, already in the dtype the model runs in.
+
+# weights of the three models of a LatentDiffusion checkpoint, stored together in the sidecar
+sections = {
+    'unet': 'model.diffusion_model.',
+    'vae': 'first_stage_model.',
+    'text_encoder': 'cond_stage_model.',
+}
+
+_dtypes = {
+    'F64': (torch.float64, np.float64),
+    'F32': (torch.float32, np.float32),
+    'F16': (torch.float16, np.float16),
+    'BF16': (torch.bfloat16, np.int16),
+    'I64': (torch.int64, np.int64),
+    'I32': (torch.int32, np.int32),
+    'I16': (torch.int16, np.int16),
+    'I8': (torch.int8, np.int8),
+    'U8': (torch.uint8, np.uint8),
+    'BOOL': (torch.bool, np.bool_),
+}
+_dtype_names = {torch_dtype: name for name, (torch_dtype, _) in _dtypes.items()}
+
+
+def sidecar_path(ckpt_path, dtype=torch.float16):
+    base, _ = os.path.splitext(ckpt_path)
+    return f"{base}.{'fp16' if dtype == torch.float16 else 'fp32'}.safetensors"
+
+
+def checkpoint_sha256(ckpt_path):
+    # the sha256 of a checkpoint, taken from its record or from a sidecar built from this exact
+    # file when there is one
+    sha256 = recorded_sha256(ckpt_path)
+    for dtype in (torch.float16, torch.float32):
+        path = sidecar_path(ckpt_path, dtype)
+        if sha256 is None and os.path.exists(path):
+            metadata = read_header(path)[0]
+            if _is_current(metadata, ckpt_path) and metadata.get('sha256'):
+                sha256 = metadata['sha256']
+                record_sha256(ckpt_path, sha256)
+    return sha256 or file_sha256(ckpt_path)
+
+
+def section_of(key):
+    for name, prefix in sections.items():
+        if key.startswith(prefix):
+            return name
+    return 'other'
+
+
+def save_file(tensors, path, metadata=None):
+    # tensors are written largest element size first, in the order given otherwise, so every one
+    # starts aligned to its dtype. The file is renamed into place when it is complete
+    tensors = dict(sorted(tensors.items(), key=lambda item: -item[1].element_size()))
+    header = {}
+    offset = 0
+    for key, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        header[key] = {'dtype': _dtype_names[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = {k: str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for tensor in tensors.values():
+            tensor = tensor.detach().contiguous().cpu()
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size))
+    return header.pop('__metadata__', {}), header, 8 + size
+
+
+def load_file(path, sections=None):
+    # memory maps the file, tensors are cpu views of it. sections limits which weights are returned
+    metadata, header, data_start = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for key, info in header.items():
+        if sections is not None and section_of(key) not in sections:
+            continue
+        torch_dtype, np_dtype = _dtypes[info['dtype']]
+        start, end = info['data_offsets']
+        array = data[data_start + start:data_start + end].view(np_dtype).reshape(info['shape'])
+        tensor = torch.from_numpy(array)
+        state_dict[key] = tensor.view(torch.bfloat16) if info['dtype'] == 'BF16' else tensor
+    return state_dict, metadata
+
+
+def convert_checkpoint(ckpt_path, path=None, dtype=torch.float16, sha256=None):
+    # writes the sidecar of a .ckpt. Model weights are converted to dtype and grouped by section,
+    # other floating point tensors (schedule buffers) keep theirs and the EMA copy is dropped
+    path = path or sidecar_path(ckpt_path, dtype)
+    print(f"Converting {ckpt_path} to {path}")
+    pl_sd = _torch_load(ckpt_path)
+    sd = pl_sd.get('state_dict', pl_sd)
+    order = list(sections) + ['other']
+    keys = sorted((k for k in sd if not k.startswith('model_ema.')), key=lambda k: order.index(section_of(k)))
+    tensors = {}
+    for key in keys:
+        tensor = sd[key]
+        if not isinstance(tensor, torch.Tensor):
+            continue
+        if tensor.is_floating_point() and section_of(key) != 'other':
+            tensor = tensor.to(dtype)
+        tensors[key] = tensor
+    stat = os.stat(ckpt_path)
+    metadata = {'source_size': stat.st_size, 'source_mtime': int(stat.st_mtime)}
+    if 'global_step' in pl_sd:
+        metadata['global_step'] = pl_sd['global_step']
+    if sha256:
+        metadata['sha256'] = sha256
+    save_file(tensors, path, metadata)
+    del pl_sd, sd
+    return path
+
+
+def load_checkpoint(ckpt_path, half_precision=True, sha256=None, cache=True):
+    # returns (state_dict, metadata) of a .ckpt or .safetensors file. A .ckpt is converted to a
+    # float16 (float32 without half_precision) sidecar first, unless cache is off or the
+    # directory isn't writable, in which case it is loaded with torch.load as before
+    if ckpt_path.endswith('.safetensors'):
+        return load_file(ckpt_path)
+    dtype = torch.float16 if half_precision else torch.float32
+    path = sidecar_path(ckpt_path, dtype)
+    if cache and not (os.path.exists(path) and _is_current(read_header(path)[0], ckpt_path)):
+        try:
+            convert_checkpoint(ckpt_path, path, dtype, sha256)
+        except OSError as e:
+            print(f"Could not write {path} ({e}), loading {ckpt_path} directly")
+            cache = False
+    if not cache:
+        pl_sd = _torch_load(ckpt_path)
+        metadata = {'global_step': pl_sd['global_step']} if 'global_step' in pl_sd else {}
+        return pl_sd.get('state_dict', pl_sd), metadata
+    return load_file(path)
+
+
+def _is_current(metadata, ckpt_path):
+    # a sidecar is rebuilt when the checkpoint it was made from changes
+    stat = os.stat(ckpt_path)
+    return metadata.get('source_size') == str(stat.st_size) and metadata.get('source_mtime') == str(int(stat.st_mtime))
+
+
+def _torch_load(ckpt_path):
+    # recent versions of torch can map zip checkpoints instead of reading them
+    try:
+        return torch.load(ckpt_path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(ckpt_path, map_location='cpu')
+
+
+_random_inits = ['uniform_', 'normal_', 'trunc_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'xavier_uniform_', 'xavier_normal_', 'orthogonal_']
+_missing = object()
+_reset_modules = [nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.ConvTranspose2d, nn.Embedding, nn.GroupNorm, nn.LayerNorm]
+
+
+@contextmanager
+def no_init_weights():
+    # Modules built inside are allocated but not initialized, for models whose weights all come
+    # from a checkpoint: the random initializers of torch layers are skipped, and the CLIP text
+    # model is created from its config instead of downloading and loading the pretrained weights
+    # the checkpoint replaces anyway. Only weights that are in the checkpoint may be used after.
+    patches = []
+    def patch(obj, name, value):
+        patches.append((obj, name, obj.__dict__.get(name, _missing)))
+        setattr(obj, name, value)
+
+    for name in _random_inits:
+        patch(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    for module in _reset_modules:
+        patch(module, 'reset_parameters', lambda self: None)
+    patch(nn.MultiheadAttention, '_reset_parameters', lambda self: None)
+    try:
+        from transformers import CLIPTextConfig, CLIPTextModel
+        from transformers.models.clip.modeling_clip import CLIPPreTrainedModel
+        patch(CLIPPreTrainedModel, '_init_weights', lambda self, module: None)
+        patch(CLIPTextModel, 'from_pretrained', classmethod(lambda cls, name, *args, **kwargs: cls(CLIPTextConfig.from_pretrained(name))))
+    except ImportError:
+        pass
+    try:
+        yield
+    finally:
+        for obj, name, value in reversed(patches):
+            if value is _missing:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, value)
+
+
+def load_weights(model, state_dict, device, dtype):
+    # like model.load_state_dict(state_dict, strict=False), but the parameters and buffers are
+    # replaced by the checkpoint tensors moved to device (floating point ones converted to dtype)
+    # instead of copied into the existing ones, so nothing is allocated twice. Returns the missing
+    # and unexpected keys
+    tensors = dict(model.named_parameters())
+    tensors.update(model.named_buffers())
+    unexpected = []
+    for key, value in state_dict.items():
+        if key not in tensors:
+            unexpected.append(key)
+            continue
+        tensor = tensors.pop(key)
+        if tensor.shape != value.shape:
+            raise RuntimeError(f"size mismatch for {key}: copying a param with shape {tuple(value.shape)} from checkpoint, the shape in current model is {tuple(tensor.shape)}")
+        with torch.no_grad():
+            tensor.data = value.to(device, dtype if value.is_floating_point() else value.dtype)
+    # parameters and buffers the checkpoint doesn't have
+    model.to(device)
+    model.to(dtype)
+    return list(tensors), unexpected
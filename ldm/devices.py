@@ -0,0 +1,56 @@
+import os
+
+import torch
+
+
+def get_device(name="auto"):
+    # "auto" picks cuda when it is available and falls back to the cpu
+    if name == "auto":
+        name = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(name)
+    if device.type == "cuda" and not torch.cuda.is_available():
+        raise RuntimeError("cuda was requested but no cuda device is available")
+    return device
+
+
+def get_dtype(device, half_precision=True):
+    # half precision is float16 on cuda and bfloat16 on the cpu, where most float16 kernels are missing
+    if not half_precision:
+        return torch.float32
+    return torch.float16 if torch.device(device).type == "cuda" else torch.bfloat16
+
+
+def free_memory(device):
+    # bytes that can still be allocated on device, used to size attention slices
+    device = torch.device(device)
+    if device.type == "cuda":
+        stats = torch.cuda.memory_stats(device)
+        mem_active = stats['active_bytes.all.current']
+        mem_reserved = stats['reserved_bytes.all.current']
+        mem_free_cuda, _ = torch.cuda.mem_get_info(device)
+        mem_free_torch = mem_reserved - mem_active
+        return mem_free_cuda + mem_free_torch
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def empty_cache(device=None):
+    if (device is None or torch.device(device).type == "cuda") and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def set_cpu_threads(threads=0):
+    # intra-op parallelism for cpu inference, 0 uses every core
+    threads = int(threads) or os.cpu_count() or 1
+    torch.set_num_threads(threads)
+    return threads
+
+
+def describe(device):
+    device = torch.device(device)
+    if device.type == "cuda":
+        return str(torch.cuda.get_device_properties(device))
+    return f"cpu ({torch.get_num_threads()} threads)"
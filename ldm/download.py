@@ -0,0 +1,131 @@
+import hashlib, json, os
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from tqdm import tqdm
+
+
+# Model downloads stream into <path>.part in chunks and are hashed while they are written, an
+# interrupted download continues from the end of the .part file with an HTTP range request.
+# The sha256 of a finished or verified file is recorded in <path>.sha256 together with its size
+# and mtime, so later starts don't hash multi-GB checkpoints again.
+
+CHUNK_SIZE = 8*1024*1024
+
+
+def sha256_record_path(path):
+    return path + '.sha256'
+
+
+def recorded_sha256(path):
+    # the recorded sha256 of path, None when there is no record or the file changed since
+    try:
+        with open(sha256_record_path(path)) as f:
+            record = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if record.get('size') != stat.st_size or record.get('mtime') != stat.st_mtime_ns:
+        return None
+    return record.get('sha256')
+
+
+def record_sha256(path, sha256):
+    stat = os.stat(path)
+    try:
+        with open(sha256_record_path(path), 'w') as f:
+            json.dump({'sha256': sha256, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}, f)
+    except OSError as e:
+        print(f"Could not record the sha256 of {path} ({e})")
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE, cache=True):
+    # hashes the file in chunks instead of reading all of it into memory, or returns the recorded hash
+    sha256 = recorded_sha256(path) if cache else None
+    if sha256 is not None:
+        return sha256
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    sha256 = hasher.hexdigest()
+    if cache:
+        record_sha256(path, sha256)
+    return sha256
+
+
+def fetch(url, path, sha256=None, mirror=None, chunk_size=CHUNK_SIZE, auth=None):
+    # Downloads url to path unless it exists, and returns path. A file of the same name in the
+    # mirror directory is copied instead of downloading it. With sha256 the finished file is
+    # checked, and a download that doesn't match is deleted and raises a ValueError.
+    # auth is a (username, token) pair sent in an Authorization header, never put credentials in
+    # the url: it ends up in error messages.
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    part_path = path + '.part'
+    name = os.path.basename(path)
+
+    mirror_path = os.path.join(mirror, name) if mirror else None
+    if mirror_path and os.path.exists(mirror_path):
+        print(f"Copying {name} from {mirror}")
+        with open(mirror_path, 'rb') as src:
+            digest = _write(src, part_path, hashlib.sha256(), 0, os.path.getsize(mirror_path), chunk_size, name)
+    else:
+        digest = _download(url, part_path, chunk_size, name, auth)
+
+    if sha256 is not None and digest != sha256:
+        os.remove(part_path)
+        raise ValueError(f"sha256 of {name} is {digest}, expected {sha256}")
+    os.replace(part_path, path)
+    record_sha256(path, digest)
+    return path
+
+
+def _public_url(url):
+    # url without user and password, for messages
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(netloc=parts.hostname + (f':{parts.port}' if parts.port else ''))) if parts.hostname else url
+
+
+def _download(url, part_path, chunk_size, name, auth=None):
+    # continues a .part file left by an earlier attempt, its bytes are hashed first
+    hasher = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hasher.update(chunk)
+                offset += len(chunk)
+
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with requests.get(url, headers=headers, auth=auth, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # the .part file is already complete
+            return hasher.hexdigest()
+        public_url = _public_url(url)
+        if response.status_code == 403:
+            raise ConnectionRefusedError(f"Access to {public_url} was refused, you may have to accept the license of this model.")
+        elif response.status_code == 404:
+            raise ConnectionError(f"{public_url} was not found")
+        elif response.status_code not in (200, 206):
+            raise ConnectionError(f"Downloading {public_url} failed with response code {response.status_code}")
+        if offset and response.status_code == 200:
+            # the server ignored the range, start over
+            print(f"Restarting the download of {name}")
+            hasher, offset = hashlib.sha256(), 0
+        else:
+            print(f"Resuming the download of {name} at {offset} bytes" if offset else f"Downloading {name}")
+        total = int(response.headers.get('Content-Length', 0)) + offset or None
+        return _write(response.raw, part_path, hasher, offset, total, chunk_size, name)
+
+
+def _write(src, part_path, hasher, offset, total, chunk_size, name):
+    if hasattr(src, 'decode_content'):
+        src.decode_content = True
+    with open(part_path, 'ab' if offset else 'wb') as f, tqdm(total=total, initial=offset, unit='B', unit_scale=True, desc=name) as progress:
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            f.write(chunk)
+            hasher.update(chunk)
+            progress.update(len(chunk))
+    return hasher.hexdigest()
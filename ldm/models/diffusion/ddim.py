@@ -10,20 +10,35 @@ from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, mak
     extract_into_tensor
 
 
+schedule_attributes = ['ddim_timesteps', 'betas', 'alphas_cumprod', 'alphas_cumprod_prev', 'sqrt_alphas_cumprod',
+                       'sqrt_one_minus_alphas_cumprod', 'log_one_minus_alphas_cumprod', 'sqrt_recip_alphas_cumprod',
+                       'sqrt_recipm1_alphas_cumprod', 'ddim_sigmas', 'ddim_alphas', 'ddim_alphas_prev',
+                       'ddim_sqrt_one_minus_alphas', 'ddim_sigmas_for_original_num_steps', 'ddim_coefficients']
+
+
 class DDIMSampler(object):
     def __init__(self, model, schedule="linear", **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.schedules = {}
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        # every schedule is built once per sampler, reusing the sampler reuses its schedules
+        key = (ddim_num_steps, ddim_discretize, float(ddim_eta), self.model.device)
+        if key not in self.schedules:
+            self.build_schedule(ddim_num_steps, ddim_discretize, ddim_eta, verbose)
+            self.schedules[key] = {name: self.__dict__[name] for name in schedule_attributes}
+        self.__dict__.update(self.schedules[key])
+
+    def build_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
@@ -54,6 +69,12 @@ class DDIMSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        # a_t, a_prev, sigma_t and sqrt(1 - a_t) of every step as (1, 1, 1) tensors on the device,
+        # so a step doesn't read them back from the device to fill new tensors
+        coefficients = [ddim_alphas, ddim_alphas_prev, ddim_sigmas, np.sqrt(1. - ddim_alphas)]
+        coefficients = torch.stack([torch.as_tensor(np.asarray(c.cpu() if isinstance(c, torch.Tensor) else c), dtype=torch.float32) for c in coefficients])
+        self.register_buffer('ddim_coefficients', coefficients.reshape(4, -1, 1, 1, 1))
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -77,6 +98,7 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               guidance_schedule=None,
                **kwargs
                ):
         if conditioning is not None:
@@ -108,6 +130,7 @@ class DDIMSampler(object):
                                                     log_every_t=log_every_t,
                                                     unconditional_guidance_scale=unconditional_guidance_scale,
                                                     unconditional_conditioning=unconditional_conditioning,
+                                                    guidance_schedule=guidance_schedule,
                                                     )
         return samples, intermediates
 
@@ -117,7 +140,7 @@ class DDIMSampler(object):
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_schedule=None):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
@@ -152,7 +175,8 @@ class DDIMSampler(object):
                                       noise_dropout=noise_dropout, score_corrector=score_corrector,
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning)
+                                      unconditional_conditioning=unconditional_conditioning,
+                                      guidance_schedule=guidance_schedule)
             img, pred_x0 = outs
             if callback: callback(i)
             if img_callback: img_callback(img, i)
@@ -166,10 +190,14 @@ class DDIMSampler(object):
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_schedule=None):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+        if guidance_schedule is not None and not use_original_steps:
+            # the scale of this step in the whole schedule, None skips the unconditional pass
+            unconditional_guidance_scale = guidance_schedule(1. - (index + 1) / len(self.ddim_timesteps))
+
+        if unconditional_conditioning is None or unconditional_guidance_scale is None or unconditional_guidance_scale == 1.:
             e_t = self.model.apply_model(x, t, c)
         else:
             x_in = torch.cat([x] * 2)
@@ -187,10 +215,13 @@ class DDIMSampler(object):
         sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
         sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        if use_original_steps:
+            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
+            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
+            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
+            sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        else:
+            a_t, a_prev, sigma_t, sqrt_one_minus_at = self.ddim_coefficients[:, index]
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
@@ -222,7 +253,7 @@ class DDIMSampler(object):
 
     @torch.no_grad()
     def decode(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               use_original_steps=False, img_callback=None):
+               use_original_steps=False, img_callback=None, guidance_schedule=None):
 
         timesteps = np.arange(self.ddpm_num_timesteps) if use_original_steps else self.ddim_timesteps
         timesteps = timesteps[:t_start]
@@ -239,7 +270,8 @@ class DDIMSampler(object):
             ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
             x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
                                           unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+                                          unconditional_conditioning=unconditional_conditioning,
+                                          guidance_schedule=guidance_schedule)
 
             if img_callback: img_callback(x_dec, i)
 
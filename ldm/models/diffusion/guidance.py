@@ -0,0 +1,25 @@
+class GuidanceSchedule(object):
+    # Classifier free guidance scale over the steps of a sampling schedule. progress is the position
+    # of a step in the full schedule, 0 for the first (noisiest) step up to 1. The scale moves
+    # linearly from scale to scale_end, and from cutoff on guidance is dropped altogether: those
+    # late steps only run the conditional pass, which halves their UNet batch.
+    # Calling the schedule returns the scale of a step, None for a conditional only step.
+    def __init__(self, scale, scale_end=None, cutoff=1.0):
+        self.scale = float(scale)
+        self.scale_end = self.scale if scale_end is None else float(scale_end)
+        self.cutoff = float(cutoff)
+
+    @classmethod
+    def from_args(cls, args):
+        # args.scale_end <= 0 keeps args.scale for every step, args without the options guide every step
+        scale_end = getattr(args, 'scale_end', 0)
+        return cls(args.scale, scale_end if scale_end and scale_end > 0 else None, getattr(args, 'cfg_cutoff', 1.0))
+
+    @property
+    def constant(self):
+        return self.scale_end == self.scale and self.cutoff >= 1.0
+
+    def __call__(self, progress):
+        if progress >= self.cutoff:
+            return None
+        return self.scale + (self.scale_end - self.scale) * progress
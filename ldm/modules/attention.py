@@ -1,4 +1,5 @@
 import gc
+from functools import partial
 from inspect import isfunction
 import math
 import torch
@@ -6,6 +7,7 @@ import torch.nn.functional as F
 from torch import nn, einsum
 from einops import rearrange, repeat
 
+from ldm.devices import free_memory
 from ldm.modules.diffusionmodules.util import checkpoint
 
 
@@ -78,6 +80,195 @@ def Normalize(in_channels):
     return torch.nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
 
+# attention backends
+# Every backend takes q (B, N, D), k (B, M, D), v (B, M, Dv) and the softmax scale and returns
+# softmax(q k^T * scale) v as (B, N, Dv). CrossAttention and AttnBlock pick up the backend that is
+# selected when they are constructed, so call set_attention_backend() before instantiating a model.
+def sliced_attention(q, k, v, scale):
+    # full score matrix, computed in as many query slices as needed to fit in free memory
+    r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+
+    mem_free_total = free_memory(q.device)
+
+    gb = 1024 ** 3
+    tensor_size = q.shape[0] * q.shape[1] * k.shape[1] * 4
+    mem_required = tensor_size * 2.5
+    steps = 1
+
+    if mem_required > mem_free_total:
+        steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
+
+    if steps > 64:
+        max_res = math.floor(math.sqrt(math.sqrt(mem_free_total / 2.5)) / 8) * 64
+        raise RuntimeError(f'Not enough memory, use lower resolution (max approx. {max_res}x{max_res}). '
+                           f'Need: {mem_required/64/gb:0.1f}GB free, Have:{mem_free_total/gb:0.1f}GB free')
+
+    slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
+    for i in range(0, q.shape[1], slice_size):
+        end = i + slice_size
+        s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * scale
+
+        s2 = s1.softmax(dim=-1)
+        del s1
+
+        r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
+        del s2
+
+    return r1
+
+
+def sdpa_attention(q, k, v, scale):
+    # fused kernel from torch >= 2.0 (flash / memory efficient attention where available)
+    if scale != q.shape[-1] ** -0.5:
+        # older versions of scaled_dot_product_attention have no scale argument
+        q = q * (scale * q.shape[-1] ** 0.5)
+    return F.scaled_dot_product_attention(q, k, v)
+
+
+def chunked_attention(q, k, v, scale, query_chunk_size=1024, key_chunk_size=4096):
+    # online softmax over key chunks, only a query_chunk_size x key_chunk_size block of scores
+    # exists at any time, so memory grows linearly with the number of tokens
+    out = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    for i in range(0, q.shape[1], query_chunk_size):
+        q_chunk = q[:, i:i + query_chunk_size] * scale
+        row_max = None
+        for j in range(0, k.shape[1], key_chunk_size):
+            s = torch.bmm(q_chunk, k[:, j:j + key_chunk_size].transpose(1, 2)).float()
+            chunk_max = s.amax(dim=-1, keepdim=True)
+            if row_max is None:
+                new_max = chunk_max
+            else:
+                new_max = torch.maximum(row_max, chunk_max)
+            p = torch.exp(s - new_max)
+            del s
+            values = torch.bmm(p.to(v.dtype), v[:, j:j + key_chunk_size]).float()
+            if row_max is None:
+                row_sum = p.sum(dim=-1, keepdim=True)
+                acc = values
+            else:
+                correction = torch.exp(row_max - new_max)
+                row_sum = row_sum * correction + p.sum(dim=-1, keepdim=True)
+                acc = acc * correction + values
+            row_max = new_max
+            del p, values
+        out[:, i:i + query_chunk_size] = (acc / row_sum).to(out.dtype)
+    return out
+
+
+attention_backends = {
+    'sliced': sliced_attention,
+    'sdpa': sdpa_attention,
+    'chunked': chunked_attention,
+}
+
+_attention_backend = 'sliced'
+
+
+def set_attention_backend(name):
+    # 'auto' uses torch's fused kernel when this torch version has one and sliced attention otherwise
+    global _attention_backend
+    if name == 'auto':
+        name = 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'sliced'
+    assert name in attention_backends, f'attention backend {name} unknown, choose from {list(attention_backends)}'
+    if name == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+        raise RuntimeError('the sdpa attention backend needs torch >= 2.0')
+    _attention_backend = name
+    return name
+
+
+def get_attention_backend():
+    return attention_backends[_attention_backend]
+
+
+# token merging
+# Neighbouring latent positions are often nearly identical, so a transformer block can merge the
+# most similar tokens before its self attention and feed forward and copy the results back to
+# every merged token after (bipartite soft matching, Bolya et al., "Token Merging for Fast Stable
+# Diffusion"). The ratio is the share of tokens merged away, set per downsample level of the
+# UNet (1 is the full latent resolution, where attention costs the most). Unlike the attention
+# backend it is read on every forward pass, so it can change between generations.
+_token_merging = {}
+
+
+def set_token_merging(ratio=0.0, max_downsample=1):
+    # ratio is a number for every level up to max_downsample or a dict {downsample: ratio},
+    # 0 turns merging off. At most 3 of every 2x2 tokens can be merged into the fourth
+    global _token_merging
+    ratios = ratio if isinstance(ratio, dict) else {ds: ratio for ds in (1, 2, 4, 8) if ds <= max_downsample}
+    for ds, r in ratios.items():
+        assert 0 <= r < 1, f'token merging ratio {r} for downsample {ds} must be in [0, 1)'
+    _token_merging = {int(ds): float(r) for ds, r in ratios.items() if r > 0}
+    return dict(_token_merging)
+
+
+def get_token_merging(downsample):
+    return _token_merging.get(downsample, 0.0)
+
+
+def bipartite_soft_matching(metric, h, w, ratio, sx=2, sy=2):
+    # Splits the h*w tokens of metric (B, h*w, C) into destinations, the top left token of every
+    # sy x sx cell, and sources, the others. The ratio*h*w sources that are most similar (cosine)
+    # to a destination are merged into it. Returns merge(x), which averages x (B, h*w, C') down to
+    # the remaining tokens, and unmerge(x), which maps merged tokens back to all h*w positions
+    B, N, _ = metric.shape
+    hsy, wsx = h // sy, w // sx
+    num_dst = hsy * wsx
+    r = min(int(N * ratio), N - num_dst)
+    if r <= 0:
+        return (lambda x: x), (lambda x: x)
+
+    with torch.no_grad():
+        # -1 marks the destinations, so sorting puts them first
+        idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+        idx_buffer[:hsy * sy:sy, :wsx * sx:sx] = -1
+        order = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        a_idx = order[:, num_dst:, :]  # sources
+        b_idx = order[:, :num_dst, :]  # destinations
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        del scores
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:, :]  # sources that stay
+        src_idx = edge_idx[:, :r, :]  # sources that are merged
+        dst_idx = torch.gather(node_idx[..., None], dim=1, index=src_idx)
+        unm_len = N - num_dst - r
+        # positions of the kept and merged sources in the full token order
+        unm_pos = torch.gather(a_idx.expand(B, N - num_dst, 1), dim=1, index=unm_idx)
+        src_pos = torch.gather(a_idx.expand(B, N - num_dst, 1), dim=1, index=src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        C = x.shape[-1]
+        unm = torch.gather(src, dim=1, index=unm_idx.expand(B, unm_len, C))
+        src = torch.gather(src, dim=1, index=src_idx.expand(B, r, C))
+        # mean of every destination and the sources merged into it (scatter_add works on old torch)
+        counts = torch.ones(B, num_dst, 1, device=x.device, dtype=x.dtype)
+        counts = counts.scatter_add(1, dst_idx, torch.ones(B, r, 1, device=x.device, dtype=x.dtype))
+        dst = dst.scatter_add(1, dst_idx.expand(B, r, C), src) / counts
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        C = x.shape[-1]
+        unm, dst = x[:, :unm_len, :], x[:, unm_len:, :]
+        src = torch.gather(dst, dim=1, index=dst_idx.expand(B, r, C))
+        out = torch.empty(B, N, C, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=1, index=b_idx.expand(B, num_dst, C), src=dst)
+        out.scatter_(dim=1, index=unm_pos.expand(B, unm_len, C), src=unm)
+        out.scatter_(dim=1, index=src_pos.expand(B, r, C), src=src)
+        return out
+
+    return merge, unmerge
+
+
 class LinearAttention(nn.Module):
     def __init__(self, dim, heads=4, dim_head=32):
         super().__init__()
@@ -167,6 +358,7 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
+        self.attention = get_attention_backend()
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
@@ -180,40 +372,7 @@ class CrossAttention(nn.Module):
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q_in, k_in, v_in))
         del q_in, k_in, v_in
 
-        r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device)
-
-        stats = torch.cuda.memory_stats(q.device)
-        mem_active = stats['active_bytes.all.current']
-        mem_reserved = stats['reserved_bytes.all.current']
-        mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-        mem_free_torch = mem_reserved - mem_active
-        mem_free_total = mem_free_cuda + mem_free_torch
-
-        gb = 1024 ** 3
-        tensor_size = q.shape[0] * q.shape[1] * k.shape[1] * 4
-        mem_required = tensor_size * 2.5
-        steps = 1
-
-        if mem_required > mem_free_total:
-            steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
-            # print(f"Expected tensor size:{tensor_size/gb:0.1f}GB, cuda free:{mem_free_cuda/gb:0.1f}GB "
-            #       f"torch free:{mem_free_torch/gb:0.1f} total:{mem_free_total/gb:0.1f} steps:{steps}")
-
-        if steps > 64:
-            max_res = math.floor(math.sqrt(math.sqrt(mem_free_total / 2.5)) / 8) * 64
-            raise RuntimeError(f'Not enough memory, use lower resolution (max approx. {max_res}x{max_res}). '
-                               f'Need: {mem_required/64/gb:0.1f}GB free, Have:{mem_free_total/gb:0.1f}GB free')
-
-        slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
-        for i in range(0, q.shape[1], slice_size):
-            end = i + slice_size
-            s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * self.scale
-
-            s2 = s1.softmax(dim=-1)
-            del s1
-
-            r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
-            del s2
+        r1 = self.attention(q, k, v, self.scale)
 
         del q, k, v
 
@@ -235,13 +394,22 @@ class BasicTransformerBlock(nn.Module):
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
 
-    def forward(self, x, context=None):
-        return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
-
-    def _forward(self, x, context=None):
-        x = self.attn1(self.norm1(x)) + x
+    def forward(self, x, context=None, merging=None):
+        return checkpoint(partial(self._forward, merging=merging), (x, context), self.parameters(), self.checkpoint)
+
+    def _forward(self, x, context=None, merging=None):
+        # merging is (h, w, ratio) of the token grid to merge tokens of for attn1 and ff
+        if merging is None:
+            x = self.attn1(self.norm1(x)) + x
+            x = self.attn2(self.norm2(x), context=context) + x
+            x = self.ff(self.norm3(x)) + x
+            return x
+        x_norm = self.norm1(x)
+        merge, unmerge = bipartite_soft_matching(x_norm, *merging)
+        x = unmerge(self.attn1(merge(x_norm))) + x
+        del x_norm
         x = self.attn2(self.norm2(x), context=context) + x
-        x = self.ff(self.norm3(x)) + x
+        x = unmerge(self.ff(merge(self.norm3(x)))) + x
         return x
 
 
@@ -252,11 +420,13 @@ class SpatialTransformer(nn.Module):
     and reshape to b, t, d.
     Then apply standard transformer action.
     Finally, reshape to image
+    downsample is the resolution level of the block in the UNet, for token merging
     """
     def __init__(self, in_channels, n_heads, d_head,
-                 depth=1, dropout=0., context_dim=None):
+                 depth=1, dropout=0., context_dim=None, downsample=1):
         super().__init__()
         self.in_channels = in_channels
+        self.downsample = downsample
         inner_dim = n_heads * d_head
         self.norm = Normalize(in_channels)
 
@@ -284,8 +454,10 @@ class SpatialTransformer(nn.Module):
         x = self.norm(x)
         x = self.proj_in(x)
         x = rearrange(x, 'b c h w -> b (h w) c')
+        ratio = get_token_merging(self.downsample)
+        merging = (h, w, ratio) if ratio > 0 else None
         for block in self.transformer_blocks:
-            x = block(x, context=context)
+            x = block(x, context=context, merging=merging)
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
         return x + x_in
\ No newline at end of file
@@ -0,0 +1,47 @@
+from contextlib import contextmanager
+
+
+class FeatureCache():
+    # Deep UNet features reused between adjacent sampler steps (Ma et al., "DeepCache"). The high
+    # level features of the UNet change slowly from one step to the next, so only every interval-th
+    # UNet evaluation is a full one. It keeps the input of output_blocks[-(branch + 1)], everything
+    # below it in the UNet. The evaluations in between only run input_blocks[:branch + 1] and
+    # output_blocks[-(branch + 1):] on top of the kept features. branch=0 skips the most.
+    # Evaluations are counted, for samplers that call the model twice per step (heun, dpm2) the
+    # interval counts calls. An input of another shape (e.g. a step without guidance) always
+    # evaluates the full UNet.
+    def __init__(self, interval=3, branch=0):
+        self.interval = int(interval)
+        self.branch = int(branch)
+        self.reset()
+
+    def reset(self):
+        self.features = None
+        self.shape = None
+        self.calls = 0
+
+    def cheap_step(self, x):
+        # whether the evaluation of x can reuse the kept features, counts the evaluation
+        cheap = self.features is not None and self.calls % self.interval != 0 and x.shape == self.shape
+        self.calls += 1
+        return cheap
+
+    def store(self, features, x):
+        self.features = features
+        self.shape = x.shape
+
+
+@contextmanager
+def feature_caching(model, interval=3, branch=0):
+    # caches deep features of the UNet of model (a LatentDiffusion or UNetModel) for the sampling
+    # runs inside, yields the FeatureCache or None for interval <= 1, which evaluates every step
+    unet = getattr(getattr(model, 'model', None), 'diffusion_model', model)
+    if interval <= 1:
+        yield None
+        return
+    assert 0 <= branch < len(unet.input_blocks), f'feature cache branch must be in [0, {len(unet.input_blocks)})'
+    unet.feature_cache = FeatureCache(interval, branch)
+    try:
+        yield unet.feature_cache
+    finally:
+        unet.feature_cache = None
@@ -6,8 +6,9 @@ import torch.nn as nn
 import numpy as np
 from einops import rearrange
 
+from ldm.devices import empty_cache
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, get_attention_backend
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -186,6 +187,7 @@ class AttnBlock(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        self.attention = get_attention_backend()
 
     def forward(self, x):
         h_ = x
@@ -197,50 +199,16 @@ class AttnBlock(nn.Module):
         # compute attention
         b, c, h, w = q1.shape
 
-        q2 = q1.reshape(b, c, h*w)
+        q = q1.reshape(b, c, h*w).permute(0, 2, 1)   # b,hw,c
         del q1
-
-        q = q2.permute(0, 2, 1)   # b,hw,c
-        del q2
-
-        k = k1.reshape(b, c, h*w) # b,c,hw
+        k = k1.reshape(b, c, h*w).permute(0, 2, 1)   # b,hw,c
         del k1
+        v = v.reshape(b, c, h*w).permute(0, 2, 1)    # b,hw,c
 
-        h_ = torch.zeros_like(k, device=q.device)
-
-        stats = torch.cuda.memory_stats(q.device)
-        mem_active = stats['active_bytes.all.current']
-        mem_reserved = stats['reserved_bytes.all.current']
-        mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-        mem_free_torch = mem_reserved - mem_active
-        mem_free_total = mem_free_cuda + mem_free_torch
-
-        tensor_size = q.shape[0] * q.shape[1] * k.shape[2] * 4
-        mem_required = tensor_size * 2.5
-        steps = 1
-
-        if mem_required > mem_free_total:
-            steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
-
-        slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
-        for i in range(0, q.shape[1], slice_size):
-            end = i + slice_size
-
-            w1 = torch.bmm(q[:, i:end], k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-            w2 = w1 * (int(c)**(-0.5))
-            del w1
-            w3 = torch.nn.functional.softmax(w2, dim=2)
-            del w2
-
-            # attend to values
-            v1 = v.reshape(b, c, h*w)
-            w4 = w3.permute(0, 2, 1)   # b,hw,hw (first hw of k, second of q)
-            del w3
-
-            h_[:, :, i:end] = torch.bmm(v1, w4)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-            del v1, w4
+        h_ = self.attention(q, k, v, int(c)**(-0.5))  # b,hw,c
+        del q, k, v
 
-        h2 = h_.reshape(b, c, h, w)
+        h2 = h_.permute(0, 2, 1).reshape(b, c, h, w)
         del h_
 
         h3 = self.proj_out(h2)
@@ -603,7 +571,7 @@ class Decoder(nn.Module):
 
         # prepare for up sampling
         gc.collect()
-        torch.cuda.empty_cache()
+        empty_cache(h.device)
 
         # upsampling
         for i_level in reversed(range(self.num_resolutions)):
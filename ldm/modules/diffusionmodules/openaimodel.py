@@ -502,6 +502,8 @@ class UNetModel(nn.Module):
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
         self.predict_codebook_ids = n_embed is not None
+        # set by feature_caching() to reuse deep features between sampler steps
+        self.feature_cache = None
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -555,7 +557,7 @@ class UNetModel(nn.Module):
                             num_head_channels=dim_head,
                             use_new_attention_order=use_new_attention_order,
                         ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim, downsample=ds
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -610,7 +612,7 @@ class UNetModel(nn.Module):
                 num_head_channels=dim_head,
                 use_new_attention_order=use_new_attention_order,
             ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim, downsample=ds
                         ),
             ResBlock(
                 ch,
@@ -656,7 +658,7 @@ class UNetModel(nn.Module):
                             num_head_channels=dim_head,
                             use_new_attention_order=use_new_attention_order,
                         ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim, downsample=ds
                         )
                     )
                 if level and i == num_res_blocks:
@@ -728,13 +730,26 @@ class UNetModel(nn.Module):
             emb = emb + self.label_emb(y)
 
         h = x.type(self.dtype)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
-            h = th.cat([h, hs.pop()], dim=1)
-            h = module(h, emb, context)
+        cache = self.feature_cache
+        if cache is not None and cache.cheap_step(x):
+            # only the shallow blocks, the deep features are those of the last full evaluation
+            for module in self.input_blocks[:cache.branch + 1]:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = cache.features
+            for module in self.output_blocks[len(self.output_blocks) - cache.branch - 1:]:
+                h = th.cat([h, hs.pop()], dim=1)
+                h = module(h, emb, context)
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            for module in self.output_blocks:
+                if cache is not None and len(hs) == cache.branch + 1:
+                    cache.store(h, x)
+                h = th.cat([h, hs.pop()], dim=1)
+                h = module(h, emb, context)
         h = h.type(x.dtype)
         if self.predict_codebook_ids:
             return self.id_predictor(h)
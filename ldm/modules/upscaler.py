@@ -0,0 +1,204 @@
+import os, subprocess, tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+
+from ldm.devices import empty_cache, get_device
+
+
+def lanczos():
+    return Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS
+
+
+class ResidualDenseBlock(nn.Module):
+    def __init__(self, num_feat=64, num_grow_ch=32):
+        super().__init__()
+        self.conv1 = nn.Conv2d(num_feat, num_grow_ch, 3, 1, 1)
+        self.conv2 = nn.Conv2d(num_feat + num_grow_ch, num_grow_ch, 3, 1, 1)
+        self.conv3 = nn.Conv2d(num_feat + 2 * num_grow_ch, num_grow_ch, 3, 1, 1)
+        self.conv4 = nn.Conv2d(num_feat + 3 * num_grow_ch, num_grow_ch, 3, 1, 1)
+        self.conv5 = nn.Conv2d(num_feat + 4 * num_grow_ch, num_feat, 3, 1, 1)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+    def forward(self, x):
+        x1 = self.lrelu(self.conv1(x))
+        x2 = self.lrelu(self.conv2(torch.cat((x, x1), 1)))
+        x3 = self.lrelu(self.conv3(torch.cat((x, x1, x2), 1)))
+        x4 = self.lrelu(self.conv4(torch.cat((x, x1, x2, x3), 1)))
+        x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
+        return x5 * 0.2 + x
+
+
+class RRDB(nn.Module):
+    def __init__(self, num_feat, num_grow_ch=32):
+        super().__init__()
+        self.rdb1 = ResidualDenseBlock(num_feat, num_grow_ch)
+        self.rdb2 = ResidualDenseBlock(num_feat, num_grow_ch)
+        self.rdb3 = ResidualDenseBlock(num_feat, num_grow_ch)
+
+    def forward(self, x):
+        out = self.rdb3(self.rdb2(self.rdb1(x)))
+        return out * 0.2 + x
+
+
+class RRDBNet(nn.Module):
+    # ESRGAN generator with the BasicSR parameter names used by the Real-ESRGAN releases.
+    # The x2 and x1 models fold the input into channels with pixel_unshuffle first.
+    def __init__(self, num_in_ch=3, num_out_ch=3, scale=4, num_feat=64, num_block=23, num_grow_ch=32):
+        super().__init__()
+        self.scale = scale
+        if scale == 2:
+            num_in_ch = num_in_ch * 4
+        elif scale == 1:
+            num_in_ch = num_in_ch * 16
+        self.conv_first = nn.Conv2d(num_in_ch, num_feat, 3, 1, 1)
+        self.body = nn.Sequential(*[RRDB(num_feat, num_grow_ch) for _ in range(num_block)])
+        self.conv_body = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_up1 = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_up2 = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_hr = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_last = nn.Conv2d(num_feat, num_out_ch, 3, 1, 1)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+    def forward(self, x):
+        if self.scale == 2:
+            x = F.pixel_unshuffle(x, 2)
+        elif self.scale == 1:
+            x = F.pixel_unshuffle(x, 4)
+        feat = self.conv_first(x)
+        feat = feat + self.conv_body(self.body(feat))
+        feat = self.lrelu(self.conv_up1(F.interpolate(feat, scale_factor=2, mode='nearest')))
+        feat = self.lrelu(self.conv_up2(F.interpolate(feat, scale_factor=2, mode='nearest')))
+        return self.conv_last(self.lrelu(self.conv_hr(feat)))
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        # the architecture is read off the weights, so x4plus, x2plus and smaller variants all load
+        num_feat, in_ch = state_dict['conv_first.weight'].shape[:2]
+        scale = {3: 4, 12: 2, 48: 1}[in_ch]
+        num_block = len({key.split('.')[1] for key in state_dict if key.startswith('body.')})
+        num_grow_ch = state_dict['body.0.rdb1.conv1.weight'].shape[0]
+        model = cls(scale=scale, num_feat=num_feat, num_block=num_block, num_grow_ch=num_grow_ch)
+        model.load_state_dict(state_dict, strict=True)
+        return model
+
+
+class InterpolationUpscaler():
+    # no model, plain Lanczos resampling
+    def __init__(self, scale=2):
+        self.scale = scale
+
+    def upscale(self, image):
+        return image.resize((image.size[0] * self.scale, image.size[1] * self.scale), lanczos())
+
+
+class ESRGANUpscaler():
+    # In-process Real-ESRGAN. The image is upscaled in tiles of tile x tile pixels (0 for the
+    # whole image at once) with tile_pad pixels of context on each side, in half precision on cuda.
+    # The network output is resampled to scale when the model has a different one (x4plus -> 2x).
+    def __init__(self, model_path, scale=2, device=None, half_precision=True, tile=512, tile_pad=16):
+        self.model_path = model_path
+        self.scale = scale
+        self.device = get_device() if device is None else torch.device(device)
+        self.dtype = torch.float16 if half_precision and self.device.type == 'cuda' else torch.float32
+        self.tile = tile
+        self.tile_pad = tile_pad
+        self.model = None
+
+    def load(self):
+        state_dict = torch.load(self.model_path, map_location='cpu')
+        for key in ('params_ema', 'params'):
+            if key in state_dict:
+                state_dict = state_dict[key]
+                break
+        self.model = RRDBNet.from_state_dict(state_dict).eval().to(self.device, self.dtype)
+
+    def unload(self):
+        self.model = None
+        empty_cache(self.device)
+
+    def upscale(self, image):
+        if self.model is None:
+            self.load()
+        with torch.inference_mode():
+            x = torch.from_numpy(np.array(image.convert('RGB'))).permute(2, 0, 1)[None]
+            x = x.to(self.device, self.dtype) / 255.
+            # pixel_unshuffle needs sides divisible by its factor
+            mod = {4: 1, 2: 2, 1: 4}[self.model.scale]
+            h, w = x.shape[2:]
+            pad_h, pad_w = (mod - h % mod) % mod, (mod - w % mod) % mod
+            if pad_h or pad_w:
+                x = F.pad(x, (0, pad_w, 0, pad_h), mode='reflect')
+            out = self.tiled(x)[:, :, :h * self.model.scale, :w * self.model.scale]
+            out = (out[0].float().clamp(0, 1) * 255.).round().byte().permute(1, 2, 0).cpu().numpy()
+        result = Image.fromarray(out)
+        if self.model.scale != self.scale:
+            result = result.resize((image.size[0] * self.scale, image.size[1] * self.scale), lanczos())
+        return result
+
+    def tiled(self, x):
+        _, c, h, w = x.shape
+        s = self.model.scale
+        if self.tile <= 0 or (h <= self.tile and w <= self.tile):
+            return self.model(x)
+        tile, pad = self.tile, self.tile_pad
+        # the x2/x1 models need even (or /4) tile corners too
+        mod = {4: 1, 2: 2, 1: 4}[s]
+        tile, pad = tile - tile % mod, pad - pad % mod
+        out = x.new_empty(1, c, h * s, w * s)
+        for y0 in range(0, h, tile):
+            for x0 in range(0, w, tile):
+                y1, x1 = min(y0 + tile, h), min(x0 + tile, w)
+                py0, px0 = max(y0 - pad, 0), max(x0 - pad, 0)
+                py1, px1 = min(y1 + pad, h), min(x1 + pad, w)
+                result = self.model(x[:, :, py0:py1, px0:px1])
+                oy, ox = (y0 - py0) * s, (x0 - px0) * s
+                out[:, :, y0 * s:y1 * s, x0 * s:x1 * s] = result[:, :, oy:oy + (y1 - y0) * s, ox:ox + (x1 - x0) * s]
+        return out
+
+
+class NcnnUpscaler():
+    # the realesrgan-ncnn-vulkan executable, only for installs without the .pth weights
+    def __init__(self, executable, scale=2):
+        self.executable = executable
+        self.scale = scale
+
+    def upscale(self, image):
+        with tempfile.TemporaryDirectory() as tmp:
+            input, output = os.path.join(tmp, 'input.png'), os.path.join(tmp, 'output.png')
+            image.save(input)
+            subprocess.run([
+                os.path.join(self.executable, 'realesrgan-ncnn-vulkan.exe'),
+                '-i', input,
+                '-o', output,
+                '-n', 'realesrgan-x4plus'
+            ], check=True)
+            result = Image.open(output)
+            result.load()
+        return result.resize((image.size[0] * self.scale, image.size[1] * self.scale), lanczos())
+
+
+upscalers = ["auto", "esrgan", "lanczos", "ncnn"]
+
+
+def get_upscaler(name="auto", model_path=None, executable=None, scale=2, device=None, half_precision=True, tile=512):
+    # "auto" uses the in-process ESRGAN when its weights are there, then the ncnn executable,
+    # then Lanczos resampling
+    if name == "auto":
+        if model_path is not None and os.path.exists(model_path):
+            name = "esrgan"
+        elif executable is not None and os.path.exists(os.path.join(executable, 'realesrgan-ncnn-vulkan.exe')):
+            name = "ncnn"
+        else:
+            print(f"No upscaler model at {model_path}, upscaling with Lanczos")
+            name = "lanczos"
+    if name == "esrgan":
+        return ESRGANUpscaler(model_path, scale=scale, device=device, half_precision=half_precision, tile=tile)
+    if name == "ncnn":
+        return NcnnUpscaler(executable, scale=scale)
+    if name == "lanczos":
+        return InterpolationUpscaler(scale=scale)
+    raise ValueError(f"unknown upscaler {name}, choose from {upscalers}")
@@ -34,7 +34,6 @@ from contextlib import contextmanager, nullcontext
 from einops import rearrange, repeat
 from omegaconf import OmegaConf
 from pytorch_lightning import seed_everything
-from skimage.exposure import match_histograms
 from tqdm import tqdm, trange
 from types import SimpleNamespace
 import subprocess
@@ -46,7 +45,8 @@ sys.path.append("./src/clip")
 sys.path.append("./stable-diffusion/")
 sys.path.append("./k-diffusion")
 
-from helpers import save_samples, sampler_fn
+from helpers import ColorMatcher, VideoEncoder, save_samples, sampler_fn
+from ldm.checkpoint import load_checkpoint, load_weights, no_init_weights
 from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
@@ -64,14 +64,14 @@ class Predictor(BasePredictor):
         ckpt_path = "./weights/sd-v1-4.ckpt"
         local_config = OmegaConf.load(f"{ckpt_config_path}")
 
-        half_precision = True
-        self.model = load_model_from_config(
-            local_config, f"{ckpt_path}", half_precision=half_precision
-        )
         self.device = (
             torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         )
-        self.model = self.model.to(self.device)
+        # float16 only on cuda, the cpu runs in float32
+        half_precision = self.device.type == "cuda"
+        self.model = load_model_from_config(
+            local_config, f"{ckpt_path}", device=self.device, half_precision=half_precision
+        )
 
     def predict(
         self,
@@ -213,51 +213,18 @@ class Predictor(BasePredictor):
         if args.sampler != "ddim":
             args.ddim_eta = 0
 
-        if anim_args.animation_mode == "2D":
-            anim_args.animation_prompts = animation_prompts
-            render_animation(args, anim_args, self.model, self.device)
-        elif anim_args.animation_mode == "Video Input":
-            render_input_video(args, anim_args, self.model, self.device)
-        elif anim_args.animation_mode == "Interpolation":
-            render_interpolation(args, anim_args, self.model, self.device)
-        else:
-            render_image_batch(args, prompts, self.model, self.device)
-
-        # make video
-        image_path = os.path.join(args.outdir, f"{args.timestring}_%05d.png")
+        # make video, the frames are piped into ffmpeg as they are rendered
         mp4_path = f"/tmp/out.mp4"
-
-        # make video
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-vcodec",
-            "png",
-            "-r",
-            str(fps),
-            "-start_number",
-            str(0),
-            "-i",
-            image_path,
-            "-frames:v",
-            str(anim_args.max_frames),
-            "-c:v",
-            "libx264",
-            "-vf",
-            f"fps={fps}",
-            "-pix_fmt",
-            "yuv420p",
-            "-crf",
-            "17",
-            "-preset",
-            "veryfast",
-            mp4_path,
-        ]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            print(stderr)
-            raise RuntimeError(stderr)
+        with VideoEncoder(mp4_path, fps) as encoder:
+            if anim_args.animation_mode == "2D":
+                anim_args.animation_prompts = animation_prompts
+                render_animation(args, anim_args, self.model, self.device, encoder)
+            elif anim_args.animation_mode == "Video Input":
+                render_input_video(args, anim_args, self.model, self.device, encoder)
+            elif anim_args.animation_mode == "Interpolation":
+                render_interpolation(args, anim_args, self.model, self.device, encoder)
+            else:
+                render_image_batch(args, prompts, self.model, self.device)
 
         return Path(mp4_path)
 
@@ -341,6 +308,9 @@ def DeforumAnimArgs():
     interpolate_key_frames = False
     interpolate_x_frames = 4
 
+    # Video Output
+    save_frames = False
+
     # Resume Animation
     resume_from_timestring = False
     resume_timestring = " "
@@ -350,14 +320,16 @@ def DeforumAnimArgs():
 def load_model_from_config(
     config, ckpt, verbose=False, device="cuda", half_precision=True
 ):
-    map_location = "cuda"
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location=map_location)
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    sd, metadata = load_checkpoint(ckpt, half_precision=half_precision)
+    if "global_step" in metadata:
+        print(f"Global Step: {metadata['global_step']}")
+    with no_init_weights():
+        model = instantiate_from_config(config.model)
+    m, u = load_weights(
+        model, sd, device, torch.float16 if half_precision else torch.float32
+    )
+    del sd
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -365,10 +337,6 @@ def load_model_from_config(
         print("unexpected keys:")
         print(u)
 
-    if half_precision:
-        model = model.half().to(device)
-    else:
-        model = model.to(device)
     model.eval()
     return model
 
@@ -403,21 +371,6 @@ def load_img(path, shape):
     return 2.0 * image - 1.0
 
 
-def maintain_colors(prev_img, color_match_sample, mode):
-    if mode == "Match Frame 0 RGB":
-        return match_histograms(prev_img, color_match_sample, multichannel=True)
-    elif mode == "Match Frame 0 HSV":
-        prev_img_hsv = cv2.cvtColor(prev_img, cv2.COLOR_RGB2HSV)
-        color_match_hsv = cv2.cvtColor(color_match_sample, cv2.COLOR_RGB2HSV)
-        matched_hsv = match_histograms(prev_img_hsv, color_match_hsv, multichannel=True)
-        return cv2.cvtColor(matched_hsv, cv2.COLOR_HSV2RGB)
-    else:  # Match Frame 0 LAB
-        prev_img_lab = cv2.cvtColor(prev_img, cv2.COLOR_RGB2LAB)
-        color_match_lab = cv2.cvtColor(color_match_sample, cv2.COLOR_RGB2LAB)
-        matched_lab = match_histograms(prev_img_lab, color_match_lab, multichannel=True)
-        return cv2.cvtColor(matched_lab, cv2.COLOR_LAB2RGB)
-
-
 def make_callback(sampler, dynamic_threshold=None, static_threshold=None):
     # Creates the callback function to be passed into the samplers
     # The callback function is applied to the image after each step
@@ -743,7 +696,15 @@ def render_image_batch(args, prompts, model, device):
             display.display(grid_image)
 
 
-def render_animation(args, anim_args, model, device):
+def save_frame(image, path, anim_args, encoder=None):
+    # with an encoder the PNG is only written when save_frames is set
+    if encoder is not None:
+        encoder.write(image)
+    if encoder is None or anim_args.save_frames:
+        image.save(path)
+
+
+def render_animation(args, anim_args, model, device, encoder=None):
     # animations use key framed prompts
     args.prompts = anim_args.animation_prompts
 
@@ -777,7 +738,7 @@ def render_animation(args, anim_args, model, device):
 
     args.n_samples = 1
     prev_sample = None
-    color_match_sample = None
+    color_matcher = None
     for frame_idx in range(start_frame, anim_args.max_frames):
         print(f"Rendering animation frame {frame_idx} of {anim_args.max_frames}")
 
@@ -824,12 +785,12 @@ def render_animation(args, anim_args, model, device):
 
             # apply color matching
             if anim_args.color_coherence != "None":
-                if color_match_sample is None:
-                    color_match_sample = prev_img.copy()
-                else:
-                    prev_img = maintain_colors(
-                        prev_img, color_match_sample, anim_args.color_coherence
+                if color_matcher is None:
+                    color_matcher = ColorMatcher(
+                        prev_img, anim_args.color_coherence, device
                     )
+                else:
+                    prev_img = color_matcher.match(prev_img)
 
             # apply scaling
             contrast_sample = prev_img * contrast
@@ -858,7 +819,7 @@ def render_animation(args, anim_args, model, device):
         sample, image = results[0], results[1]
 
         filename = f"{args.timestring}_{frame_idx:05}.png"
-        image.save(os.path.join(args.outdir, filename))
+        save_frame(image, os.path.join(args.outdir, filename), anim_args, encoder)
         if not using_vid_init:
             prev_sample = sample
 
@@ -868,7 +829,7 @@ def render_animation(args, anim_args, model, device):
         args.seed = next_seed(args)
 
 
-def render_input_video(args, anim_args, model, dvice):
+def render_input_video(args, anim_args, model, dvice, encoder=None):
     # create a folder for the video input frames to live in
     video_in_frame_path = os.path.join(args.outdir, "inputframes")
     os.makedirs(os.path.join(args.outdir, video_in_frame_path), exist_ok=True)
@@ -911,10 +872,10 @@ def render_input_video(args, anim_args, model, dvice):
     print(
         f"Loading {anim_args.max_frames} input frames from {video_in_frame_path} and saving video frames to {args.outdir}"
     )
-    render_animation(args, anim_args, model, device)
+    render_animation(args, anim_args, model, device, encoder)
 
 
-def render_interpolation(args, anim_args, model, device):
+def render_interpolation(args, anim_args, model, device, encoder=None):
     # animations use key framed prompts
     args.prompts = animation_prompts
 
@@ -978,7 +939,7 @@ def render_interpolation(args, anim_args, model, device):
                     image = results[0]
 
                     filename = f"{args.timestring}_{frame_idx:05}.png"
-                    image.save(os.path.join(args.outdir, filename))
+                    save_frame(image, os.path.join(args.outdir, filename), anim_args, encoder)
                     frame_idx += 1
 
                     display.clear_output(wait=True)
@@ -1003,7 +964,7 @@ def render_interpolation(args, anim_args, model, device):
                 image = results[0]
 
                 filename = f"{args.timestring}_{frame_idx:05}.png"
-                image.save(os.path.join(args.outdir, filename))
+                save_frame(image, os.path.join(args.outdir, filename), anim_args, encoder)
                 frame_idx += 1
 
                 display.clear_output(wait=True)
@@ -1016,7 +977,7 @@ def render_interpolation(args, anim_args, model, device):
     results = generate(args, model, device)
     image = results[0]
     filename = f"{args.timestring}_{frame_idx:05}.png"
-    image.save(os.path.join(args.outdir, filename))
+    save_frame(image, os.path.join(args.outdir, filename), anim_args, encoder)
 
     display.clear_output(wait=True)
     display.display(image)
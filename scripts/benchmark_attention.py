@@ -0,0 +1,94 @@
+import argparse, time
+
+import torch
+
+from ldm.modules.attention import attention_backends, set_attention_backend, get_attention_backend
+
+
+def attention_shapes(resolution, batch_size):
+    # (name, q shape, k/v length) of the largest attention calls at this output resolution
+    # for SD v1: highest resolution UNet self/cross attention (8 heads x 40) with the
+    # cond/uncond batch, and the VAE mid block AttnBlock (1 head x 512)
+    tokens = (resolution // 8) ** 2
+    return [
+        ("unet self-attention", (batch_size * 2 * 8, tokens, 40), tokens),
+        ("unet cross-attention", (batch_size * 2 * 8, tokens, 40), 77),
+        ("vae attention", (batch_size, tokens, 512), tokens),
+    ]
+
+
+def benchmark(attention, q, k, v, repeats):
+    attention(q, k, v, q.shape[-1] ** -0.5)
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        attention(q, k, v, q.shape[-1] ** -0.5)
+    torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = torch.cuda.max_memory_allocated() - base
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resolutions",
+        type=int,
+        nargs="+",
+        default=[512, 768, 1024],
+        help="output image sizes in pixels",
+    )
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=list(attention_backends),
+        help="attention backends to compare",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="images per batch",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=10,
+        help="timed calls per measurement",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["full", "half"],
+        default="half",
+    )
+    opt = parser.parse_args()
+
+    assert torch.cuda.is_available(), "the attention benchmark needs a cuda device"
+    dtype = torch.float16 if opt.precision == "half" else torch.float32
+
+    print(f"{'resolution':>10} {'call':<22} {'backend':<8} {'ms':>9} {'extra MB':>9}")
+    for resolution in opt.resolutions:
+        for name, q_shape, kv_len in attention_shapes(resolution, opt.batch_size):
+            q = torch.randn(q_shape, device="cuda", dtype=dtype)
+            k = torch.randn(q_shape[0], kv_len, q_shape[2], device="cuda", dtype=dtype)
+            v = torch.randn(q_shape[0], kv_len, q_shape[2], device="cuda", dtype=dtype)
+            for backend in opt.backends:
+                try:
+                    set_attention_backend(backend)
+                    elapsed, peak = benchmark(get_attention_backend(), q, k, v, opt.repeats)
+                    result = f"{elapsed * 1000:9.2f} {peak / 1024 ** 2:9.0f}"
+                except RuntimeError as e:
+                    # out of memory, or sdpa on torch < 2.0
+                    result = f"{'failed':>9} {str(e).splitlines()[0][:60]}"
+                torch.cuda.empty_cache()
+                print(f"{resolution:>10} {name:<22} {backend:<8} {result}")
+            del q, k, v
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import pytest
+
+from ldm.models.diffusion.guidance import GuidanceSchedule
+
+
+def test_constant():
+    schedule = GuidanceSchedule(7)
+    assert schedule.constant
+    assert schedule(0.0) == 7 and schedule(0.99) == 7
+
+
+def test_ramp():
+    schedule = GuidanceSchedule(8, 4)
+    assert not schedule.constant
+    assert schedule(0.0) == 8
+    assert schedule(0.5) == pytest.approx(6)
+    assert schedule(0.75) == pytest.approx(5)
+
+
+def test_cutoff():
+    # steps at or past the cutoff only run the conditional pass
+    schedule = GuidanceSchedule(7, cutoff=0.6)
+    assert not schedule.constant
+    assert schedule(0.59) == 7
+    assert schedule(0.6) is None
+    assert schedule(1.0) is None
+
+
+def test_from_args():
+    assert GuidanceSchedule.from_args(SimpleNamespace(scale=7)).constant
+    # scale_end <= 0 keeps the scale
+    assert GuidanceSchedule.from_args(SimpleNamespace(scale=7, scale_end=0, cfg_cutoff=1.0)).constant
+    schedule = GuidanceSchedule.from_args(SimpleNamespace(scale=7, scale_end=3, cfg_cutoff=0.8))
+    assert schedule(0.5) == pytest.approx(5)
+    assert schedule(0.8) is None
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from helpers.render_journal import RenderJournal
+
+
+def save_frames(journal, outdir, frames):
+    for frame in frames:
+        path = os.path.join(outdir, f"ts_{frame:05}.png")
+        open(path, 'wb').close()
+        journal.frame_saved(path)
+
+
+def render_with_cadence(outdir, turbo_steps, crash_at):
+    # the loop of render_animation with cadence: the snapshot at a diffused frame is taken before
+    # the in-between frames up to it are saved, the run stops right after the one at crash_at
+    with RenderJournal(outdir, 'ts', interval=1) as journal:
+        for frame_idx in range(0, crash_at + 1, turbo_steps):
+            journal.snapshot(frame_idx, {'turbo_next_frame_idx': frame_idx - turbo_steps}, saved=max(0, frame_idx - turbo_steps))
+            if frame_idx == crash_at:
+                break
+            save_frames(journal, outdir, range(max(0, frame_idx - turbo_steps), frame_idx))
+
+
+def test_resume_with_cadence(tmp_path):
+    render_with_cadence(str(tmp_path), 3, crash_at=9)
+    journal = RenderJournal(str(tmp_path), 'ts')
+    # frames 6-8 were never saved, the snapshot at 9 renders them again
+    assert journal.frames_on_disk() == 6
+    state = journal.resume('cpu')
+    assert state['frame_idx'] == 9
+    assert state['turbo_next_frame_idx'] == 6
+
+
+def test_resume_missing_frame(tmp_path):
+    render_with_cadence(str(tmp_path), 3, crash_at=9)
+    os.remove(os.path.join(str(tmp_path), "ts_00002.png"))
+    journal = RenderJournal(str(tmp_path), 'ts')
+    assert journal.frames_on_disk() == 2
+    assert journal.resume('cpu') is None
+
+
+def test_resume_without_cadence(tmp_path):
+    with RenderJournal(str(tmp_path), 'ts', interval=2) as journal:
+        save_frames(journal, str(tmp_path), range(4))
+        journal.snapshot(4, {})
+    assert RenderJournal(str(tmp_path), 'ts').resume('cpu')['frame_idx'] == 4
+    os.remove(os.path.join(str(tmp_path), "ts_00003.png"))
+    assert RenderJournal(str(tmp_path), 'ts').resume('cpu') is None
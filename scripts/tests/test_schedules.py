@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from helpers.schedules import get_inbetweens, get_prompt_series, parse_key_frames
+
+
+# expected values are the outputs of the pandas implementation the schedules replaced, where it
+# accepted the input
+# (pd.Series.interpolate(limit_direction='both') after filling the first and last frame,
+# ffill().bfill() for prompts)
+
+def inbetweens(string, max_frames, **kwargs):
+    return get_inbetweens(parse_key_frames(string), max_frames, **kwargs)
+
+
+def test_parse_key_frames():
+    assert parse_key_frames("0: (1.0), 50: (sin(t))") == {0: '1.0', 50: 'sin(t)'}
+    with pytest.raises(RuntimeError):
+        parse_key_frames("0: 1.0")
+
+
+def test_linear():
+    np.testing.assert_allclose(inbetweens("0: (0), 10: (10)", 11), np.arange(11))
+    np.testing.assert_allclose(inbetweens("0: (0), 2: (4), 6: (0)", 8), [0, 2, 4, 3, 2, 1, 0, 0])
+
+
+def test_first_and_last_fill():
+    # frames before the first and after the last key frame keep the nearest key value. The pandas
+    # version raised without a key frame at 0, so these values are not pandas outputs.
+    np.testing.assert_allclose(inbetweens("2: (4), 4: (8)", 7), [4, 4, 4, 6, 8, 8, 8])
+
+
+def test_float64():
+    # img2img frames take t_enc = int((1.0-strength)*steps), float32 0.6 gives 19 instead of 20
+    strength = inbetweens("0: (0.6)", 3)
+    assert strength.dtype == np.float64
+    assert int((1.0-strength[0])*50) == 20
+
+
+def test_key_frames_past_max_frames():
+    np.testing.assert_allclose(inbetweens("0: (1.0), 4: (5)", 3), [1, 1, 1])
+
+
+def test_integer():
+    np.testing.assert_array_equal(inbetweens("0: (0), 4: (3)", 5, integer=True), [0, 0, 1, 2, 3])
+
+
+def test_cubic_falls_back_to_linear():
+    np.testing.assert_allclose(inbetweens("0: (0), 5: (5)", 6, interp_method='Cubic'), np.arange(6))
+
+
+def test_expressions():
+    pytest.importorskip('numexpr')
+    np.testing.assert_allclose(inbetweens("0: (0.5*t)", 4), [0, 0.5, 1, 1.5])
+    # an expression runs up to the next key frame, the frames after the last number keep it
+    np.testing.assert_allclose(inbetweens("0: (t), 3: (10)", 6), [0, 1, 2, 10, 10, 10])
+
+
+def test_prompt_series():
+    assert get_prompt_series({0: 'a', 3: 'b', 10: 'c'}, 5) == ['a', 'a', 'a', 'b', 'b']
+    assert get_prompt_series({2: 'a', 4: 'b'}, 6) == ['a', 'a', 'a', 'a', 'b', 'b']
+    assert get_prompt_series({3: 'b', 0: 'a'}, 4) == ['a', 'a', 'a', 'b']
+    assert get_prompt_series({'0': 'a', '2': 'b'}, 3) == ['a', 'a', 'b']
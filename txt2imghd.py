@@ -14,7 +14,6 @@ import cv2
 import PIL
 import gc
 import numpy as np
-import subprocess
 from omegaconf import OmegaConf
 from PIL import Image, ImageDraw
 from tqdm import tqdm, trange
@@ -26,7 +25,12 @@ import time
 from pytorch_lightning import seed_everything
 from torch.cuda.amp import autocast
 
+from ldm.checkpoint import load_checkpoint, load_weights, no_init_weights
 from ldm.util import instantiate_from_config
+from ldm.devices import describe, empty_cache, free_memory, get_device, get_dtype
+from ldm.modules.attention import set_attention_backend, set_token_merging
+from ldm.modules.diffusionmodules.feature_cache import feature_caching
+from ldm.modules.upscaler import get_upscaler, upscalers
 from ldm.models.diffusion.ddimHD import DDIMSampler
 from ldm.models.diffusion.plmsHD import PLMSSampler
 
@@ -56,14 +60,16 @@ def numpy_to_pil(images):
 
     return pil_images
 
-def load_model_from_config(config, ckpt, verbose=False):
+def load_model_from_config(config, ckpt, device, verbose=False):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    sd, metadata = load_checkpoint(ckpt, half_precision=False)
+    if "global_step" in metadata:
+        print(f"Global Step: {metadata['global_step']}")
+    with no_init_weights():
+        model = instantiate_from_config(config.model)
+    # the model runs in float32, autocast picks half precision kernels where it can
+    m, u = load_weights(model, sd, device, get_dtype(device, half_precision=False))
+    del sd
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -71,7 +77,6 @@ def load_model_from_config(config, ckpt, verbose=False):
         print("unexpected keys:")
         print(u)
 
-    model.cuda()
     model.eval()
     return model
 
@@ -224,11 +229,19 @@ class Options:
     passes: int
     wm: str
     realesrgan: str
+    upscaler: str
+    upscaler_model: str
+    upscaler_tile: int
     detail_steps: int
     detail_scale: float
     gobig_overlap: int
     generated: Optional[List[str]]
     img: str
+    attention: str
+    tile_batch: int
+    token_merging: float
+    feature_cache_interval: int
+    feature_cache_branch: int
 
 def main():
     
@@ -358,6 +371,25 @@ def main():
         default="realesrgan-ncnn-vulkan",
         help="path to realesrgan executable"
     )
+    parser.add_argument(
+        "--upscaler",
+        type=str,
+        default="auto",
+        choices=upscalers,
+        help="upscaler between passes, auto uses esrgan when --upscaler_model exists",
+    )
+    parser.add_argument(
+        "--upscaler_model",
+        type=str,
+        default="models/RealESRGAN_x4plus.pth",
+        help="Real-ESRGAN weights for the esrgan upscaler",
+    )
+    parser.add_argument(
+        "--upscaler_tile",
+        type=int,
+        default=512,
+        help="tile size for the esrgan upscaler, 0 upscales the whole image at once",
+    )
     parser.add_argument(
         "--detail_steps",
         type=int,
@@ -376,11 +408,42 @@ def main():
         default=128,
         help="overlap size for GOBIG",
     )
+    parser.add_argument(
+        "--tile_batch",
+        type=int,
+        default=0,
+        help="GOBIG slices detailed per batch, 0 picks as many as fit in free memory",
+    )
 
     parser.add_argument("--embedding_type", type=str, help=".bin or .pt")
     parser.add_argument("--embedding_path", type=str, help="Path to a pre-trained embedding manager checkpoint")
     parser.add_argument("--negative_prompt", type=str, help="negative prompt")
     parser.add_argument('--seamless',action='store_true',default=False,help='Change the model to seamless tiling (circular) mode',)
+    parser.add_argument(
+        "--attention",
+        type=str,
+        default="auto",
+        choices=["auto", "sliced", "sdpa", "chunked"],
+        help="attention backend, chunked uses the least memory on large GOBIG tiles",
+    )
+    parser.add_argument(
+        "--token_merging",
+        type=float,
+        default=0.0,
+        help="share of tokens merged for self attention at full latent resolution, 0.3-0.5 speeds up large tiles",
+    )
+    parser.add_argument(
+        "--feature_cache_interval",
+        type=int,
+        default=1,
+        help="evaluate the full UNet only every this many steps and reuse its deep features in between, 1 turns it off",
+    )
+    parser.add_argument(
+        "--feature_cache_branch",
+        type=int,
+        default=0,
+        help="shallow UNet blocks recomputed on the steps in between, 0 is the fastest",
+    )
 
     parser.add_argument("--image_file", type=str)
 
@@ -393,24 +456,79 @@ def main():
        
     text2img2(opt)
 
-def realesrgan2x(executable: str, input: str, output: str):
-    print(f"executable = {executable}\n")
-    print(f"input = {input}\n")
-    print(f"output = {output}\n")
-    process = subprocess.Popen([
-        './'+executable+'/realesrgan-ncnn-vulkan.exe',
-        '-i',
-        './'+input,
-        '-o',
-        './'+output,
-        '-n',
-        'realesrgan-x4plus'
-    ])
-    process.wait()
-
-    final_output = Image.open(output)
-    final_output = final_output.resize((int(final_output.size[0] / 2), int(final_output.size[1] / 2)), get_resampling_mode())
-    final_output.save(output)
+def tile_batch_size(opt, device, n_tiles):
+    if opt.tile_batch > 0:
+        return min(opt.tile_batch, n_tiles)
+    # rough cost of one slice with guidance: latents, VAE activations and attention scores
+    per_tile = opt.H * opt.W * 2048
+    return max(1, min(n_tiles, int(free_memory(device) // per_tile)))
+
+def detail_tile_batch(opt, model, sampler, tiles, c, uc, t_enc, device):
+    n = tiles.shape[0]
+    init_latent = model.get_first_stage_encoding(model.encode_first_stage(tiles.to(device)))  # move to latent space
+    # encode (scaled latent)
+    z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]*n).to(device))
+    # decode it
+    with feature_caching(model, opt.feature_cache_interval, opt.feature_cache_branch):
+        samples = sampler.decode(z_enc, repeat(c, '1 ... -> b ...', b=n), t_enc, unconditional_guidance_scale=opt.detail_scale,
+                                unconditional_conditioning=None if uc is None else repeat(uc, '1 ... -> b ...', b=n),)
+
+    x_samples = model.decode_first_stage(samples)
+    x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+
+    resultslices = []
+    for x_sample in x_samples:
+        x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
+        resultslices.append(Image.fromarray(x_sample.astype(np.uint8)).convert('RGBA'))
+    return resultslices
+
+def detail_slices(opt, model, sampler, slices, data, device):
+    # GOBIG detailing of every slice of a pass: the schedule is made once, the conditioning is
+    # computed once per prompt and slices are encoded, sampled and decoded in batches. A batch
+    # that runs out of memory is split in half and retried.
+    sampler.make_schedule(ddim_num_steps=opt.detail_steps, ddim_eta=0, verbose=False)
+
+    assert 0. <= opt.strength <= 1., 'can only work with strength in [0.0, 1.0]'
+    t_enc = int(opt.strength * opt.detail_steps)
+
+    tiles = torch.cat([convert_pil_img(chunk) for chunk, _, _ in slices])
+    tile_batch = tile_batch_size(opt, device, len(slices))
+    results = [[] for _ in slices]
+
+    with torch.inference_mode():
+        #fix for using less VRAM 3/3
+        with torch.cuda.amp.autocast():
+            with model.ema_scope():
+                for prompts in tqdm(data, desc="data"):
+                    uc = None
+                    if opt.detail_scale != 1.0:
+                        uc = model.get_learned_conditioning([opt.negative_prompt])
+                    if isinstance(prompts, tuple):
+                        prompts = list(prompts)
+                    c = model.get_learned_conditioning(prompts)
+
+                    start = 0
+                    while start < len(slices):
+                        n = min(tile_batch, len(slices) - start)
+                        try:
+                            resultslices = detail_tile_batch(opt, model, sampler, tiles[start:start+n], c, uc, t_enc, device)
+                        except RuntimeError as e:
+                            if 'out of memory' not in str(e) or n == 1:
+                                raise
+                            tile_batch = max(1, n // 2)
+                            print(f">> out of memory detailing {n} slices, retrying with {tile_batch}")
+                            empty_cache(device)
+                            continue
+                        for i, resultslice in enumerate(resultslices):
+                            results[start + i].append(resultslice)
+                        start += n
+
+    # same order as detailing the slices one by one, so the center slices end up on top
+    betterslices = []
+    for (_, coord_x, coord_y), resultslices in zip(slices, results):
+        for resultslice in resultslices:
+            betterslices.append((resultslice, coord_x, coord_y))
+    return betterslices
 
 def text2img2(opt: Options):
 
@@ -449,18 +567,20 @@ def text2img2(opt: Options):
             shutil.copyfile(originalbin, file_path)
             print('using .bin embedding')  
             
+    print(f">> using {set_attention_backend(opt.attention)} attention")
+    set_token_merging(opt.token_merging)
+    device = get_device()
+    print('Using device:', describe(device))
+    sys.stdout.flush()
+
     config = OmegaConf.load(f"{opt.config}")
-    model = load_model_from_config(config, f"{opt.ckpt}")
+    model = load_model_from_config(config, f"{opt.ckpt}", device)
     if opt.embedding_path is not None:
         model.embedding_manager.load(opt.embedding_path)
 
     #fix for using less VRAM 1/3 - add next line
     #model.half()
 
-    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
-    print('Using device:', device)
-    print(torch.cuda.get_device_properties(device))
-    sys.stdout.flush()
     model = model.to(device)
 
     if opt.ddim:
@@ -529,15 +649,16 @@ def text2img2(opt: Options):
                                 prompts = list(prompts)
                             c = model.get_learned_conditioning(prompts)
                             shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
-                            samples_ddim, _ = sampler.sample(S=opt.steps,
-                                                            conditioning=c,
-                                                            batch_size=batch_size,
-                                                            shape=shape,
-                                                            verbose=False,
-                                                            unconditional_guidance_scale=opt.scale,
-                                                            unconditional_conditioning=uc,
-                                                            eta=0,
-                                                            x_T=None)
+                            with feature_caching(model, opt.feature_cache_interval, opt.feature_cache_branch):
+                                samples_ddim, _ = sampler.sample(S=opt.steps,
+                                                                conditioning=c,
+                                                                batch_size=batch_size,
+                                                                shape=shape,
+                                                                verbose=False,
+                                                                unconditional_guidance_scale=opt.scale,
+                                                                unconditional_conditioning=uc,
+                                                                eta=0,
+                                                                x_T=None)
 
                             x_samples_ddim = model.decode_first_stage(samples_ddim)
                             x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
@@ -569,14 +690,16 @@ def text2img2(opt: Options):
 
     sampler = DDIMSampler(model)
 
+    upscaler = get_upscaler(opt.upscaler, model_path=opt.upscaler_model, executable=opt.realesrgan, device=device, tile=opt.upscaler_tile)
+
     for base_filename in generated:
+        # every pass upscales the previous pass in memory, the PNGs are only written as outputs
+        source_image = Image.open(os.path.join(sample_path, f"{base_filename}.png")).convert("RGB")
         for _ in trange(opt.passes, desc="Passes"):
-            realesrgan2x(opt.realesrgan, os.path.join(sample_path, f"{base_filename}.png"), os.path.join(sample_path, f"{base_filename}u.png"))
-            #realesrgan2x(opt.realesrgan, opt.image_file, opt.image_file)
+            source_image = upscaler.upscale(source_image)
             base_filename = f"{base_filename}u"
+            source_image.save(os.path.join(sample_path, f"{base_filename}.png"))
 
-            source_image = Image.open(os.path.join(sample_path, f"{base_filename}.png"))
-            
             sys.stdout.write('Saving progress ...\n')
             sys.stdout.flush()
             shutil.copyfile(os.path.join(sample_path, f"{base_filename}.png"),opt.image_file)
@@ -587,54 +710,7 @@ def text2img2(opt: Options):
             og_size = (opt.H,opt.W)
             slices, _ = grid_slice(source_image, opt.gobig_overlap, og_size, False)
 
-            betterslices = []
-            for _, chunk_w_coords in tqdm(enumerate(slices), "Slices", disable=True):
-            
-                #sys.stdout.write(f'Slice {_}\n')
-                #sys.stdout.flush()
-
-                chunk, coord_x, coord_y = chunk_w_coords
-                init_image = convert_pil_img(chunk).to(device)
-                init_image = repeat(init_image, '1 ... -> b ...', b=batch_size)
-                
-                #fix for using less VRAM 2/3 next line added
-                #with torch.cuda.amp.autocast(): # needed for half precision!
-                init_latent = model.get_first_stage_encoding(model.encode_first_stage(init_image))  # move to latent space
-
-                sampler.make_schedule(ddim_num_steps=opt.detail_steps, ddim_eta=0, verbose=False)
-
-                assert 0. <= opt.strength <= 1., 'can only work with strength in [0.0, 1.0]'
-                t_enc = int(opt.strength * opt.detail_steps)
-
-                with torch.inference_mode():
-        
-                    #with precision_scope("cuda"):
-                    #fix for using less VRAM 3/3 - change previous line to this
-                    with torch.cuda.amp.autocast():
-                    
-                        with model.ema_scope():
-                            for prompts in tqdm(data, desc="data"):
-
-                                uc = None
-                                if opt.detail_scale != 1.0:
-                                    uc = model.get_learned_conditioning(batch_size * [opt.negative_prompt])
-                                if isinstance(prompts, tuple):
-                                    prompts = list(prompts)
-                                c = model.get_learned_conditioning(prompts)
-
-                                # encode (scaled latent)
-                                z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]*batch_size).to(device))
-                                # decode it
-                                samples = sampler.decode(z_enc, c, t_enc, unconditional_guidance_scale=opt.detail_scale,
-                                                        unconditional_conditioning=uc,)
-
-                                x_samples = model.decode_first_stage(samples)
-                                x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
-
-                                for x_sample in x_samples:
-                                    x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                                    resultslice = Image.fromarray(x_sample.astype(np.uint8)).convert('RGBA')
-                                    betterslices.append((resultslice.copy(), coord_x, coord_y))
+            betterslices = detail_slices(opt, model, sampler, slices, data, device)
 
             alpha = Image.new('L', og_size, color=0xFF)
             alpha_gradient = ImageDraw.Draw(alpha)
@@ -665,6 +741,7 @@ def text2img2(opt: Options):
 
             #final_output.save(opt.image_file)
             base_filename = f"{base_filename}d"
+            source_image = final_output
 
             torch.cuda.empty_cache()
             gc.collect()